@@ -18,6 +18,9 @@ def create_app() -> Flask:
     # 延迟导入注册任务，避免循环引用
     from .tasks.jobs import register_jobs
     register_jobs(scheduler.instance, app)
+    # 记录事件流起点，读线程从进程启动时的末尾开始
+    from .services.events import EventBus
+    EventBus.mark_start()
 
     # Blueprints
     app.register_blueprint(api_v1_bp, url_prefix="/api/v1")
@@ -1,17 +1,22 @@
-from flask import Blueprint, request, Response
+from flask import Blueprint, request, Response, current_app
 from ..services.devices import DeviceService
 from ..services.menu import MenuService
+from ..services.menu_templates import MenuTemplateService
 from ..services.commands import CommandService
+from ..services.progress import ProgressHub
+from ..services.events import EventBus
+from ..services.targets import TargetService
 from ..services.orders import OrderService
 from ..services.materials import MaterialService
 from ..services.recipes import RecipeService
+from ..services.dict_cache import DictCache
 from ..services.audit import AuditService
 from ..services.packages import PackageService
 from ..services.alarms import AlarmService
 from ..utils.rbac import require_role
 from ..utils.extensions import redis_cli
 from ..utils.keys import k_menu_meta
-import json, time
+import json, queue
 
 api_v1_bp = Blueprint("api_v1", __name__)
 
@@ -55,6 +60,40 @@ def devices_list():
     page_size = request.args.get('page_size', 20)
     return ok(DeviceService.list_devices(status=status, query=query, page=int(page), page_size=int(page_size)))
 
+# Device labels / groups / selectors
+@api_v1_bp.get("/devices/select")
+@require_role(["admin", "ops", "viewer"]) 
+def devices_select():
+    # 预览选择器命中：?selector=tag:a AND NOT status:offline&limit=20
+    try:
+        return ok(TargetService.preview(request.args.get('selector') or '', int(request.args.get('limit', 20))))
+    except ValueError as e:
+        return err(str(e), 400)
+
+@api_v1_bp.put("/devices/<device_id>/labels")
+@require_role(["admin", "ops"]) 
+def device_labels_put(device_id):
+    body = request.json or {}
+    try:
+        return ok(DeviceService.set_labels(device_id, body.get('tags'), body.get('groups'), body.get('attrs')))
+    except ValueError as e:
+        code = 404 if str(e) == 'DEVICE_NOT_FOUND' else 400
+        return err(str(e), code)
+
+@api_v1_bp.get("/device-groups")
+@require_role(["admin", "ops", "viewer"]) 
+def device_groups_list():
+    return ok(DeviceService.list_groups())
+
+@api_v1_bp.post("/device-groups/<group>/members")
+@require_role(["admin", "ops"]) 
+def device_group_members(group):
+    body = request.json or {}
+    try:
+        return ok(DeviceService.update_group(group, body.get('add'), body.get('remove'), body.get('selector')))
+    except ValueError as e:
+        return err(str(e), 400)
+
 @api_v1_bp.post("/devices/<device_id>/sync_state")
 @require_role(["admin", "ops"]) 
 def sync_state(device_id):
@@ -185,6 +224,15 @@ def device_orders_export(device_id):
 def device_bins(device_id):
     return ok(DeviceService.list_bins(device_id))
 
+@api_v1_bp.put("/devices/<device_id>/bins/<bin_index>")
+@require_role(["admin", "ops"]) 
+def device_bin_update(device_id, bin_index):
+    body = request.json or {}
+    try:
+        return ok(DeviceService.update_bin(device_id, bin_index, body))
+    except ValueError as e:
+        return err(str(e), 400)
+
 # Commands
 @api_v1_bp.post("/devices/<device_id>/commands")
 @require_role(["admin", "ops"]) 
@@ -200,7 +248,36 @@ def device_command(device_id):
 @require_role(["admin", "ops", "viewer"]) 
 def device_commands_list(device_id):
     limit = int(request.args.get("limit", 50))
-    return ok(CommandService.list_by_device(device_id, limit))
+    offset = int(request.args.get("offset", 0))
+    return ok(CommandService.list_by_device(device_id, limit, offset))
+
+# Device-side long poll / ack
+@api_v1_bp.get("/devices/<device_id>/commands/next")
+@require_role(["admin", "device"]) 
+def device_commands_next(device_id):
+    max_wait = int(current_app.config.get("CMD_LONGPOLL_MAX_WAIT", 30))
+    wait = max(0, min(int(request.args.get("wait", 0)), max_wait))
+    limit = int(request.args.get("limit", 1))
+    return ok(CommandService.claim_wait(device_id, limit, wait))
+
+@api_v1_bp.post("/devices/<device_id>/commands/ack:batch")
+@require_role(["admin", "device"]) 
+def device_commands_ack_batch(device_id):
+    body = request.json or {}
+    try:
+        return ok(CommandService.ack_many(device_id, body.get("results")))
+    except ValueError as e:
+        return err(str(e), 400)
+
+@api_v1_bp.put("/devices/<device_id>/recipes/active")
+@require_role(["admin", "device"]) 
+def device_recipes_active(device_id):
+    # 设备上报当前启用的配方（整体替换），维护 recipe → devices 反向索引
+    ids = (request.json or {}).get("recipe_ids")
+    if not isinstance(ids, list):
+        return err('INVALID_ARGUMENT:recipe_ids', 400)
+    RecipeService.set_device_active(device_id, ids)
+    return ok()
 
 # Menu read
 @api_v1_bp.get("/devices/<device_id>/menu")
@@ -245,6 +322,8 @@ def update_category(device_id, cat_id):
         return ok(cat)
     except KeyError:
         return err("MENU_CATEGORY_NOT_FOUND", 404)
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.delete("/devices/<device_id>/menu/categories/<cat_id>")
 @require_role(["admin", "ops"]) 
@@ -291,6 +370,8 @@ def update_item(device_id, item_id):
         return ok(item)
     except KeyError:
         return err("MENU_ITEM_NOT_FOUND", 404)
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.delete("/devices/<device_id>/menu/items/<item_id>")
 @require_role(["admin", "ops"]) 
@@ -300,8 +381,11 @@ def delete_item(device_id, item_id):
         cur_ver = redis_cli.r.hget(k_menu_meta(device_id), "version") or "1"
         if str(if_match) != str(cur_ver):
             return err("CONFLICT", 409)
-    MenuService.delete_item(device_id, item_id)
-    return ok()
+    try:
+        MenuService.delete_item(device_id, item_id)
+        return ok()
+    except ValueError as e:
+        return err(str(e), 400)
 
 # Visibility / schedule / price
 @api_v1_bp.patch("/devices/<device_id>/menu/items/<item_id>/visibility")
@@ -343,8 +427,23 @@ def put_price(device_id, item_id):
         cur_ver = redis_cli.r.hget(k_menu_meta(device_id), "version") or "1"
         if str(if_match) != str(cur_ver):
             return err("CONFLICT", 409)
-    item = MenuService.set_price(device_id, item_id, price)
-    return ok(item)
+    try:
+        item = MenuService.set_price(device_id, item_id, price)
+        return ok(item)
+    except ValueError as e:
+        return err(str(e), 400)
+
+@api_v1_bp.post("/devices/<device_id>/menu/items:bulk")
+@require_role(["admin", "ops"]) 
+def bulk_items(device_id):
+    body = request.json or {}
+    try:
+        res = MenuService.bulk_update(device_id, body.get("ops"), request.headers.get("If-Match"))
+        return ok(res)
+    except ValueError as e:
+        if str(e) == "CONFLICT":
+            return err("CONFLICT", 409)
+        return err(str(e), 400)
 
 # Publish / export / import
 @api_v1_bp.post("/devices/<device_id>/menu/publish")
@@ -370,6 +469,49 @@ def import_menu(device_id):
     except ValueError as e:
         return err(str(e), 400)
 
+# Menu templates
+@api_v1_bp.get("/menu-templates")
+@require_role(["admin", "ops", "viewer"]) 
+def menu_templates_list():
+    return ok(MenuTemplateService.list_all())
+
+@api_v1_bp.get("/menu-templates/<tpl_id>")
+@require_role(["admin", "ops", "viewer"]) 
+def menu_template_get(tpl_id):
+    try:
+        return ok(MenuTemplateService.get(tpl_id))
+    except KeyError:
+        return err("MENU_TEMPLATE_NOT_FOUND", 404)
+
+@api_v1_bp.post("/menu-templates/<tpl_id>/publish")
+@require_role(["admin", "ops"]) 
+def menu_template_publish(tpl_id):
+    body = request.json or {}
+    try:
+        res = MenuTemplateService.publish(tpl_id, body.get("menu_json"), body.get("name"), bool(body.get("notify", True)))
+        return ok(res)
+    except ValueError as e:
+        return err(str(e), 400)
+
+@api_v1_bp.post("/devices/<device_id>/menu/template")
+@require_role(["admin", "ops"]) 
+def bind_menu_template(device_id):
+    body = request.json or {}
+    try:
+        meta = MenuTemplateService.bind(device_id, str(body.get("template_id") or ""), body.get("version"))
+        return ok(meta)
+    except ValueError as e:
+        return err(str(e), 400)
+
+@api_v1_bp.delete("/devices/<device_id>/menu/template")
+@require_role(["admin", "ops"]) 
+def unbind_menu_template(device_id):
+    try:
+        meta = MenuTemplateService.unbind(device_id)
+        return ok(meta)
+    except ValueError as e:
+        return err(str(e), 400)
+
 # Materials
 @api_v1_bp.get("/materials")
 @require_role(["admin", "ops", "viewer"]) 
@@ -491,12 +633,35 @@ def recipe_usage(recipe_id):
 def recipe_publish(recipe_id):
     return ok(RecipeService.publish(recipe_id))
 
+@api_v1_bp.get("/recipes/<recipe_id>/package")
+@require_role(["admin", "ops", "viewer", "device"]) 
+def recipe_package(recipe_id):
+    pkg = RecipeService.package(recipe_id, request.args.get('version'), request.args.get('have'))
+    if not pkg:
+        return err('PACKAGE_NOT_FOUND', 404)
+    return ok(pkg)
+
+@api_v1_bp.get("/recipes/<recipe_id>/packages/<digest>")
+@require_role(["admin", "ops", "viewer", "device"]) 
+def recipe_package_blob(recipe_id, digest):
+    # 内容寻址，摘要即 ETag，可长期缓存；先确认摘要属于该配方再返回 304
+    etag = f'"{digest}"'
+    raw = RecipeService.package_blob(recipe_id, digest)
+    if raw is None:
+        return err('PACKAGE_NOT_FOUND', 404)
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={"ETag": etag})
+    return Response(raw, mimetype="application/json", headers={"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"})
+
 @api_v1_bp.post("/recipes/<recipe_id>/dispatch")
 @require_role(["admin", "ops"]) 
 def recipe_dispatch(recipe_id):
     body = request.json or {}
     device_ids = body.get('device_ids') or []
-    return ok(RecipeService.dispatch(recipe_id, device_ids))
+    try:
+        return ok(RecipeService.dispatch(recipe_id, device_ids, body.get('selector')))
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.post("/recipes/import")
 @require_role(["admin", "ops"]) 
@@ -528,7 +693,10 @@ def dispatch_batch():
     cmd_type = body.get("command_type")
     payload = body.get("payload")
     note = body.get("note")
-    return ok(CommandService.dispatch_batch(device_ids, cmd_type, payload, note))
+    try:
+        return ok(CommandService.dispatch_batch(device_ids, cmd_type, payload, note, body.get("selector")))
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.get("/commands/batches")
 @require_role(["admin", "ops", "viewer"]) 
@@ -568,8 +736,15 @@ def create_batch():
     tag = body.get('tag')
     note = body.get('note')
     dedup_key = body.get('dedup_key')
+    # 可选：{device_id: payload}，仅与 payload 不同的才单独保存
+    overrides = body.get('payload_overrides') or {}
+    # 可选：设备选择器（如 "tag:a AND NOT status:offline"），替代 device_ids
+    selector = body.get('selector')
     creator = request.headers.get('X-User') or request.headers.get('X-Role') or 'admin'
-    return ok(CommandService.create_batch(batch_type, device_ids, payload, options, tag, note, dedup_key, creator))
+    try:
+        return ok(CommandService.create_batch(batch_type, device_ids, payload, options, tag, note, dedup_key, creator, overrides, selector))
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.post("/commands/batches/<batch_id>/retry")
 @require_role(["admin", "ops"]) 
@@ -616,22 +791,72 @@ def batch_item_retry(batch_id, item_id):
 @api_v1_bp.get("/commands/batches/<batch_id>/sse")
 @require_role(["admin", "ops", "viewer"]) 
 def batch_sse(batch_id):
+    # 首帧为完整概要（event: batch），此后只推送变化字段（event: delta），空闲时发送注释保活
+    keepalive = int(current_app.config.get("SSE_KEEPALIVE_S", 15))
     def gen():
-        # naive polling push, 2s interval, ~4 minutes
-        for _ in range(120):
-            try:
-                data = CommandService.get_batch(batch_id)
-                payload = json.dumps(data, ensure_ascii=False)
-                yield f"event: batch\n" + f"data: {payload}\n\n"
-            except Exception as e:
-                yield f"event: error\n" + f"data: {str(e)}\n\n"
-            time.sleep(2)
+        q, snap = ProgressHub.subscribe(batch_id)
+        try:
+            yield "event: batch\n" + f"data: {json.dumps(snap, ensure_ascii=False)}\n\n"
+            while True:
+                try:
+                    delta = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "event: delta\n" + f"data: {json.dumps(delta, ensure_ascii=False)}\n\n"
+        finally:
+            ProgressHub.unsubscribe(batch_id, q)
+    return Response(gen(), mimetype='text/event-stream')
+
+@api_v1_bp.get("/events")
+@require_role(["admin", "ops", "viewer"]) 
+def events_sse():
+    # 全局事件：?topics=device,order,alarm,bin,batch,command（缺省全部），?device_id= 只看单台设备；
+    # 断线重连按 Last-Event-ID 补发
+    topics = EventBus.parse_topics(request.args.get("topics"))
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    device_id = request.args.get("device_id")
+    keepalive = int(current_app.config.get("SSE_KEEPALIVE_S", 15))
+    def frame(eid, event, data):
+        head = f"id: {eid}\n" if eid else ""
+        return head + f"event: {event}\n" + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    def wanted(data):
+        return not device_id or data.get("device_id") == device_id
+    def gen():
+        q: queue.Queue = queue.Queue(maxsize=1000)
+        # 首次连接从订阅前的流末尾补发，订阅生效前写入的事件也不会漏掉
+        start = last_id or EventBus.tail()
+        # 先订阅再补发，补发期间的新事件按 id 去重
+        EventBus.subscribe(q, topics)
+        try:
+            seen = start
+            for eid, event, data in EventBus.replay(start, topics):
+                seen = eid
+                if wanted(data):
+                    yield frame(eid, event, data)
+            while True:
+                try:
+                    eid, event, data = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if eid and not EventBus.newer(eid, seen):
+                    continue
+                if wanted(data):
+                    yield frame(eid, event, data)
+        finally:
+            EventBus.unsubscribe(q)
     return Response(gen(), mimetype='text/event-stream')
 
 # Metrics (very basic placeholders)
 @api_v1_bp.get("/metrics")
 def metrics():
-    return ("api_latency_avg 0\napi_error_rate 0\n", 200, {"Content-Type": "text/plain; version=0.0.4"})
+    dc = DictCache.stats()
+    body = (
+        "api_latency_avg 0\napi_error_rate 0\n"
+        f"dict_cache_hits_total {dc['hits']}\ndict_cache_misses_total {dc['misses']}\ndict_cache_size {dc['size']}\n"
+    )
+    return (body, 200, {"Content-Type": "text/plain; version=0.0.4"})
 
 # Audit
 @api_v1_bp.get("/audit")
@@ -678,8 +903,11 @@ def reorder_categories(device_id):
     arr = request.json or []
     if not isinstance(arr, list):
         return err("INVALID_ARGUMENT", 400)
-    MenuService.reorder_categories(device_id, arr)
-    return ok()
+    try:
+        MenuService.reorder_categories(device_id, arr)
+        return ok()
+    except ValueError as e:
+        return err(str(e), 400)
 
 @api_v1_bp.patch("/devices/<device_id>/menu/categories/<cat_id>/reorder")
 @require_role(["admin", "ops"]) 
@@ -687,5 +915,8 @@ def reorder_items(device_id, cat_id):
     arr = request.json or []
     if not isinstance(arr, list):
         return err("INVALID_ARGUMENT", 400)
-    MenuService.reorder_items(device_id, cat_id, arr)
-    return ok()
+    try:
+        MenuService.reorder_items(device_id, cat_id, arr)
+        return ok()
+    except ValueError as e:
+        return err(str(e), 400)
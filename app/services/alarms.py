@@ -5,6 +5,7 @@ from ..utils.keys import ts
 from ..utils.keys import (
     k_alarm, k_alarms_by_ts, k_alarms_status
 )
+from .events import EventBus
 
 
 class AlarmService:
@@ -34,6 +35,7 @@ class AlarmService:
         r.hset(k_alarm(device_id, alarm_id), mapping=h)
         r.zadd(k_alarms_by_ts(device_id), {alarm_id: ts()})
         r.sadd(k_alarms_status(device_id, h["status"]), alarm_id)
+        EventBus.publish("alarm.created", {"device_id": device_id, "id": alarm_id, "severity": h["severity"], "title": h["title"], "status": h["status"]})
         return h
 
     @staticmethod
@@ -47,4 +49,6 @@ class AlarmService:
             r.srem(k_alarms_status(device_id, old), alarm_id)
             r.sadd(k_alarms_status(device_id, status), alarm_id)
         r.hset(key, mapping={"status": status, "updated_ts": str(ts())})
+        if old != status:
+            EventBus.publish("alarm.updated", {"device_id": device_id, "id": alarm_id, "status": status, "from": old})
         return r.hgetall(key)
@@ -0,0 +1,213 @@
+import uuid
+from typing import Dict, Any, List, Iterable
+from ..utils.extensions import redis_cli
+from ..utils.keys import (
+    k_menu_cats, k_menu_cat_items, k_menu_item, k_menu_available, k_menu_available_tmp,
+    k_dict_recipe_enabled, k_recipe_req, k_material_recipes, k_recipe_menu_refs,
+    k_menu_recipe_items, k_dev_stock, k_menu_meta,
+)
+
+
+# 可售计算：商品 → 配方(启用) → 需求向量 → 设备料仓库存。
+# menu:available 只做增量维护；配方启停或料仓跨越需求阈值时，
+# 通过反向索引定位受影响的商品，仅刷新这些商品。
+class AvailabilityService:
+    @staticmethod
+    def _base_available(h: Dict[str, Any]) -> bool:
+        # 延迟导入，避免与 menu 循环引用
+        from .menu import MenuService
+        return MenuService._item_available(h)
+
+    @staticmethod
+    def _templates():
+        from .menu_templates import MenuTemplateService
+        return MenuTemplateService
+
+    @staticmethod
+    def _load_items(r, device_id: str, item_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        tpl = AvailabilityService._templates()
+        if tpl.binding(r, device_id):
+            resolved = tpl.resolve_items(device_id)
+            return {iid: resolved.get(iid) or {} for iid in item_ids}
+        pipe = r.pipeline(transaction=False)
+        for iid in item_ids:
+            pipe.hgetall(k_menu_item(device_id, iid))
+        return dict(zip(item_ids, pipe.execute()))
+
+    @staticmethod
+    def requirement_vector(norm: Dict[str, Any]) -> Dict[str, float]:
+        req: Dict[str, float] = {}
+        for ing in norm.get("ingredients", []):
+            code = (ing.get("material") or ing.get("material_code") or "").strip()
+            if not code:
+                continue
+            req[code] = req.get(code, 0.0) + float(ing.get("amount") or 0)
+        return req
+
+    @staticmethod
+    def _evaluate(r, device_id: str, items: Dict[str, Dict[str, Any]]) -> Dict[str, bool]:
+        rids = sorted({h.get("recipe_id") for h in items.values() if h and h.get("recipe_id")})
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(k_dev_stock(device_id))
+        for rid in rids:
+            pipe.sismember(k_dict_recipe_enabled(), rid)
+            pipe.hgetall(k_recipe_req(rid))
+        res = pipe.execute()
+        stock = res[0]
+        enabled = {rid: bool(res[1 + 2 * i]) for i, rid in enumerate(rids)}
+        reqs = {rid: res[2 + 2 * i] for i, rid in enumerate(rids)}
+        out = {}
+        for iid, h in items.items():
+            ok = AvailabilityService._base_available(h) and enabled.get(h.get("recipe_id"), False)
+            # 设备尚未上报料仓时不做物料校验
+            if ok and stock:
+                for code, amt in (reqs.get(h.get("recipe_id")) or {}).items():
+                    if float(stock.get(code) or 0) < float(amt):
+                        ok = False
+                        break
+            out[iid] = ok
+        return out
+
+    @staticmethod
+    def refresh_items(device_id: str, item_ids: Iterable[str], hashes: Dict[str, Dict[str, Any]] | None = None):
+        r = redis_cli.r
+        item_ids = list(item_ids)
+        if not item_ids:
+            return
+        items = dict(hashes or {})
+        missing = [iid for iid in item_ids if iid not in items]
+        if missing:
+            items.update(AvailabilityService._load_items(r, device_id, missing))
+        verdict = AvailabilityService._evaluate(r, device_id, {iid: items[iid] for iid in item_ids})
+        key = k_menu_available(device_id)
+        add = [iid for iid, ok in verdict.items() if ok]
+        rem = [iid for iid, ok in verdict.items() if not ok]
+        pipe = r.pipeline(transaction=False)
+        if add:
+            pipe.sadd(key, *add)
+        if rem:
+            pipe.srem(key, *rem)
+        pipe.execute()
+
+    @staticmethod
+    def rebuild(device_id: str):
+        r = redis_cli.r
+        key = k_menu_available(device_id)
+        # 先在临时键上构建，再 RENAME 原子替换，避免读者看到空集合
+        tpl = AvailabilityService._templates()
+        bound = tpl.binding(r, device_id)
+        if bound:
+            items = tpl.resolve_items(device_id)
+        else:
+            cat_ids = r.zrange(k_menu_cats(device_id), 0, -1)
+            pipe = r.pipeline(transaction=False)
+            for cat_id in cat_ids:
+                pipe.zrange(k_menu_cat_items(device_id, cat_id), 0, -1)
+            item_ids = [iid for ids in pipe.execute() for iid in ids]
+            pipe = r.pipeline(transaction=False)
+            for item_id in item_ids:
+                pipe.hgetall(k_menu_item(device_id, item_id))
+            items = {iid: h for iid, h in zip(item_ids, pipe.execute()) if h}
+        verdict = AvailabilityService._evaluate(r, device_id, items)
+        available = [iid for iid, ok in verdict.items() if ok]
+        pipe = r.pipeline(transaction=False)
+        if bound:
+            # 记录计算所依据的模板版本，模板发布后读取时惰性重建
+            pipe.hset(k_menu_meta(device_id), "available_tpl_ver", f"{bound[0]}@{bound[1]}")
+        # 顺带补齐反向索引（兼容索引建立前已存在的菜单）
+        for iid, h in ([] if bound else items.items()):
+            AvailabilityService.index_item(pipe, device_id, iid, h.get("recipe_id"))
+        if available:
+            tmp = k_menu_available_tmp(device_id, uuid.uuid4().hex)
+            pipe.sadd(tmp, *available)
+            pipe.rename(tmp, key)
+        else:
+            pipe.delete(key)
+        pipe.execute()
+
+    # ---- 反向索引维护 ----
+    @staticmethod
+    def index_item(pipe, device_id: str, item_id: str, recipe_id: str | None):
+        if not recipe_id:
+            return
+        pipe.sadd(k_menu_recipe_items(device_id, recipe_id), item_id)
+        pipe.sadd(k_recipe_menu_refs(recipe_id), f"{device_id}:{item_id}")
+
+    @staticmethod
+    def unindex_item(pipe, device_id: str, item_id: str, recipe_id: str | None):
+        if not recipe_id:
+            return
+        pipe.srem(k_menu_recipe_items(device_id, recipe_id), item_id)
+        pipe.srem(k_recipe_menu_refs(recipe_id), f"{device_id}:{item_id}")
+
+    @staticmethod
+    def set_recipe_requirements(recipe_id: str, req: Dict[str, float] | None) -> bool:
+        # 写入配方需求向量并维护 material → recipes 索引；返回向量是否变化
+        r = redis_cli.r
+        old = r.hgetall(k_recipe_req(recipe_id))
+        new = {code: str(float(amt)) for code, amt in (req or {}).items()}
+        if old == new:
+            return False
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(k_recipe_req(recipe_id))
+        if new:
+            pipe.hset(k_recipe_req(recipe_id), mapping=new)
+        for code in set(old) - set(new):
+            pipe.srem(k_material_recipes(code), recipe_id)
+        for code in set(new) - set(old):
+            pipe.sadd(k_material_recipes(code), recipe_id)
+        pipe.execute()
+        return True
+
+    # ---- 变更触发的局部刷新 ----
+    @staticmethod
+    def on_recipe_changed(recipe_id: str):
+        r = redis_cli.r
+        by_device: Dict[str, List[str]] = {}
+        for ref in r.smembers(k_recipe_menu_refs(recipe_id)):
+            device_id, item_id = ref.rsplit(":", 1)
+            by_device.setdefault(device_id, []).append(item_id)
+        for device_id, item_ids in by_device.items():
+            AvailabilityService.refresh_items(device_id, item_ids)
+        # 引用该配方的模板所绑定的设备
+        tpl = AvailabilityService._templates()
+        for device_id in tpl.devices_for_recipe(recipe_id):
+            AvailabilityService.refresh_items(device_id, tpl.items_by_recipe(device_id, [recipe_id]))
+
+    @staticmethod
+    def on_stock_changed(device_id: str, before: Dict[str, str], after: Dict[str, str]):
+        r = redis_cli.r
+        if bool(before) != bool(after):
+            # 首次上报料仓（或全部清空）时物料校验整体开启/关闭
+            AvailabilityService.rebuild(device_id)
+            return
+        changed = [c for c in set(before) | set(after) if before.get(c) != after.get(c)]
+        if not changed:
+            return
+        pipe = r.pipeline(transaction=False)
+        for code in changed:
+            pipe.smembers(k_material_recipes(code))
+        rids = sorted({rid for s in pipe.execute() for rid in s})
+        pipe = r.pipeline(transaction=False)
+        for rid in rids:
+            pipe.hgetall(k_recipe_req(rid))
+        affected = []
+        for rid, req in zip(rids, pipe.execute()):
+            for code in changed:
+                if code not in req:
+                    continue
+                need = float(req[code])
+                if (float(before.get(code) or 0) >= need) != (float(after.get(code) or 0) >= need):
+                    affected.append(rid)
+                    break
+        if not affected:
+            return
+        tpl = AvailabilityService._templates()
+        if tpl.binding(r, device_id):
+            AvailabilityService.refresh_items(device_id, tpl.items_by_recipe(device_id, affected))
+            return
+        pipe = r.pipeline(transaction=False)
+        for rid in affected:
+            pipe.smembers(k_menu_recipe_items(device_id, rid))
+        item_ids = sorted({iid for s in pipe.execute() for iid in s})
+        AvailabilityService.refresh_items(device_id, item_ids)
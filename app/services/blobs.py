@@ -0,0 +1,99 @@
+import base64
+import hashlib
+import json
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, Tuple
+from ..utils.extensions import redis_cli
+from ..utils.keys import k_blob, ts
+from ..utils.lua import script
+
+# 超过该字节数的负载尝试 zlib 压缩（压缩后更小才采用）
+COMPRESS_MIN_BYTES = 1024
+
+
+class BlobService:
+    # 内容寻址，写入后不可变，按摘要做进程内缓存
+    _cache: "OrderedDict[str, str]" = OrderedDict()
+    _lock = threading.Lock()
+    CACHE_SIZE = 256
+
+    @staticmethod
+    def canonical(obj: Any) -> str:
+        # 键排序的紧凑 JSON，相同内容得到相同摘要
+        return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    @staticmethod
+    def digest(raw: str) -> str:
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _encode(raw: str) -> Tuple[str, str]:
+        data = raw.encode("utf-8")
+        if len(data) >= COMPRESS_MIN_BYTES:
+            packed = base64.b64encode(zlib.compress(data, 6)).decode("ascii")
+            if len(packed) < len(data):
+                return "zlib+b64", packed
+        return "raw", raw
+
+    @staticmethod
+    def _decode(enc: str | None, data: str | None) -> str | None:
+        if data is None:
+            return None
+        if enc == "zlib+b64":
+            return zlib.decompress(base64.b64decode(data)).decode("utf-8")
+        return data
+
+    @staticmethod
+    def put(raw: str) -> str:
+        # 写入（已存在则只增加引用计数），返回摘要
+        # 存在判断与写入都在脚本内完成；正文已存在时不做编码
+        r = redis_cli.r
+        d = BlobService.digest(raw)
+        put = script(r, "blob_put")
+        if not put(keys=[k_blob(d)], client=r):
+            enc, data = BlobService._encode(raw)
+            put(keys=[k_blob(d)], args=[enc, data, len(raw.encode("utf-8")), ts()], client=r)
+        return d
+
+    @staticmethod
+    def put_obj(obj: Any) -> str:
+        return BlobService.put(BlobService.canonical(obj))
+
+    @staticmethod
+    def get_many(digests: Iterable[str]) -> Dict[str, str]:
+        out: Dict[str, str] = {}
+        miss = []
+        with BlobService._lock:
+            for d in set(digests):
+                raw = BlobService._cache.get(d)
+                if raw is None:
+                    miss.append(d)
+                else:
+                    BlobService._cache.move_to_end(d)
+                    out[d] = raw
+        if miss:
+            pipe = redis_cli.r.pipeline(transaction=False)
+            for d in miss:
+                pipe.hmget(k_blob(d), "enc", "data")
+            loaded = {d: BlobService._decode(enc, data) for d, (enc, data) in zip(miss, pipe.execute())}
+            with BlobService._lock:
+                for d, raw in loaded.items():
+                    if raw is None:
+                        continue
+                    out[d] = raw
+                    BlobService._cache[d] = raw
+                while len(BlobService._cache) > BlobService.CACHE_SIZE:
+                    BlobService._cache.popitem(last=False)
+        return out
+
+    @staticmethod
+    def get(digest: str) -> str | None:
+        return BlobService.get_many([digest]).get(digest)
+
+    @staticmethod
+    def release(digest: str) -> int:
+        # 引用归零即删除；返回剩余引用数（不存在为 -1）
+        r = redis_cli.r
+        return int(script(r, "blob_release")(keys=[k_blob(digest)], client=r))
@@ -1,149 +1,560 @@
 import uuid
-from typing import Dict, Any, List, Tuple
+from itertools import islice
+from typing import Dict, Any, List, Tuple, Iterable
 from ..utils.extensions import redis_cli, jset, jget
+from ..utils.lua import script
+from .blobs import BlobService
+from .targets import TargetService
+from .events import EventBus
 from ..utils.keys import (
-    k_cmd_hash, k_cmd_pending_q, k_cmd_inflight, ts,
-    k_audit_stream, k_batch, k_batch_cmds
+    k_cmd_hash, k_cmd_pending_q, k_cmd_inflight, k_cmd_processing_q, k_cmd_inflight_deadlines, k_cmd_delayed, ts,
+    k_audit_stream, k_batch, k_batch_cmds, k_batch_staging, k_batch_parked,
+    k_batch_status, k_batch_items, k_cmd_coalesce, k_dedup_batch,
+    k_cmd_by_ts, k_cmd_all_by_ts, k_batches_by_ts, k_batches_idx, k_batches_tmp, k_batch_progress,
 )
-import json, io, csv
+from flask import current_app, has_app_context
+import json, io, csv, random, time
+
+# 批次重试策略字段及默认值（退避秒数、封顶秒数、抖动比例）
+RETRY_DEFAULTS = {"retry_enabled": "0", "backoff_s": "5", "backoff_max_s": "300", "jitter": "0.2"}
+RETRY_FIELDS = tuple(RETRY_DEFAULTS)
+
+# 批次内命令状态（cm:batch:{id}:st:{status} 与 count_{status} 同步维护）
+CMD_STATUSES = ("pending", "sent", "success", "fail", "canceled")
+
+# 设备回执允许的状态
+ACK_STATUSES = ("success", "fail")
+
+# 批量下发时每个流水线写入的命令数
+ENQUEUE_CHUNK = 500
+
+# 批次筛选索引字段（cm:batches:idx:{field}:{value}）
+BATCH_INDEX_FIELDS = ("type", "status", "creator", "tag")
+
+# list_batches 关键字搜索比对的字段
+BATCH_SEARCH_FIELDS = ("id", "type", "note", "tag", "creator", "status")
+
+# 单独下发时可与队列中相同的 pending 命令合并的类型
+COALESCE_TYPES = ("sync", "menu_update")
+
+# 重复提交等待原请求写入批次哈希的最长秒数与轮询间隔
+DEDUP_WAIT_S = 5
+DEDUP_POLL_S = 0.05
 
 
 class CommandService:
     @staticmethod
-    def enqueue(device_id: str, cmd_type: str, payload: Dict[str, Any] | None = None, note: str | None = None, batch_id: str | None = None) -> str:
+    def _default_timeout() -> int:
+        # 调度线程中无应用上下文，回退到默认 60 秒
+        return int(current_app.config.get("CMD_TIMEOUT_S", 60)) if has_app_context() else 60
+
+    @staticmethod
+    def _dedup_ttl() -> int:
+        return int(current_app.config.get("BATCH_DEDUP_TTL_S", 3600)) if has_app_context() else 3600
+
+    @staticmethod
+    def _coalesced(r, device_id: str, cmd_type: str, payload: Dict[str, Any] | None) -> str | None:
+        # 队列中已有同类型、同负载且仍 pending 的单独命令时直接复用；
+        # 判定后即使被设备领取，设备拿到的也是相同内容，不影响语义
+        cmd_id = r.hget(k_cmd_coalesce(device_id), cmd_type)
+        if not cmd_id:
+            return None
+        status, payload_json = r.hmget(k_cmd_hash(device_id, cmd_id), "status", "payload_json")
+        if status == "pending" and payload_json == jset(payload or {}):
+            return cmd_id
+        return None
+
+    @staticmethod
+    def enqueue(device_id: str, cmd_type: str, payload: Dict[str, Any] | None = None, note: str | None = None, batch_id: str | None = None, max_attempts: int | None = None, staged: bool = False) -> str:
         r = redis_cli.r
-        cmd_id = str(uuid.uuid4())
-        h = {
-            "type": cmd_type,
-            "payload_json": jset(payload or {}),
-            "status": "pending",
-            "issued_ts": str(ts()),
-            "sent_ts": "",
-            "result_ts": "",
-            "result_payload_json": "",
-            "attempts": "0",
-            "max_attempts": "3",
-            "last_error": "",
-            "batch_id": batch_id or "",
-        }
-        r.hset(k_cmd_hash(device_id, cmd_id), mapping=h)
-        r.lpush(k_cmd_pending_q(device_id), cmd_id)
+        if not batch_id and cmd_type in COALESCE_TYPES:
+            dup = CommandService._coalesced(r, device_id, cmd_type, payload)
+            if dup:
+                return dup
+        cmd_id = CommandService._enqueue_many(r, [device_id], cmd_type, payload, batch_id, max_attempts, staged)[0]
+        # 单条命令通知设备页；批次命令数量大，只走批次进度
+        if not batch_id:
+            EventBus.publish("command.created", {"device_id": device_id, "command_ids": [cmd_id], "type": cmd_type})
         return cmd_id
 
+    @staticmethod
+    def _enqueue_many(r, device_ids: Iterable[str], cmd_type: str, payload: Dict[str, Any] | None, batch_id: str | None = None, max_attempts: int | None = None, staged: bool = False, overrides: Dict[str, Any] | None = None) -> List[str]:
+        # 分块流水线写入：命令哈希、批次成员与索引、设备队列（或批次 staging），每块一次往返；
+        # device_ids 可为生成器（选择器结果流式读取）
+        # 批次命令只保存共享负载的摘要（payload_ref）；设备覆盖负载与基础负载不同时才内联保存
+        payload_json = jset(payload or {})
+        payload_ref = ""
+        inline: Dict[str, str] = {}
+        if batch_id:
+            base = BlobService.canonical(payload or {})
+            payload_ref = BlobService.put(base)
+            payload_json = ""
+            for d, o in (overrides or {}).items():
+                raw = BlobService.canonical(o or {})
+                if raw != base:
+                    inline[d] = raw
+        out: List[str] = []
+        it = iter(device_ids)
+        while True:
+            part = list(islice(it, ENQUEUE_CHUNK))
+            if not part:
+                break
+            cmd_ids = [str(uuid.uuid4()) for _ in part]
+            now = ts()
+            h = {
+                "type": cmd_type,
+                "payload_json": payload_json,
+                "payload_ref": payload_ref,
+                "status": "pending",
+                "issued_ts": str(now),
+                "sent_ts": "",
+                "result_ts": "",
+                "result_payload_json": "",
+                "attempts": "0",
+                "max_attempts": str(int(max_attempts or 3)),
+                "last_error": "",
+                "batch_id": batch_id or "",
+            }
+            pipe = r.pipeline(transaction=False)
+            # 设备历史与全局保留期索引
+            pipe.zadd(k_cmd_all_by_ts(), {f"{d}:{cmd_id}": now for d, cmd_id in zip(part, cmd_ids)})
+            for d, cmd_id in zip(part, cmd_ids):
+                pipe.zadd(k_cmd_by_ts(d), {cmd_id: now})
+                if d in inline:
+                    pipe.hset(k_cmd_hash(d, cmd_id), mapping={**h, "payload_json": inline[d], "payload_ref": ""})
+                else:
+                    pipe.hset(k_cmd_hash(d, cmd_id), mapping=h)
+            if batch_id:
+                # 记录批次引用的共享负载，命令全部过期清理后释放
+                pipe.hset(k_batch(batch_id), "payload_ref", payload_ref)
+                # 批次成员 + 索引：全部条目 + 按状态分组（score 为 issued_ts），计数同步
+                pipe.hset(k_batch_cmds(batch_id), mapping=dict(zip(cmd_ids, part)))
+                pipe.zadd(k_batch_items(batch_id), {cmd_id: now for cmd_id in cmd_ids})
+                pipe.zadd(k_batch_status(batch_id, "pending"), {cmd_id: now for cmd_id in cmd_ids})
+                pipe.hincrby(k_batch(batch_id), "count_pending", len(cmd_ids))
+            if staged:
+                # 限流批次：先进入批次 staging，由 _release 按并发名额放行
+                pipe.rpush(k_batch_staging(batch_id), *[f"{d}:{cmd_id}" for d, cmd_id in zip(part, cmd_ids)])
+            else:
+                for d, cmd_id in zip(part, cmd_ids):
+                    pipe.lpush(k_cmd_pending_q(d), cmd_id)
+            if not batch_id and cmd_type in COALESCE_TYPES:
+                for d, cmd_id in zip(part, cmd_ids):
+                    pipe.hset(k_cmd_coalesce(d), cmd_type, cmd_id)
+            pipe.execute()
+            out += cmd_ids
+        return out
+
+    @staticmethod
+    def _set_status(pipe, device_id: str, cmd_id: str, status: str, fields: Dict[str, Any] | None = None, allowed_from: Tuple[str, ...] = ()):
+        # 经 set_status 脚本迁移状态（同步批次状态集合与计数）；结果为原状态，见 lua.SET_STATUS
+        args = [k_batch(""), cmd_id, status, ",".join(allowed_from)]
+        for f, v in (fields or {}).items():
+            args += [f, v]
+        script(pipe, "set_status")(keys=[k_cmd_hash(device_id, cmd_id)], args=args, client=pipe)
+
+    @staticmethod
+    def _claim_ids(r, device_id: str, limit: int) -> List[str]:
+        # 服务端脚本原子领取：出队、取消/暂停判断、标记 sent、登记 inflight 一次完成
+        keys = [k_cmd_pending_q(device_id), k_cmd_processing_q(device_id), k_cmd_inflight(device_id), k_cmd_inflight_deadlines()]
+        args = [limit, ts(), k_cmd_hash(device_id, ""), k_batch(""), device_id, CommandService._default_timeout()]
+        ids = script(r, "claim")(keys=keys, args=args, client=r)
+        if ids:
+            EventBus.publish("command.sent", {"device_id": device_id, "command_ids": ids})
+        return ids
+
+    @staticmethod
+    def _resolve_payloads(hashes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # 引用共享负载的命令回填 payload_json；每个摘要每次调用只读取一次
+        blobs = BlobService.get_many({h["payload_ref"] for h in hashes if h.get("payload_ref") and not h.get("payload_json")})
+        for h in hashes:
+            ref = h.get("payload_ref")
+            if ref and not h.get("payload_json"):
+                h["payload_json"] = blobs.get(ref, "")
+        return hashes
+
+    @staticmethod
+    def _load_claimed(r, device_id: str, ids: List[str]) -> List[Dict[str, Any]]:
+        pipe = r.pipeline(transaction=False)
+        for cmd_id in ids:
+            pipe.hgetall(k_cmd_hash(device_id, cmd_id))
+        return CommandService._resolve_payloads([{**h, "id": cmd_id} for cmd_id, h in zip(ids, pipe.execute())])
+
     @staticmethod
     def claim(device_id: str, limit: int = 1) -> List[Dict[str, Any]]:
         r = redis_cli.r
-        result = []
-        tries = 0
-        for _ in range(max(1, min(limit, 20))):
-            cmd_id = r.rpop(k_cmd_pending_q(device_id))
-            if not cmd_id:
-                break
-            key = k_cmd_hash(device_id, cmd_id)
-            ch = r.hgetall(key)
-            # skip canceled
-            if ch and (ch.get("status") == "canceled"):
-                continue
-            # paused batch? push back and skip
-            bid = ch.get("batch_id") if ch else ""
-            if bid:
-                b = r.hgetall(k_batch(bid)) or {}
-                if (b.get("paused") == "1"):
-                    r.lpush(k_cmd_pending_q(device_id), cmd_id)
-                    tries += 1
-                    if tries > 5:
-                        break
-                    continue
-            r.hset(key, mapping={"status": "sent", "sent_ts": str(ts())})
-            r.zadd(k_cmd_inflight(device_id), {cmd_id: ts()})
-            h = ch or r.hgetall(key)
-            h["id"] = cmd_id
-            result.append(h)
-        return result
+        ids = CommandService._claim_ids(r, device_id, max(1, min(limit, 20)))
+        return CommandService._load_claimed(r, device_id, ids)
 
     @staticmethod
-    def ack(device_id: str, cmd_id: str, status: str, result_payload: Dict[str, Any] | None = None, error: str | None = None):
+    def claim_wait(device_id: str, limit: int = 1, wait: int = 0) -> List[Dict[str, Any]]:
+        # 长轮询领取：队列为空时 BLMOVE 阻塞等待，空闲设备几乎不产生 Redis 请求
         r = redis_cli.r
-        key = k_cmd_hash(device_id, cmd_id)
-        if not r.exists(key):
-            return False
-        mapping = {
-            "status": status,
-            "result_ts": str(ts()),
-            "result_payload_json": jset(result_payload or {}),
-            "last_error": error or "",
-        }
-        r.hset(key, mapping=mapping)
-        # update batch counters best-effort
-        try:
-            bid = r.hget(key, "batch_id")
-            if bid:
-                r.hincrby(k_batch(bid), f"count_{status}", 1)
-        except Exception:
-            pass
-        r.zrem(k_cmd_inflight(device_id), cmd_id)
-        r.xadd(k_audit_stream(), {"action": "cmd_ack", "actor": device_id, "target_id": cmd_id, "summary": status, "ts": ts()})
-        return True
+        limit = max(1, min(int(limit or 1), 20))
+        ids = CommandService._claim_ids(r, device_id, limit)
+        if not ids and wait > 0:
+            # 阻塞搬入 processing，即使随后进程崩溃，下次领取也会先消费它
+            if not r.blmove(k_cmd_pending_q(device_id), k_cmd_processing_q(device_id), wait, "RIGHT", "LEFT"):
+                return []
+            ids = CommandService._claim_ids(r, device_id, limit)
+        return CommandService._load_claimed(r, device_id, ids)
+
+    @staticmethod
+    def _batch_policies(r, batch_ids) -> Dict[str, Dict[str, Any]]:
+        # 批次重试策略与是否限流（普通字段，create_batch 写入）；无批次的命令使用默认退避
+        bids = sorted({b for b in batch_ids if b})
+        pipe = r.pipeline(transaction=False)
+        for bid in bids:
+            pipe.hmget(k_batch(bid), "staged", *RETRY_FIELDS)
+        out = {}
+        for bid, (staged, *vals) in zip(bids, pipe.execute()):
+            out[bid] = {f: (v if v not in (None, "") else RETRY_DEFAULTS[f]) for f, v in zip(RETRY_FIELDS, vals)}
+            out[bid]["staged"] = staged == "1"
+        return out
 
     @staticmethod
-    def list_by_device(device_id: str, limit: int = 50):
+    def _pending_affix() -> List[str]:
+        # 由键函数推出设备 pending 队列键的前后缀，供脚本内拼接，保持与 keys.py 一致
+        return k_cmd_pending_q("\0").split("\0")
+
+    @staticmethod
+    def _release(r, batch_ids) -> int:
+        # 限流批次放行：空出的并发名额由 staging 中的命令补上
+        bids = sorted({b for b in batch_ids if b})
+        if not bids:
+            return 0
+        release = script(r, "release_batch")
+        pipe = r.pipeline(transaction=False)
+        for bid in bids:
+            release(keys=[k_batch(bid), k_batch_staging(bid)], args=CommandService._pending_affix(), client=pipe)
+        return sum(pipe.execute())
+
+    @staticmethod
+    def _free_slots(pipe, batch_ids: List[str]):
+        for bid in batch_ids:
+            pipe.hincrby(k_batch(bid), "active", -1)
+
+    @staticmethod
+    def _backoff(attempts: int, policy: Dict[str, Any] | None) -> int:
+        # 指数退避 + 抖动：base * 2^(attempts-1)，封顶 backoff_max_s，再乘以 (1 ± jitter)
+        p = policy or RETRY_DEFAULTS
+        delay = min(float(p["backoff_max_s"]), float(p["backoff_s"]) * (2 ** max(0, attempts - 1)))
+        j = float(p["jitter"])
+        return max(1, int(round(delay * (1 + random.uniform(-j, j)))))
+
+    @staticmethod
+    def ack(device_id: str, cmd_id: str, status: str, result_payload: Dict[str, Any] | None = None, error: str | None = None):
+        res = CommandService.ack_many(device_id, [{"id": cmd_id, "status": status, "result": result_payload, "error": error}])
+        return bool(res["acked"])
+
+    @staticmethod
+    def ack_many(device_id: str, results: List[Dict[str, Any]]) -> Dict[str, Any]:
+        # 批量回执：一次读取 + 一次流水线写入；批次开启重试时，失败回执按退避进入延迟队列
+        if not isinstance(results, list) or not results:
+            raise ValueError("INVALID_ARGUMENT:results")
+        for obj in results:
+            if not isinstance(obj, dict) or not obj.get("id") or not obj.get("status"):
+                raise ValueError("INVALID_ARGUMENT:results")
         r = redis_cli.r
-        arr = []
-        # naive scan on device scope
-        prefix = f"cm:dev:{device_id}:cmd:"
-        for key in r.scan_iter(match=prefix+"*"):
-            if key.endswith(":inflight"):
+        pipe = r.pipeline(transaction=False)
+        for obj in results:
+            pipe.hmget(k_cmd_hash(device_id, str(obj["id"])), "status", "batch_id", "attempts", "max_attempts", "type")
+        states = pipe.execute()
+        policies = CommandService._batch_policies(r, [st[1] for st in states])
+        now = ts()
+        acked, retried, missing, rejected = [], [], [], []
+        installed: List[str] = []
+        freed: List[str] = []
+        # 只接受 sent 状态的回执：迟到 / 重复回执不得改写已取消或已终结的命令
+        plan = []
+        pipe = r.pipeline(transaction=False)
+        for obj, (cur, bid, attempts, max_attempts, cmd_type) in zip(results, states):
+            cmd_id, status = str(obj["id"]), str(obj["status"])
+            if cur is None:
+                missing.append(cmd_id)
+                continue
+            # 回执只能是终态 success / fail；其他值不得改写状态或归还名额
+            if status not in ACK_STATUSES:
+                rejected.append(cmd_id)
                 continue
-            if key.endswith(":pending"):
+            mapping = {
+                "result_ts": str(now),
+                "result_payload_json": jset(obj.get("result") or {}),
+                "last_error": obj.get("error") or "",
+            }
+            n = int(attempts or 0) + 1
+            policy = policies.get(bid)
+            eligible = None
+            if status == "fail" and policy and policy["retry_enabled"] == "1" and n < int(max_attempts or 3):
+                eligible = now + CommandService._backoff(n, policy)
+                mapping.update({"attempts": str(n), "next_attempt_ts": str(eligible)})
+                CommandService._set_status(pipe, device_id, cmd_id, "pending", mapping, allowed_from=("sent",))
+            else:
+                CommandService._set_status(pipe, device_id, cmd_id, status, mapping, allowed_from=("sent",))
+            plan.append((cmd_id, status, bid, policy, eligible, cmd_type))
+        moved = pipe.execute() if plan else []
+        pipe = r.pipeline(transaction=False)
+        for (cmd_id, status, bid, policy, eligible, cmd_type), res in zip(plan, moved):
+            member = f"{device_id}:{cmd_id}"
+            pipe.zrem(k_cmd_inflight(device_id), cmd_id)
+            pipe.zrem(k_cmd_inflight_deadlines(), member)
+            # 脚本返回 '!原状态' 表示不允许迁移，false 表示命令已不存在
+            if not res or str(res).startswith("!"):
+                rejected.append(cmd_id)
                 continue
-            h = r.hgetall(key)
-            if not h:
+            if eligible is not None:
+                pipe.zadd(k_cmd_delayed(), {member: eligible})
+                retried.append(cmd_id)
+                status = "retry"
+            elif bid and policy and policy["staged"]:
+                # 限流批次：命令由 sent 进入终态时归还并发名额
+                freed.append(bid)
+            pipe.xadd(k_audit_stream(), {"action": "cmd_ack", "actor": device_id, "target_id": cmd_id, "summary": status, "ts": now})
+            acked.append(cmd_id)
+            if status == "success" and cmd_type == "recipe_update":
+                installed.append(cmd_id)
+        CommandService._free_slots(pipe, freed)
+        if acked:
+            EventBus.publish("command.acked", {"device_id": device_id, "command_ids": acked, "retried": retried}, pipe)
+        pipe.execute()
+        CommandService._release(r, freed)
+        if installed:
+            CommandService._on_recipes_installed(r, device_id, installed)
+        return {"acked": acked, "retried": retried, "missing": missing, "rejected": rejected}
+
+    @staticmethod
+    def _on_recipes_installed(r, device_id: str, cmd_ids: List[str]):
+        # 配方下发成功即视为设备已启用该配方，维护 recipe → devices 反向索引；延迟导入避免循环引用
+        from .recipes import RecipeService
+        rids = []
+        for h in CommandService._load_claimed(r, device_id, cmd_ids):
+            rid = (jget(h.get("payload_json")) or {}).get("recipe_id")
+            if rid:
+                rids.append(str(rid))
+        RecipeService.add_device_active(device_id, rids)
+
+    @staticmethod
+    def list_by_device(device_id: str, limit: int = 50, offset: int = 0):
+        # 按 issued_ts 倒序分页读取设备命令历史
+        r = redis_cli.r
+        limit = max(1, min(int(limit or 50), 500)); offset = max(0, int(offset or 0))
+        ids = r.zrevrange(k_cmd_by_ts(device_id), offset, offset + limit - 1)
+        pipe = r.pipeline(transaction=False)
+        for cmd_id in ids:
+            pipe.hgetall(k_cmd_hash(device_id, cmd_id))
+        arr = [{**h, "id": cmd_id} for cmd_id, h in zip(ids, pipe.execute()) if h]
+        return CommandService._resolve_payloads(arr)
+
+    @staticmethod
+    def _retention_days() -> int:
+        return int(current_app.config.get("CMD_RETENTION_DAYS", 7)) if has_app_context() else 7
+
+    @staticmethod
+    def expire_history(days: int | None = None, chunk: int = 500) -> int:
+        # 清理 issued_ts 早于保留期的终态命令（结果先计入批次汇总），未终结的命令保留；
+        # 批次命令全部清理后释放其共享负载
+        r = redis_cli.r
+        days = CommandService._retention_days() if days is None else days
+        cutoff = ts() - int(days) * 86400
+        expire = script(r, "expire_cmd")
+        removed = 0
+        offset = 0
+        touched = set()
+        while True:
+            members = r.zrangebyscore(k_cmd_all_by_ts(), "-inf", cutoff, start=offset, num=chunk)
+            if not members:
+                break
+            pipe = r.pipeline(transaction=False)
+            for member in members:
+                device_id, cmd_id = member.rsplit(":", 1)
+                pipe.hget(k_cmd_hash(device_id, cmd_id), "batch_id")
+                expire(keys=[k_cmd_hash(device_id, cmd_id), k_cmd_by_ts(device_id), k_cmd_all_by_ts()], args=[cmd_id, member, k_batch("")], client=pipe)
+            res = pipe.execute()
+            done = 0
+            for bid, n in zip(res[0::2], res[1::2]):
+                if n:
+                    done += 1
+                    if bid:
+                        touched.add(bid)
+            removed += done
+            # 跳过本轮保留下来的未终结命令
+            offset += len(members) - done
+            if len(members) < chunk:
+                break
+        for bid in touched:
+            if r.zcard(k_batch_items(bid)):
                 continue
-            h["id"] = key.split(":")[-1]
-            arr.append(h)
-            if len(arr) >= limit:
+            tx = r.pipeline(transaction=True)
+            tx.hget(k_batch(bid), "payload_ref")
+            tx.hdel(k_batch(bid), "payload_ref")
+            ref = tx.execute()[0]
+            if ref:
+                BlobService.release(ref)
+        return removed
+
+    @staticmethod
+    def recycle_inflight(chunk: int = 500) -> Dict[str, int]:
+        # 只取已过截止时间的条目，代价与过期数量成正比，与设备规模无关；
+        # 重试不立即入队，而是按批次退避策略放入延迟队列
+        r = redis_cli.r
+        requeue = script(r, "requeue_expired")
+        stats = {"requeued": 0, "failed": 0, "skip": 0}
+        now = ts()
+        while True:
+            expired = r.zrangebyscore(k_cmd_inflight_deadlines(), "-inf", now, start=0, num=chunk, withscores=True)
+            if not expired:
                 break
-        return arr
+            refs = [member.rsplit(":", 1) for member, _ in expired]
+            pipe = r.pipeline(transaction=False)
+            for device_id, cmd_id in refs:
+                pipe.hmget(k_cmd_hash(device_id, cmd_id), "attempts", "batch_id")
+            states = pipe.execute()
+            policies = CommandService._batch_policies(r, [bid for _, bid in states])
+            pipe = r.pipeline(transaction=False)
+            for (member, score), (device_id, cmd_id), (attempts, bid) in zip(expired, refs, states):
+                eligible = now + CommandService._backoff(int(attempts or 0) + 1, policies.get(bid))
+                keys = [k_cmd_hash(device_id, cmd_id), k_cmd_delayed(), k_cmd_inflight(device_id), k_cmd_inflight_deadlines()]
+                requeue(keys=keys, args=[cmd_id, member, score, 3, eligible, k_batch("")], client=pipe)
+            freed = []
+            touched: Dict[str, List[str]] = {}
+            for res, (_, bid), (device_id, cmd_id) in zip(pipe.execute(), states, refs):
+                stats[res] = stats.get(res, 0) + 1
+                if res in ("requeued", "failed"):
+                    touched.setdefault(device_id, []).append(cmd_id)
+                if res == "failed" and bid and policies[bid]["staged"]:
+                    freed.append(bid)
+            if freed or touched:
+                pipe = r.pipeline(transaction=False)
+                CommandService._free_slots(pipe, freed)
+                # 超时回收按设备合并为一条事件
+                for device_id, ids in touched.items():
+                    EventBus.publish("command.expired", {"device_id": device_id, "command_ids": ids}, pipe)
+                pipe.execute()
+                CommandService._release(r, freed)
+            if len(expired) < chunk:
+                break
+        return stats
 
     @staticmethod
-    def recycle_inflight(max_age_sec: int = 60):
+    def promote_delayed(chunk: int = 500) -> int:
+        # 到期的延迟命令按设备分组，批量搬回 pending 队列
         r = redis_cli.r
-        # For all devices: naive scan inflight keys
+        promote = script(r, "promote_due")
+        moved = 0
+        while True:
+            due = r.zrangebyscore(k_cmd_delayed(), "-inf", ts(), start=0, num=chunk)
+            if not due:
+                break
+            by_device: Dict[str, List[str]] = {}
+            for member in due:
+                device_id, cmd_id = member.rsplit(":", 1)
+                by_device.setdefault(device_id, []).append(cmd_id)
+            pipe = r.pipeline(transaction=False)
+            for device_id, ids in by_device.items():
+                promote(keys=[k_cmd_delayed(), k_cmd_pending_q(device_id)], args=[device_id, *ids], client=pipe)
+            moved += sum(pipe.execute())
+            if len(due) < chunk:
+                break
+        return moved
+
+    @staticmethod
+    def reindex_inflight():
+        # 回填：为截止时间索引建立前已下发的命令补录条目（一次性，幂等）
+        r = redis_cli.r
+        timeout = CommandService._default_timeout()
         for key in r.scan_iter(match="cm:dev:*:cmd:inflight"):
-            now = ts()
-            stale = []
-            for member, score in r.zrange(key, 0, -1, withscores=True):
-                if now - int(score) >= max_age_sec:
-                    stale.append(member)
-            if not stale:
+            device_id = key[len("cm:dev:"):-len(":cmd:inflight")]
+            entries = r.zrange(key, 0, -1, withscores=True)
+            if entries:
+                r.zadd(k_cmd_inflight_deadlines(), {f"{device_id}:{cmd_id}": int(score) + timeout for cmd_id, score in entries}, nx=True)
+
+    @staticmethod
+    def reindex_history():
+        # 回填：为历史索引建立前已存在的命令补录条目（一次性，幂等）
+        r = redis_cli.r
+        keys = [k for k in r.scan_iter(match="cm:dev:*:cmd:*") if not k.endswith(":cmd:inflight")]
+        for i in range(0, len(keys), ENQUEUE_CHUNK):
+            part = keys[i:i + ENQUEUE_CHUNK]
+            pipe = r.pipeline(transaction=False)
+            for key in part:
+                pipe.type(key)
+            types = pipe.execute()
+            part = [k for k, t in zip(part, types) if t == "hash"]
+            pipe = r.pipeline(transaction=False)
+            for key in part:
+                pipe.hget(key, "issued_ts")
+            issued = pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            for key, its in zip(part, issued):
+                device_id, cmd_id = key[len("cm:dev:"):].rsplit(":cmd:", 1)
+                score = int(its or 0)
+                pipe.zadd(k_cmd_by_ts(device_id), {cmd_id: score}, nx=True)
+                pipe.zadd(k_cmd_all_by_ts(), {f"{device_id}:{cmd_id}": score}, nx=True)
+            pipe.execute()
+
+    @staticmethod
+    def reindex_batches():
+        # 回填：为状态集合建立前创建的批次补建条目/状态索引与计数（一次性，幂等）
+        r = redis_cli.r
+        for key in r.scan_iter(match="cm:batch:*"):
+            if key.count(":") != 2:
                 continue
-            # requeue
-            parts = key.split(":")
-            device_id = parts[2]
-            for cmd_id in stale:
-                ch = r.hgetall(k_cmd_hash(device_id, cmd_id))
-                attempts = int(ch.get("attempts", "0")) + 1
-                max_attempts = int(ch.get("max_attempts", "3"))
-                if attempts < max_attempts:
-                    r.hset(k_cmd_hash(device_id, cmd_id), mapping={"status": "pending", "attempts": str(attempts)})
-                    r.lpush(k_cmd_pending_q(device_id), cmd_id)
-                else:
-                    r.hset(k_cmd_hash(device_id, cmd_id), mapping={"status": "fail", "attempts": str(attempts), "last_error": "timeout"})
-                r.zrem(key, cmd_id)
+            bid = key.split(":")[-1]
+            CommandService._index_batch(r, r.hgetall(key))
+            if r.exists(k_batch_items(bid)):
+                continue
+            cmds = r.hgetall(k_batch_cmds(bid)) or {}
+            if not cmds:
+                continue
+            pipe = r.pipeline(transaction=False)
+            for cmd_id, did in cmds.items():
+                pipe.hmget(k_cmd_hash(did, cmd_id), "status", "issued_ts")
+            counts = {st: 0 for st in CMD_STATUSES}
+            tx = r.pipeline(transaction=True)
+            for cmd_id, (st, its) in zip(cmds, pipe.execute()):
+                if st is None:
+                    continue
+                tx.zadd(k_batch_items(bid), {cmd_id: int(its or 0)})
+                tx.zadd(k_batch_status(bid, st), {cmd_id: int(its or 0)})
+                counts[st] = counts.get(st, 0) + 1
+            tx.hset(key, mapping={f"count_{st}": str(n) for st, n in counts.items()})
+            tx.execute()
+
+    @staticmethod
+    def _index_batch(pipe, meta: Dict[str, Any]):
+        # 创建时登记列表与筛选索引
+        if not meta.get("id"):
+            return
+        pipe.zadd(k_batches_by_ts(), {meta["id"]: int(meta.get("created_ts") or 0)})
+        for f in BATCH_INDEX_FIELDS:
+            if meta.get(f):
+                pipe.sadd(k_batches_idx(f, meta[f]), meta["id"])
+
+    @staticmethod
+    def _set_batch_status(r, batch_id: str, status: str):
+        # 状态变更同步移动 status 索引
+        old = r.hget(k_batch(batch_id), "status")
+        tx = r.pipeline(transaction=True)
+        tx.hset(k_batch(batch_id), "status", status)
+        if old and old != status:
+            tx.srem(k_batches_idx("status", old), batch_id)
+        tx.sadd(k_batches_idx("status", status), batch_id)
+        tx.publish(k_batch_progress(batch_id), "meta")
+        tx.execute()
 
     @staticmethod
-    def dispatch_batch(device_ids: List[str], command_type: str, payload: Dict[str, Any] | None, note: str | None) -> Dict[str, Any]:
+    def dispatch_batch(device_ids: List[str], command_type: str, payload: Dict[str, Any] | None, note: str | None, selector: str | None = None) -> Dict[str, Any]:
         import uuid
         batch_id = str(uuid.uuid4())
         r = redis_cli.r
         now = ts()
-        meta = {"id": batch_id, "type": command_type, "note": note or "", "created_ts": str(now), "status": "queued", "creator": "admin", "tag": "", "paused": "0", "max_concurrency": "0", "count_total": str(len(device_ids))}
-        r.hset(k_batch(batch_id), mapping=meta)
-        created = 0
-        for d in device_ids:
-            cmd_id = CommandService.enqueue(d, command_type, payload, note, batch_id=batch_id)
-            r.hset(k_batch_cmds(batch_id), mapping={cmd_id: d})
-            created += 1
+        targets, total = TargetService.targets(device_ids, selector)
+        meta = {"id": batch_id, "type": command_type, "note": note or "", "created_ts": str(now), "status": "queued", "creator": "admin", "tag": "", "paused": "0", "max_concurrency": "0", "count_total": str(total), "selector": selector or ""}
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(k_batch(batch_id), mapping=meta)
+        CommandService._index_batch(pipe, meta)
+        pipe.execute()
+        created = len(CommandService._enqueue_many(r, targets, command_type, payload, batch_id))
         r.xadd(k_audit_stream(), {"action": "dispatch_create", "actor": "admin", "target_id": batch_id, "ts": now, "summary": command_type})
         return {"batch_id": batch_id, "count": created}
 
@@ -151,102 +562,100 @@ class CommandService:
     def list_batches(from_ts: int | None = None, to_ts: int | None = None, type: str | None = None, status: str | None = None, creator: str | None = None, tag: str | None = None, q: str | None = None, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         r = redis_cli.r
         page = max(1, int(page or 1)); page_size = max(1, min(100, int(page_size or 20)))
-        arr = []
-        for key in r.scan_iter(match="cm:batch:*"):
-            if key.endswith(":cmds"):
-                continue
-            h = r.hgetall(key)
-            if not h:
-                continue
-            try:
-                cts = int(h.get("created_ts") or 0)
-            except Exception:
-                cts = 0
-            if from_ts and cts < int(from_ts):
-                continue
-            if to_ts and cts > int(to_ts):
-                continue
-            if type and (h.get("type") != type):
-                continue
-            if status and (h.get("status") != status):
-                continue
-            if creator and (h.get("creator") != creator):
-                continue
-            if tag and (h.get("tag") != tag):
-                continue
-            if q:
-                blob = json.dumps(h, ensure_ascii=False).lower()
-                if q.lower() not in blob:
-                    continue
-            arr.append(h)
-        # sort by created_ts desc
-        def _score(o):
-            try:
-                return int(o.get("created_ts") or 0)
-            except Exception:
-                return 0
-        arr.sort(key=_score, reverse=True)
-        total = len(arr)
         s=(page-1)*page_size; e=s+page_size
-        return {"items": arr[s:e], "total": total, "page": page, "page_size": page_size}
+        lo = int(from_ts) if from_ts else "-inf"
+        hi = int(to_ts) if to_ts else "+inf"
+        # 筛选条件 → 索引集合求交（权重 0，保留 created_ts 分数），时间范围与分页在有序集合上完成
+        sets = [k_batches_idx(f, v) for f, v in (("type", type), ("status", status), ("creator", creator), ("tag", tag)) if v]
+        src = k_batches_tmp(uuid.uuid4().hex) if sets else k_batches_by_ts()
+        tx = r.pipeline(transaction=True)
+        if sets:
+            tx.zinterstore(src, {k_batches_by_ts(): 1, **{k: 0 for k in sets}})
+        if q:
+            tx.zrevrangebyscore(src, hi, lo)
+        else:
+            tx.zcount(src, lo, hi)
+            tx.zrevrangebyscore(src, hi, lo, start=s, num=page_size)
+        if sets:
+            tx.delete(src)
+        res = tx.execute()[1 if sets else 0:]
+        if q:
+            # 关键字只在候选批次的文本字段上比对
+            needle = q.lower()
+            ids = res[0]
+            matched = []
+            for i in range(0, len(ids), ENQUEUE_CHUNK):
+                part = ids[i:i + ENQUEUE_CHUNK]
+                pipe = r.pipeline(transaction=False)
+                for bid in part:
+                    pipe.hmget(k_batch(bid), *BATCH_SEARCH_FIELDS)
+                matched += [bid for bid, vals in zip(part, pipe.execute()) if needle in " ".join(v or "" for v in vals).lower()]
+            total = len(matched)
+            page_ids = matched[s:e]
+        else:
+            total, page_ids = int(res[0] or 0), res[1]
+        pipe = r.pipeline(transaction=False)
+        for bid in page_ids:
+            pipe.hgetall(k_batch(bid))
+        arr = [h for h in pipe.execute() if h]
+        return {"items": arr, "total": total, "page": page, "page_size": page_size}
 
     @staticmethod
     def get_batch(batch_id: str) -> Dict[str, Any]:
+        # 计数由状态迁移同步维护，O(1) 读取
         r = redis_cli.r
-        info = r.hgetall(k_batch(batch_id))
-        cmds = r.hgetall(k_batch_cmds(batch_id))
-        # derive counters
-        counts = {"success": 0, "fail": 0, "sent": 0, "pending": 0, "canceled": 0}
-        for cmd_id, did in (cmds or {}).items():
-            ch = r.hgetall(k_cmd_hash(did, cmd_id))
-            st = (ch.get("status") or "pending") if ch else "pending"
-            if st in counts:
-                counts[st] += 1
-        info = info or {}
-        info.setdefault("count_total", str(len(cmds or {})))
-        return {"info": info, "counts": counts, "cmds": cmds}
+        info = r.hgetall(k_batch(batch_id)) or {}
+        counts = {st: max(0, int(info.get(f"count_{st}") or 0)) for st in CMD_STATUSES}
+        info.setdefault("count_total", str(sum(counts.values())))
+        return {"info": info, "counts": counts}
 
     @staticmethod
     def list_batch_items(batch_id: str, status: str | None = None, device_id: str | None = None, page: int = 1, page_size: int = 50) -> Dict[str, Any]:
         r = redis_cli.r
         page = max(1, int(page or 1)); page_size = max(1, min(200, int(page_size or 50)))
-        cmds = r.hgetall(k_batch_cmds(batch_id)) or {}
+        # 按状态集合（或全部条目）倒序分页，只加载当前页的命令
+        idx = k_batch_status(batch_id, status) if status else k_batch_items(batch_id)
+        s=(page-1)*page_size; e=s+page_size
+        if device_id:
+            # 按设备过滤需逐条比对归属，仅此情况线性扫描
+            cmds = r.hgetall(k_batch_cmds(batch_id)) or {}
+            ids = [cid for cid in r.zrevrange(idx, 0, -1) if cmds.get(cid) == device_id]
+            total = len(ids)
+            page_ids = ids[s:e]
+        else:
+            total = int(r.zcard(idx) or 0)
+            page_ids = r.zrevrange(idx, s, e - 1)
+        dids = r.hmget(k_batch_cmds(batch_id), page_ids) if page_ids else []
+        pipe = r.pipeline(transaction=False)
+        for cmd_id, did in zip(page_ids, dids):
+            pipe.hgetall(k_cmd_hash(did or "", cmd_id))
         rows = []
-        for cmd_id, did in cmds.items():
-            if device_id and did != device_id:
-                continue
-            ch = r.hgetall(k_cmd_hash(did, cmd_id))
+        for cmd_id, did, ch in zip(page_ids, dids, pipe.execute()):
             if not ch:
                 continue
-            st = ch.get("status")
-            if status and st != status:
-                continue
             rows.append({
                 "item_id": cmd_id,
                 "device_id": did,
                 "type": ch.get("type"),
-                "status": st,
+                "status": ch.get("status"),
                 "attempts": ch.get("attempts"),
                 "issued_ts": ch.get("issued_ts"),
                 "sent_ts": ch.get("sent_ts"),
                 "result_ts": ch.get("result_ts"),
                 "last_error": ch.get("last_error"),
             })
-        # sort desc by issued_ts
-        def _score(o):
-            try:
-                return int(o.get("issued_ts") or 0)
-            except Exception:
-                return 0
-        rows.sort(key=_score, reverse=True)
-        total = len(rows)
-        s=(page-1)*page_size; e=s+page_size
-        return {"items": rows[s:e], "total": total, "page": page, "page_size": page_size}
+        return {"items": rows, "total": total, "page": page, "page_size": page_size}
 
     @staticmethod
     def export_batch(batch_id: str, fmt: str = 'csv') -> Tuple[str, str, str]:
-        data = CommandService.list_batch_items(batch_id, page=1, page_size=10000)
-        rows = data.get('items') or []
+        rows = []
+        page = 1
+        while True:
+            data = CommandService.list_batch_items(batch_id, page=page, page_size=200)
+            rows += data.get('items') or []
+            if page * 200 >= data.get('total', 0):
+                break
+            page += 1
         if fmt == 'json':
             return json.dumps(rows, ensure_ascii=False), 'application/json', f'batch-{batch_id}.json'
         headers = set()
@@ -261,77 +670,140 @@ class CommandService:
         return sio.getvalue(), 'text/csv', f'batch-{batch_id}.csv'
 
     @staticmethod
-    def create_batch(batch_type: str, device_ids: List[str], payload: Dict[str, Any] | None, options: Dict[str, Any] | None, tag: str | None, note: str | None, dedup_key: str | None, creator: str) -> Dict[str, Any]:
+    def _retry_fields(options: Dict[str, Any] | None) -> Dict[str, str]:
+        # options.retry: true / false，或 {"backoff_s":..,"backoff_max_s":..,"jitter":..}
+        retry = (options or {}).get('retry')
+        conf = retry if isinstance(retry, dict) else {}
+        out = {"retry_enabled": "1" if retry else "0"}
+        for f in ("backoff_s", "backoff_max_s", "jitter"):
+            v = conf.get(f)
+            out[f] = str(float(v)) if v is not None else RETRY_DEFAULTS[f]
+        return out
+
+    @staticmethod
+    def create_batch(batch_type: str, device_ids: List[str], payload: Dict[str, Any] | None, options: Dict[str, Any] | None, tag: str | None, note: str | None, dedup_key: str | None, creator: str, overrides: Dict[str, Any] | None = None, selector: str | None = None) -> Dict[str, Any]:
         import uuid
         batch_id = str(uuid.uuid4())
         r = redis_cli.r
-        now = ts()
-        meta = {
-            "id": batch_id,
-            "type": batch_type,
-            "note": note or "",
-            "tag": tag or "",
-            "created_ts": str(now),
-            "status": "queued",
-            "creator": creator or "admin",
-            "paused": "0",
-            "max_concurrency": str((options or {}).get('max_concurrency') or 0),
-            "retry": jset({k:v for k,v in (options or {}).items() if k in ('retry','max_attempts','timeout_s')}),
-            "dedup_key": dedup_key or "",
-            "count_total": str(len(device_ids))
-        }
-        r.hset(k_batch(batch_id), mapping=meta)
-        for d in device_ids:
-            cmd_id = CommandService.enqueue(d, batch_type, payload, note, batch_id=batch_id)
-            r.hset(k_batch_cmds(batch_id), mapping={cmd_id: d})
+        if selector:
+            # 先校验语法，避免登记了去重键却建不出批次
+            TargetService.parse(selector)
+        if dedup_key:
+            # 先原子登记 dedup_key；重复提交等到原批次哈希写入后返回原批次，不做任何写入
+            dkey = k_dedup_batch(dedup_key)
+            deadline = time.monotonic() + DEDUP_WAIT_S
+            while not r.set(dkey, batch_id, nx=True, ex=CommandService._dedup_ttl()):
+                orig = r.get(dkey)
+                if not orig:
+                    continue
+                count = r.hget(k_batch(orig), "count_total")
+                if count is not None:
+                    return {"batch_id": orig, "count": int(count or 0), "deduplicated": True}
+                # 原请求仍在创建（失败时会删除去重键，随后重新抢占）
+                if time.monotonic() > deadline:
+                    raise ValueError("DEDUP_IN_PROGRESS")
+                time.sleep(DEDUP_POLL_S)
+        try:
+            now = ts()
+            targets, total = TargetService.targets(device_ids, selector)
+            meta = {
+                "id": batch_id,
+                "type": batch_type,
+                "note": note or "",
+                "tag": tag or "",
+                "created_ts": str(now),
+                "status": "queued",
+                "creator": creator or "admin",
+                "paused": "0",
+                "max_concurrency": str((options or {}).get('max_concurrency') or 0),
+                # 创建时指定了并发上限的批次走 staging 放行；active 为已放行未终结的命令数
+                "staged": "1" if int((options or {}).get('max_concurrency') or 0) > 0 else "0",
+                "active": "0",
+                "retry": jset({k:v for k,v in (options or {}).items() if k in ('retry','max_attempts','timeout_s')}),
+                # 领取脚本直接读取的超时秒数（0 表示使用默认值）
+                "timeout_s": str(int((options or {}).get('timeout_s') or 0)),
+                **CommandService._retry_fields(options),
+                "dedup_key": dedup_key or "",
+                "selector": selector or "",
+                "count_total": str(total)
+            }
+            pipe = r.pipeline(transaction=True)
+            pipe.hset(k_batch(batch_id), mapping=meta)
+            CommandService._index_batch(pipe, meta)
+            pipe.execute()
+        except Exception:
+            # 批次哈希未写成功时撤销去重登记（仅撤销本请求登记的值），避免后续提交在 TTL 内拿到不存在的批次
+            if dedup_key and not r.exists(k_batch(batch_id)) and r.get(k_dedup_batch(dedup_key)) == batch_id:
+                r.delete(k_dedup_batch(dedup_key))
+            raise
+        max_attempts = (options or {}).get('max_attempts')
+        staged = meta["staged"] == "1"
+        CommandService._enqueue_many(r, targets, batch_type, payload, batch_id, max_attempts, staged, overrides)
+        if staged:
+            CommandService._release(r, [batch_id])
         r.xadd(k_audit_stream(), {"action": "dispatch_create", "actor": creator or 'admin', "target_id": batch_id, "ts": now, "summary": batch_type})
-        return {"batch_id": batch_id, "count": len(device_ids)}
+        return {"batch_id": batch_id, "count": total}
 
     @staticmethod
     def batch_retry_failed(batch_id: str) -> int:
         r = redis_cli.r
-        cmds = r.hgetall(k_batch_cmds(batch_id)) or {}
-        n=0
-        for cmd_id, did in cmds.items():
-            ch = r.hgetall(k_cmd_hash(did, cmd_id))
-            if not ch or ch.get('status') != 'fail':
-                continue
-            r.hset(k_cmd_hash(did, cmd_id), mapping={"status":"pending"})
-            r.lpush(k_cmd_pending_q(did), cmd_id)
-            n+=1
+        # 只遍历失败集合
+        ids = r.zrange(k_batch_status(batch_id, "fail"), 0, -1)
+        dids = r.hmget(k_batch_cmds(batch_id), ids) if ids else []
+        staged = r.hget(k_batch(batch_id), "staged") == "1"
+        pipe = r.pipeline(transaction=False)
+        for cmd_id, did in zip(ids, dids):
+            CommandService._set_status(pipe, did or "", cmd_id, "pending", allowed_from=("fail",))
+        moved = [(did, cmd_id) for cmd_id, did, res in zip(ids, dids, pipe.execute()) if res == "fail"]
+        pipe = r.pipeline(transaction=False)
+        for did, cmd_id in moved:
+            if staged:
+                pipe.rpush(k_batch_staging(batch_id), f"{did}:{cmd_id}")
+            else:
+                pipe.lpush(k_cmd_pending_q(did), cmd_id)
+        pipe.execute()
+        n = len(moved)
+        if staged:
+            CommandService._release(r, [batch_id])
         r.xadd(k_audit_stream(), {"action": "dispatch_retry", "actor": "admin", "target_id": batch_id, "ts": ts(), "summary": str(n)})
         return n
 
     @staticmethod
     def batch_cancel(batch_id: str) -> int:
         r = redis_cli.r
-        r.hset(k_batch(batch_id), mapping={"status":"canceled"})
-        cmds = r.hgetall(k_batch_cmds(batch_id)) or {}
-        n=0
-        for cmd_id, did in cmds.items():
-            ch = r.hgetall(k_cmd_hash(did, cmd_id))
-            if not ch:
-                continue
-            if ch.get('status') in ('success','fail','canceled'):
-                continue
-            r.hset(k_cmd_hash(did, cmd_id), mapping={"status":"canceled"})
-            n+=1
+        CommandService._set_batch_status(r, batch_id, "canceled")
+        # 只遍历未终结（pending / sent）集合
+        ids = r.zrange(k_batch_status(batch_id, "pending"), 0, -1) + r.zrange(k_batch_status(batch_id, "sent"), 0, -1)
+        dids = r.hmget(k_batch_cmds(batch_id), ids) if ids else []
+        pipe = r.pipeline(transaction=False)
+        for cmd_id, did in zip(ids, dids):
+            CommandService._set_status(pipe, did or "", cmd_id, "canceled", allowed_from=("pending", "sent"))
+        n = sum(1 for res in pipe.execute() if res in ("pending", "sent"))
+        r.delete(k_batch_staging(batch_id), k_batch_parked(batch_id))
         r.xadd(k_audit_stream(), {"action": "dispatch_cancel", "actor": "admin", "target_id": batch_id, "ts": ts(), "summary": str(n)})
         return n
 
     @staticmethod
     def batch_pause(batch_id: str):
         redis_cli.r.hset(k_batch(batch_id), mapping={"paused":"1"})
+        redis_cli.r.publish(k_batch_progress(batch_id), "meta")
         redis_cli.r.xadd(k_audit_stream(), {"action": "dispatch_pause", "actor": "admin", "target_id": batch_id, "ts": ts()})
 
     @staticmethod
     def batch_resume(batch_id: str):
-        redis_cli.r.hset(k_batch(batch_id), mapping={"paused":"0"})
-        redis_cli.r.xadd(k_audit_stream(), {"action": "dispatch_resume", "actor": "admin", "target_id": batch_id, "ts": ts()})
+        # 暂停期间在领取时被停放的命令一次性放回设备队列，限流批次随后继续放行
+        r = redis_cli.r
+        n = script(r, "resume_batch")(keys=[k_batch(batch_id), k_batch_parked(batch_id)], args=CommandService._pending_affix(), client=r)
+        CommandService._release(r, [batch_id])
+        r.publish(k_batch_progress(batch_id), "meta")
+        r.xadd(k_audit_stream(), {"action": "dispatch_resume", "actor": "admin", "target_id": batch_id, "ts": ts(), "summary": str(n)})
 
     @staticmethod
     def batch_set_concurrency(batch_id: str, max_concurrency: int):
         redis_cli.r.hset(k_batch(batch_id), mapping={"max_concurrency": str(max_concurrency)})
+        redis_cli.r.publish(k_batch_progress(batch_id), "meta")
+        # 调高（或取消）上限后立即补放
+        CommandService._release(redis_cli.r, [batch_id])
         redis_cli.r.xadd(k_audit_stream(), {"action": "dispatch_update", "actor": "admin", "target_id": batch_id, "ts": ts(), "summary": f"concurrency={max_concurrency}"})
 
     @staticmethod
@@ -340,10 +812,16 @@ class CommandService:
         did = redis_cli.r.hget(k_batch_cmds(batch_id), item_id)
         if not did:
             return False
-        ch = r.hgetall(k_cmd_hash(did, item_id))
-        if not ch:
+        # 只重试已失败 / 已取消的命令：sent 的仍占着并发名额且等待回执，success 不应重复执行
+        pipe = r.pipeline(transaction=False)
+        CommandService._set_status(pipe, did, item_id, "pending", allowed_from=("fail", "canceled"))
+        res = pipe.execute()[0]
+        if not res or str(res).startswith("!"):
             return False
-        r.hset(k_cmd_hash(did, item_id), mapping={"status":"pending"})
-        r.lpush(k_cmd_pending_q(did), item_id)
+        if r.hget(k_batch(batch_id), "staged") == "1":
+            r.rpush(k_batch_staging(batch_id), f"{did}:{item_id}")
+            CommandService._release(r, [batch_id])
+        else:
+            r.lpush(k_cmd_pending_q(did), item_id)
         redis_cli.r.xadd(k_audit_stream(), {"action": "dispatch_retry", "actor": "admin", "target_id": batch_id, "ts": ts(), "summary": item_id})
         return True
@@ -1,10 +1,19 @@
 from ..utils.extensions import redis_cli, jget, jset
 from ..utils.keys import (
-    k_device, ts, k_audit_stream, k_orders_by_ts, k_alarms_status, k_dict_material,
-    k_menu_meta, k_menu_cats, k_menu_available
+    k_device, ts, k_audit_stream, k_orders_by_ts, k_alarms_status,
+    k_menu_meta, k_menu_cats, k_menu_available,
+    k_dev_bin, k_dev_bins, k_dev_bins_low, k_dev_stock, k_devices_last_seen,
+    k_devices_all, k_devices_label, k_devices_groups, k_material_bins,
 )
+from ..utils.lua import script
+from .availability import AvailabilityService
+from .events import EventBus
+from .dict_cache import DictCache
 from datetime import datetime, timedelta
-import json
+from typing import Dict, Any, List, Tuple
+
+# 由系统维护、不可手工设置的标签键
+RESERVED_LABELS = ("status",)
 
 
 class DeviceService:
@@ -12,13 +21,157 @@ class DeviceService:
     def touch_device(device_id: str, ip: str):
         r = redis_cli.r
         k = k_device(device_id)
-        r.hset(k, mapping={
+        now = ts()
+        was = r.hget(k, "status")
+        pipe = r.pipeline(transaction=True)
+        pipe.hset(k, mapping={
             "device_id": device_id,
             "status": "online",
-            "last_seen_ts": ts(),
+            "last_seen_ts": now,
             "ip": ip,
         })
-        r.xadd(k_audit_stream(), {"action": "device_touch", "actor": "device", "target_id": device_id, "ts": ts()})
+        pipe.zadd(k_devices_last_seen(), {device_id: now})
+        pipe.sadd(k_devices_all(), device_id)
+        if was != "online":
+            if was:
+                pipe.srem(k_devices_label("status", was), device_id)
+            pipe.sadd(k_devices_label("status", "online"), device_id)
+        pipe.xadd(k_audit_stream(), {"action": "device_touch", "actor": "device", "target_id": device_id, "ts": now})
+        if was != "online":
+            EventBus.publish("device.online", {"device_id": device_id, "ip": ip}, pipe)
+        pipe.execute()
+
+    @staticmethod
+    def mark_offline(offline_s: int = 180, chunk: int = 500) -> int:
+        # 心跳超时的设备置为 offline 并发布事件；只读取超时条目，与设备总数无关
+        r = redis_cli.r
+        mark = script(r, "mark_offline")
+        cutoff = ts() - int(offline_s)
+        n = 0
+        while True:
+            ids = r.zrangebyscore(k_devices_last_seen(), "-inf", cutoff, start=0, num=chunk)
+            if not ids:
+                break
+            pipe = r.pipeline(transaction=False)
+            for device_id in ids:
+                mark(keys=[k_device(device_id), k_devices_last_seen()], args=[device_id, cutoff, k_devices_label("status", "")], client=pipe)
+            flipped = [d for d, res in zip(ids, pipe.execute()) if res]
+            if flipped:
+                pipe = r.pipeline(transaction=False)
+                for device_id in flipped:
+                    EventBus.publish("device.offline", {"device_id": device_id}, pipe)
+                pipe.execute()
+            n += len(flipped)
+            if len(ids) < chunk:
+                break
+        return n
+
+    # ---- 标签 / 分组（选择器索引，见 TargetService） ----
+    @staticmethod
+    def _label_pairs(labels: Dict[str, List[str]]) -> set:
+        return {(k, v) for k, vs in (labels or {}).items() for v in vs}
+
+    @staticmethod
+    def _write_labels(pipe, device_id: str, old: Dict[str, List[str]], new: Dict[str, List[str]]):
+        before, after = DeviceService._label_pairs(old), DeviceService._label_pairs(new)
+        for k, v in before - after:
+            pipe.srem(k_devices_label(k, v), device_id)
+        for k, v in after - before:
+            pipe.sadd(k_devices_label(k, v), device_id)
+        groups = new.get("group") or []
+        if groups:
+            pipe.sadd(k_devices_groups(), *groups)
+        pipe.hset(k_device(device_id), "labels_json", jset({k: vs for k, vs in new.items() if vs}))
+
+    @staticmethod
+    def _clean(values) -> List[str]:
+        out = []
+        for v in values or []:
+            v = str(v).strip()
+            if not v or any(c.isspace() or c in "()" for c in v):
+                raise ValueError("INVALID_ARGUMENT:label")
+            out.append(v)
+        return sorted(set(out))
+
+    @staticmethod
+    def get_labels(device_id: str) -> Dict[str, List[str]]:
+        return jget(redis_cli.r.hget(k_device(device_id), "labels_json"), {}) or {}
+
+    @staticmethod
+    def set_labels(device_id: str, tags: List[str] | None = None, groups: List[str] | None = None, attrs: Dict[str, Any] | None = None) -> Dict[str, List[str]]:
+        # 整体替换设备标签：tags → tag:*，groups → group:*，attrs {"region":"b"} → region:b
+        r = redis_cli.r
+        if not r.exists(k_device(device_id)):
+            raise ValueError("DEVICE_NOT_FOUND")
+        new = {"tag": DeviceService._clean(tags), "group": DeviceService._clean(groups)}
+        for key, value in (attrs or {}).items():
+            key = str(key).strip()
+            if key in RESERVED_LABELS or key in new or not DeviceService._clean([key]):
+                raise ValueError(f"INVALID_ARGUMENT:label:{key}")
+            new[key] = DeviceService._clean(value if isinstance(value, list) else [value])
+        old = DeviceService.get_labels(device_id)
+        pipe = r.pipeline(transaction=True)
+        DeviceService._write_labels(pipe, device_id, old, new)
+        pipe.sadd(k_devices_all(), device_id)
+        pipe.execute()
+        return {k: vs for k, vs in new.items() if vs}
+
+    @staticmethod
+    def update_group(group: str, add: List[str] | None = None, remove: List[str] | None = None, selector: str | None = None) -> Dict[str, Any]:
+        # 批量调整分组成员；selector 命中的设备一并加入
+        from .targets import TargetService
+        group = DeviceService._clean([group])[0] if group else ""
+        if not group:
+            raise ValueError("INVALID_ARGUMENT:group")
+        r = redis_cli.r
+        changes: List[Tuple[str, bool]] = [(d, False) for d in remove or []] + [(d, True) for d in add or []]
+        if selector:
+            ids, _ = TargetService.targets(None, selector)
+            changes += [(d, True) for d in ids]
+        for i in range(0, len(changes), 500):
+            part = changes[i:i + 500]
+            pipe = r.pipeline(transaction=False)
+            for d, _ in part:
+                pipe.exists(k_device(d))
+                pipe.hget(k_device(d), "labels_json")
+            res = pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            for (d, join), exists, raw in zip(part, res[0::2], res[1::2]):
+                # 未登记的设备忽略，避免凭空创建设备哈希
+                if not exists:
+                    continue
+                old = jget(raw, {}) or {}
+                groups = set(old.get("group") or [])
+                groups = groups | {group} if join else groups - {group}
+                DeviceService._write_labels(pipe, d, old, {**old, "group": sorted(groups)})
+            pipe.execute()
+        return {"group": group, "count": int(r.scard(k_devices_label("group", group)) or 0)}
+
+    @staticmethod
+    def list_groups() -> List[Dict[str, Any]]:
+        r = redis_cli.r
+        names = sorted(r.smembers(k_devices_groups()))
+        pipe = r.pipeline(transaction=False)
+        for g in names:
+            pipe.scard(k_devices_label("group", g))
+        return [{"group": g, "count": int(n or 0)} for g, n in zip(names, pipe.execute())]
+
+    @staticmethod
+    def reindex_labels():
+        # 回填：为已有设备补建全集与状态/标签索引（一次性，幂等）
+        r = redis_cli.r
+        for key in r.scan_iter(match="cm:dev:*"):
+            if key.count(":") != 2:
+                continue
+            h = r.hmget(key, "device_id", "status", "labels_json")
+            device_id = h[0] or key.split(":")[2]
+            pipe = r.pipeline(transaction=False)
+            pipe.sadd(k_devices_all(), device_id)
+            if h[1]:
+                pipe.sadd(k_devices_label("status", h[1]), device_id)
+            for k, v in DeviceService._label_pairs(jget(h[2], {}) or {}):
+                pipe.sadd(k_devices_label(k, v), device_id)
+            pipe.execute()
 
     @staticmethod
     def get_summary(device_id: str):
@@ -29,6 +182,8 @@ class DeviceService:
             # init minimal
             h = {"device_id": device_id, "status": "registered"}
             r.hset(k, mapping=h)
+            r.sadd(k_devices_all(), device_id)
+            r.sadd(k_devices_label("status", "registered"), device_id)
         # sales today
         from datetime import datetime
         now = datetime.utcnow()
@@ -40,7 +195,11 @@ class DeviceService:
         # menu meta and counts
         meta = r.hgetall(k_menu_meta(device_id)) or {}
         try:
-            cat_cnt = int(r.zcard(k_menu_cats(device_id)) or 0)
+            if meta.get("template_id"):
+                from .menu_templates import MenuTemplateService
+                cat_cnt = len((MenuTemplateService.resolve(device_id) or {}).get("categories", []))
+            else:
+                cat_cnt = int(r.zcard(k_menu_cats(device_id)) or 0)
         except Exception:
             cat_cnt = 0
         try:
@@ -254,15 +413,15 @@ class DeviceService:
             if not low_bins:
                 continue
             bins = []
+            pipe = r.pipeline(transaction=False)
             for bi in low_bins[:max_bins]:
-                bh = r.hgetall(f"cm:dev:{device_id}:bin:{bi}")
+                pipe.hgetall(f"cm:dev:{device_id}:bin:{bi}")
+            rows = pipe.execute()
+            # 物料名称取自进程内字典缓存
+            materials = DictCache.materials(bh.get("material_code") for bh in rows)
+            for bi, bh in zip(low_bins[:max_bins], rows):
                 code = bh.get("material_code", "")
-                md = r.hgetall(k_dict_material(code)) if code else {}
-                name = md.get("name_i18n_json")
-                try:
-                    name_zh = (json.loads(name).get("zh") if name else None)
-                except Exception:
-                    name_zh = None
+                name_zh = (materials.get(code) or {}).get("name_i18n", {}).get("zh")
                 try:
                     remaining = float(bh.get("remaining") or 0)
                     capacity = float(bh.get("capacity") or 0)
@@ -293,23 +452,25 @@ class DeviceService:
     def list_bins(device_id: str):
         r = redis_cli.r
         bins = []
-        # discover bin keys by scan
-        prefix = f"cm:dev:{device_id}:bin:"
-        for key in r.scan_iter(match=prefix+"*"):
+        # 与库存汇总使用同一份料仓集合
+        indexes = DeviceService._bin_indexes(r, device_id)
+        pipe = r.pipeline(transaction=False)
+        for idx in indexes:
+            pipe.hgetall(k_dev_bin(device_id, idx))
+        rows = pipe.execute() if indexes else []
+        low = r.smembers(f"cm:dev:{device_id}:bins:low")
+        # 物料名称取自进程内字典缓存
+        materials = DictCache.materials(bh.get("material_code") for bh in rows)
+        for idx, bh in zip(indexes, rows):
+            if not bh:
+                continue
             try:
-                idx = key.split(":")[-1]
-                bh = r.hgetall(key)
                 code = bh.get("material_code", "")
-                md = r.hgetall(k_dict_material(code)) if code else {}
-                name = md.get("name_i18n_json")
-                try:
-                    name_zh = (json.loads(name).get("zh") if name else None)
-                except Exception:
-                    name_zh = None
+                name_zh = (materials.get(code) or {}).get("name_i18n", {}).get("zh")
                 remaining = float(bh.get("remaining") or 0)
                 capacity = float(bh.get("capacity") or 0)
                 pct = int(round((remaining / capacity) * 100)) if capacity > 0 else 0
-                low_set = r.sismember(f"cm:dev:{device_id}:bins:low", idx)
+                low_set = idx in low
                 bins.append({
                     "bin_index": idx,
                     "material_code": code,
@@ -329,3 +490,106 @@ class DeviceService:
             except: return 0
         bins.sort(key=_key)
         return bins
+
+    @staticmethod
+    def update_bin(device_id: str, bin_index: str, data: Dict[str, Any]):
+        r = redis_cli.r
+        key = k_dev_bin(device_id, bin_index)
+        mapping = {"updated_ts": str(ts())}
+        for f in ("material_code", "unit"):
+            if f in data:
+                mapping[f] = str(data.get(f) or "").strip()
+        for f in ("remaining", "capacity", "threshold_low_pct"):
+            if f in data and data[f] not in (None, ""):
+                try:
+                    mapping[f] = str(float(data[f]))
+                except Exception:
+                    raise ValueError(f"INVALID_ARGUMENT:{f}")
+        old_code = r.hget(key, "material_code") or ""
+        # 先补齐料仓集合（集合引入前已有的料仓），再登记本料仓，库存重算才不会漏掉其它料仓
+        DeviceService._bin_indexes(r, device_id)
+        r.hset(key, mapping=mapping)
+        r.sadd(k_dev_bins(device_id), bin_index)
+        bh = r.hgetall(key)
+        DeviceService.index_bin(r, device_id, bin_index, old_code, bh.get("material_code") or "")
+        # 低料判定：料仓阈值优先，缺省取物料字典默认阈值
+        thr = bh.get("threshold_low_pct") or DictCache.material(bh.get("material_code") or "").get("default_threshold_low_pct") or ""
+        try:
+            capacity = float(bh.get("capacity") or 0)
+            pct = (float(bh.get("remaining") or 0) / capacity) * 100 if capacity > 0 else 0
+            is_low = bool(thr) and pct < float(thr)
+        except Exception:
+            is_low = False
+        # 低料状态翻转时发布 bin.low / bin.ok
+        changed = r.sadd(k_dev_bins_low(device_id), bin_index) if is_low else r.srem(k_dev_bins_low(device_id), bin_index)
+        if changed:
+            EventBus.publish("bin.low" if is_low else "bin.ok", {"device_id": device_id, "bin_index": bin_index, "material_code": bh.get("material_code") or ""})
+        # 重算设备库存（按物料汇总），跨越配方需求量时局部刷新可售
+        before = r.hgetall(k_dev_stock(device_id))
+        after = DeviceService._recompute_stock(r, device_id)
+        AvailabilityService.on_stock_changed(device_id, before, after)
+        return {**bh, "bin_index": bin_index, "is_low": is_low}
+
+    @staticmethod
+    def index_bin(pipe, device_id: str, bin_index: str, old_code: str, new_code: str):
+        # 维护 material → bins 反向索引
+        if old_code == new_code:
+            return
+        member = f"{device_id}:{bin_index}"
+        if old_code:
+            pipe.srem(k_material_bins(old_code), member)
+        if new_code:
+            pipe.sadd(k_material_bins(new_code), member)
+
+    @staticmethod
+    def reindex_bins():
+        # 回填：按料仓键（含料仓集合引入前的旧料仓）补建设备料仓集合与 material → bins 索引（幂等）
+        r = redis_cli.r
+        keys = [key for key in r.scan_iter(match=k_dev_bin("*", "*")) if key.count(":") == 4]
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            pipe = r.pipeline(transaction=False)
+            for key in part:
+                pipe.hget(key, "material_code")
+            codes = pipe.execute()
+            pipe = r.pipeline(transaction=False)
+            for key, code in zip(part, codes):
+                device_id, _, bi = key[len("cm:dev:"):].rpartition(":bin:")
+                pipe.sadd(k_dev_bins(device_id), bi)
+                if code:
+                    pipe.sadd(k_material_bins(code), f"{device_id}:{bi}")
+            pipe.execute()
+
+    @staticmethod
+    def _bin_indexes(r, device_id: str) -> List[str]:
+        # 设备料仓编号集合；集合不存在时（早于集合引入的设备）按料仓键回填一次
+        indexes = list(r.smembers(k_dev_bins(device_id)))
+        if indexes:
+            return indexes
+        prefix = k_dev_bin(device_id, "")
+        indexes = [key[len(prefix):] for key in r.scan_iter(match=prefix + "*")]
+        if indexes:
+            r.sadd(k_dev_bins(device_id), *indexes)
+        return indexes
+
+    @staticmethod
+    def _recompute_stock(r, device_id: str) -> Dict[str, str]:
+        indexes = DeviceService._bin_indexes(r, device_id)
+        pipe = r.pipeline(transaction=False)
+        for bi in indexes:
+            pipe.hmget(k_dev_bin(device_id, bi), "material_code", "remaining")
+        totals: Dict[str, float] = {}
+        for code, remaining in pipe.execute():
+            if not code:
+                continue
+            try:
+                totals[code] = totals.get(code, 0.0) + float(remaining or 0)
+            except Exception:
+                totals.setdefault(code, 0.0)
+        stock = {code: str(v) for code, v in totals.items()}
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(k_dev_stock(device_id))
+        if stock:
+            pipe.hset(k_dev_stock(device_id), mapping=stock)
+        pipe.execute()
+        return stock
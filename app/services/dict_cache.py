@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Iterable, Callable
+from flask import g, has_request_context
+from ..utils.extensions import redis_cli, jget
+from ..utils.keys import k_dict_material, k_dict_recipe, k_dict_gen
+
+
+def _material(h: Dict[str, Any]) -> Dict[str, Any]:
+    return {**h, "name_i18n": jget(h.get("name_i18n_json")) or {}} if h else {}
+
+
+def _recipe(h: Dict[str, Any]) -> Dict[str, Any]:
+    return {**h, "schema": jget(h.get("schema_json")) or {}} if h else {}
+
+
+# 进程内字典缓存：物料 / 配方的原始哈希（不存在的条目缓存为空字典）。
+# 写入方 INCR 全局代数 cm:dict:gen；读取前比对代数（请求内只比对一次），变化即整体清空；
+# 加载后再读一次代数，加载期间代数变化则结果不入缓存。
+# 缓存只存扁平字符串哈希，每次返回时重新解码，嵌套结构（配方步骤等）不与缓存共享，调用方可自由修改
+class DictCache:
+    _cache: "OrderedDict[tuple[str, str], Dict[str, str]]" = OrderedDict()
+    _lock = threading.Lock()
+    _gen: str | None = None
+    CACHE_SIZE = 2048
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def invalidate():
+        # 物料 / 配方写入提交后调用：其它进程在下次比对时失效，本进程立即清空
+        gen = redis_cli.r.incr(k_dict_gen())
+        with DictCache._lock:
+            DictCache._cache.clear()
+            DictCache._gen = str(gen)
+
+    @staticmethod
+    def _check(r):
+        if has_request_context():
+            if g.get("_dict_gen_checked"):
+                return
+            g._dict_gen_checked = True
+        gen = r.get(k_dict_gen()) or "0"
+        with DictCache._lock:
+            if gen != DictCache._gen:
+                DictCache._cache.clear()
+                DictCache._gen = gen
+
+    @staticmethod
+    def _get_many(kind: str, ids: Iterable[str], key_of: Callable[[str], str], decode: Callable[[Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        r = redis_cli.r
+        DictCache._check(r)
+        out: Dict[str, Dict[str, str]] = {}
+        missing: List[str] = []
+        with DictCache._lock:
+            gen = DictCache._gen
+            for i in dict.fromkeys(x for x in ids if x):
+                v = DictCache._cache.get((kind, i))
+                if v is None:
+                    missing.append(i)
+                    continue
+                DictCache._cache.move_to_end((kind, i))
+                out[i] = v
+            DictCache.hits += len(out)
+            DictCache.misses += len(missing)
+        if missing:
+            pipe = r.pipeline(transaction=False)
+            for i in missing:
+                pipe.hgetall(key_of(i))
+            pipe.get(k_dict_gen())
+            *rows, after = pipe.execute()
+            loaded = dict(zip(missing, rows))
+            with DictCache._lock:
+                # 加载期间有写入提交（代数变化）或已被其它线程清空换代，结果只用于本次返回
+                if (after or "0") == gen == DictCache._gen:
+                    for i, h in loaded.items():
+                        DictCache._cache[(kind, i)] = h
+                    while len(DictCache._cache) > DictCache.CACHE_SIZE:
+                        DictCache._cache.popitem(last=False)
+            out.update(loaded)
+        return {i: decode(h) for i, h in out.items()}
+
+    @staticmethod
+    def materials(codes: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        return DictCache._get_many("material", codes, k_dict_material, _material)
+
+    @staticmethod
+    def material(code: str) -> Dict[str, Any]:
+        return DictCache.materials([code]).get(code) or {}
+
+    @staticmethod
+    def recipes(ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        return DictCache._get_many("recipe", ids, k_dict_recipe, _recipe)
+
+    @staticmethod
+    def recipe(recipe_id: str) -> Dict[str, Any]:
+        return DictCache.recipes([recipe_id]).get(recipe_id) or {}
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        with DictCache._lock:
+            return {"hits": DictCache.hits, "misses": DictCache.misses, "size": len(DictCache._cache)}
@@ -0,0 +1,85 @@
+import uuid
+from typing import Dict, Any, List, Tuple, Iterable, Callable, Set
+from ..utils.extensions import redis_cli
+from ..utils.keys import k_dict_by_ts, k_dict_field, k_dict_gram, k_dict_tmp
+
+# n-gram 最大长度：不超过该长度的关键字直接命中索引，更长的按各 GRAM 字符子串求交后复核
+GRAM = 3
+# 候选复核时每批读取的条目数
+LOAD_CHUNK = 500
+
+
+# 字典（物料 / 配方）检索索引：updated_ts 有序集合 + 字段筛选集合 + 关键字 n-gram 集合，
+# 由各字典的 upsert / delete 按新旧条目算出的索引键差量维护；列表在索引交集上排序分页，
+# 只读取当前页（或关键字候选）的条目
+class DictIndex:
+    @staticmethod
+    def grams(text: str) -> Set[str]:
+        t = (text or "").lower()
+        return {t[i:i + n] for n in range(1, GRAM + 1) for i in range(len(t) - n + 1)}
+
+    @staticmethod
+    def postings(kind: str, fields: Dict[str, Iterable[str]], texts: Iterable[str]) -> Set[str]:
+        # 条目所属的全部索引集合键
+        keys = {k_dict_field(kind, f, str(v)) for f, vals in fields.items() for v in vals if str(v)}
+        for t in texts:
+            keys |= {k_dict_gram(kind, g) for g in DictIndex.grams(t)}
+        return keys
+
+    @staticmethod
+    def write(pipe, kind: str, item_id: str, old: Set[str], new: Set[str], updated_ts):
+        for key in old - new:
+            pipe.srem(key, item_id)
+        for key in new - old:
+            pipe.sadd(key, item_id)
+        try:
+            score = int(updated_ts or 0)
+        except (TypeError, ValueError):
+            score = 0
+        pipe.zadd(k_dict_by_ts(kind), {item_id: score})
+
+    @staticmethod
+    def drop(pipe, kind: str, item_id: str, old: Set[str]):
+        for key in old:
+            pipe.srem(key, item_id)
+        pipe.zrem(k_dict_by_ts(kind), item_id)
+
+    @staticmethod
+    def search(kind: str, key_of: Callable[[str], str], texts_of: Callable[[Dict[str, Any]], Iterable[str]],
+               filters: List[Tuple[str, str]], query: str | None, page: int, page_size: int) -> Tuple[int, List[Dict[str, Any]]]:
+        # 返回 (总数, 当前页条目)；按 updated_ts 倒序
+        r = redis_cli.r
+        s = (page - 1) * page_size
+        q = (query or "").lower().strip()
+        sets = [k_dict_field(kind, f, v) for f, v in filters]
+        verify = len(q) > GRAM
+        if q:
+            sets += [k_dict_gram(kind, g) for g in ({q} if not verify else {q[i:i + GRAM] for i in range(len(q) - GRAM + 1)})]
+        src = k_dict_tmp(kind, uuid.uuid4().hex) if sets else k_dict_by_ts(kind)
+        tx = r.pipeline(transaction=True)
+        if sets:
+            # 权重 0 的集合只做过滤，保留 updated_ts 分数
+            tx.zinterstore(src, {k_dict_by_ts(kind): 1, **{k: 0 for k in sets}})
+        if verify:
+            tx.zrevrange(src, 0, -1)
+        else:
+            tx.zcard(src)
+            tx.zrevrange(src, s, s + page_size - 1)
+        if sets:
+            tx.delete(src)
+        res = tx.execute()[1 if sets else 0:]
+        if not verify:
+            return int(res[0] or 0), DictIndex._load(r, key_of, res[1])
+        # 长关键字：n-gram 交集只是候选，逐条复核原文是否包含关键字
+        matched: List[Dict[str, Any]] = []
+        ids = res[0]
+        for i in range(0, len(ids), LOAD_CHUNK):
+            matched += [h for h in DictIndex._load(r, key_of, ids[i:i + LOAD_CHUNK]) if any(q in (t or "").lower() for t in texts_of(h))]
+        return len(matched), matched[s:s + page_size]
+
+    @staticmethod
+    def _load(r, key_of: Callable[[str], str], ids: List[str]) -> List[Dict[str, Any]]:
+        pipe = r.pipeline(transaction=False)
+        for item_id in ids:
+            pipe.hgetall(key_of(item_id))
+        return [h for h in (pipe.execute() if ids else []) if h]
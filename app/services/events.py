@@ -0,0 +1,126 @@
+import queue
+import threading
+import time
+from typing import Dict, Any, List, Tuple, Iterable
+from ..utils.extensions import redis_cli, jget, jset
+from ..utils.keys import k_event_stream, ts
+
+# 事件流保留条数（近似裁剪）；断线重连只能从保留范围内续传
+STREAM_MAXLEN = 10000
+# 事件主题：事件名前缀（device.online → device）
+TOPICS = ("device", "order", "alarm", "bin", "batch", "command")
+# 单次续传补发上限
+REPLAY_MAX = 1000
+
+
+def _sid(event_id: str) -> Tuple[int, int]:
+    ms, _, seq = (event_id or "0-0").partition("-")
+    try:
+        return int(ms), int(seq or 0)
+    except ValueError:
+        return 0, 0
+
+
+# 全局事件总线：业务侧 XADD 到 cm:stream:events；每个进程一个读线程阻塞 XREAD，
+# 按主题分发给本进程的 SSE 连接。批次进度不入流，由 ProgressHub 合并后直接推送
+class EventBus:
+    _lock = threading.Lock()
+    _subs: List[Tuple[queue.Queue, frozenset]] = []
+    _thread: threading.Thread | None = None
+    # 进程启动时的流末尾 id；读线程从这里开始读，启动后、首个订阅前写入的事件不会丢失
+    _start: str | None = None
+
+    @staticmethod
+    def topic(event: str) -> str:
+        return event.split(".", 1)[0]
+
+    @staticmethod
+    def parse_topics(raw: str | None) -> frozenset:
+        picked = {t.strip() for t in (raw or "").split(",") if t.strip() in TOPICS}
+        return frozenset(picked or TOPICS)
+
+    @staticmethod
+    def publish(event: str, data: Dict[str, Any], pipe=None):
+        # 可传入流水线/事务，与业务写入一起提交
+        (pipe or redis_cli.r).xadd(k_event_stream(), {"event": event, "data": jset(data), "ts": str(ts())}, maxlen=STREAM_MAXLEN, approximate=True)
+
+    @staticmethod
+    def tail() -> str:
+        # 当前流末尾事件 id（空流为 0-0）
+        last = redis_cli.r.xrevrange(k_event_stream(), count=1)
+        return last[0][0] if last else "0-0"
+
+    @staticmethod
+    def mark_start():
+        # create_app 调用；Redis 不可用时留空，由读线程启动时再取
+        try:
+            EventBus._start = EventBus.tail()
+        except Exception:
+            EventBus._start = None
+
+    @staticmethod
+    def replay(last_id: str, topics: Iterable[str]) -> List[Tuple[str, str, Dict[str, Any]]]:
+        # 续传：Last-Event-ID 之后仍在保留范围内的事件
+        topics = set(topics)
+        out = []
+        for eid, f in redis_cli.r.xrange(k_event_stream(), min=f"({last_id}", max="+", count=REPLAY_MAX):
+            if EventBus.topic(f.get("event") or "") in topics:
+                out.append((eid, f.get("event"), jget(f.get("data"), {})))
+        return out
+
+    @staticmethod
+    def newer(event_id: str, than: str | None) -> bool:
+        return not than or _sid(event_id) > _sid(than)
+
+    @staticmethod
+    def subscribe(q: queue.Queue, topics: frozenset):
+        with EventBus._lock:
+            EventBus._subs.append((q, topics))
+            if not (EventBus._thread and EventBus._thread.is_alive()):
+                EventBus._thread = threading.Thread(target=EventBus._run, name="event-bus", daemon=True)
+                EventBus._thread.start()
+            watch = "batch" in topics and sum(1 for _, t in EventBus._subs if "batch" in t) == 1
+        if watch:
+            from .progress import ProgressHub
+            ProgressHub.watch(EventBus._on_progress)
+
+    @staticmethod
+    def unsubscribe(q: queue.Queue):
+        with EventBus._lock:
+            EventBus._subs = [(sq, t) for sq, t in EventBus._subs if sq is not q]
+            unwatch = not any("batch" in t for _, t in EventBus._subs)
+        if unwatch:
+            from .progress import ProgressHub
+            ProgressHub.unwatch(EventBus._on_progress)
+
+    @staticmethod
+    def _dispatch(event_id: str | None, event: str, data: Dict[str, Any]):
+        topic = EventBus.topic(event)
+        with EventBus._lock:
+            subs = [q for q, t in EventBus._subs if topic in t]
+        for q in subs:
+            try:
+                q.put_nowait((event_id, event, data))
+            except queue.Full:
+                pass
+
+    @staticmethod
+    def _on_progress(batch_id: str, snap: Dict[str, Any]):
+        info = snap.get("info") or {}
+        EventBus._dispatch(None, "batch.progress", {"batch_id": batch_id, "status": info.get("status", ""), "paused": info.get("paused", "0"), "counts": snap.get("counts") or {}})
+
+    @staticmethod
+    def _run():
+        last = EventBus._start
+        while True:
+            try:
+                if last is None:
+                    last = EventBus.tail()
+                res = redis_cli.r.xread({k_event_stream(): last}, count=100, block=1000)
+                for _, entries in res or []:
+                    for eid, f in entries:
+                        last = eid
+                        EventBus._dispatch(eid, f.get("event") or "", jget(f.get("data"), {}))
+            except Exception:
+                # 连接中断后重试，best-effort
+                time.sleep(1)
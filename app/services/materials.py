@@ -1,6 +1,11 @@
 from typing import Dict, Any, List, Tuple
 from ..utils.extensions import redis_cli, jset, jget
-from ..utils.keys import k_dict_material, k_dict_material_all, k_audit_stream
+from ..utils.keys import (
+    k_dict_material, k_dict_material_all, k_audit_stream,
+    k_dict_recipe, k_dict_recipe_all, k_material_refs, k_material_bins, k_dev_bin, k_dev_bins_low, k_dev_stock,
+)
+from .dict_index import DictIndex
+from .dict_cache import DictCache
 import re, json, csv, io
 from datetime import datetime
 
@@ -52,10 +57,25 @@ class MaterialService:
                 return False, "INVALID_ARGUMENT:density"
         return True, ""
 
+    @staticmethod
+    def _texts(h: Dict[str, Any]) -> List[str]:
+        # 关键字检索范围：code、中英文名称、标签
+        names = jget(h.get("name_i18n_json")) or {}
+        return [h.get("code") or "", names.get("zh") or "", names.get("en") or "", h.get("tags_csv") or ""]
+
+    @staticmethod
+    def _postings(h: Dict[str, Any]) -> set:
+        if not h:
+            return set()
+        tags = [t.strip().lower() for t in (h.get("tags_csv") or "").split(",") if t.strip()]
+        fields = {"unit": [h.get("unit") or ""], "active": [h.get("active") or "1"], "tag": tags}
+        return DictIndex.postings("material", fields, MaterialService._texts(h))
+
     @staticmethod
     def upsert(code: str, data: Dict[str, Any]):
         r = redis_cli.r
-        existed = bool(r.exists(k_dict_material(code)))
+        prev = r.hgetall(k_dict_material(code))
+        existed = bool(prev)
         ok, msg = MaterialService._validate({**data, "code": code}, is_update=existed)
         if not ok:
             raise ValueError(msg)
@@ -82,8 +102,13 @@ class MaterialService:
             "updated_ts": str(MaterialService._now()),
         })
         r.sadd(k_dict_material_all(), code)
+        h = r.hgetall(key)
+        pipe = r.pipeline(transaction=True)
+        DictIndex.write(pipe, "material", code, MaterialService._postings(prev), MaterialService._postings(h), h.get("updated_ts"))
+        pipe.execute()
+        DictCache.invalidate()
         MaterialService._audit("material_update" if existed else "material_create", code=code)
-        return r.hgetall(key)
+        return h
 
     @staticmethod
     def list_all():
@@ -99,41 +124,15 @@ class MaterialService:
 
     @staticmethod
     def list(query: str | None = None, unit: str | None = None, tags: str | None = None, status: str | None = None, page: int = 1, page_size: int = 20):
-        r = redis_cli.r
-        items: List[Dict[str, Any]] = []
-        q = (query or "").lower().strip()
-        tags_set = set([t.strip().lower() for t in (tags or "").split(",") if t.strip()])
-        for code in r.smembers(k_dict_material_all()):
-            h = r.hgetall(k_dict_material(code))
-            if not h:
-                continue
-            # filters
-            if unit and (h.get("unit") != unit):
-                continue
-            if status in ("active", "archived"):
-                want = "1" if status == "active" else "0"
-                if (h.get("active") or "1") != want:
-                    continue
-            if q:
-                name_zh = (jget(h.get("name_i18n_json")) or {}).get("zh", "")
-                name_en = (jget(h.get("name_i18n_json")) or {}).get("en", "")
-                if q not in (h.get("code") or "").lower() and q not in name_zh.lower() and q not in name_en.lower() and q not in (h.get("tags_csv") or "").lower():
-                    continue
-            if tags_set:
-                ht = set([t.strip().lower() for t in (h.get("tags_csv") or "").split(",") if t.strip()])
-                if not tags_set.issubset(ht):
-                    continue
-            items.append(h)
-        def _score(o):
-            try: return int(o.get("updated_ts") or 0)
-            except: return 0
-        items.sort(key=_score, reverse=True)
-        total = len(items)
         page = max(1, int(page or 1))
         page_size = max(1, min(int(page_size or 20), 100))
-        start = (page - 1) * page_size
-        end = start + page_size
-        page_items = items[start:end]
+        # 筛选条件 → 索引集合求交，updated_ts 倒序分页，只读取当前页
+        filters = [("tag", t) for t in sorted({t.strip().lower() for t in (tags or "").split(",") if t.strip()})]
+        if unit:
+            filters.append(("unit", unit))
+        if status in ("active", "archived"):
+            filters.append(("active", "1" if status == "active" else "0"))
+        total, page_items = DictIndex.search("material", k_dict_material, MaterialService._texts, filters, query, page, page_size)
         # usage counts for current page
         counts = MaterialService.usage_counts([it.get("code") for it in page_items])
         for it in page_items:
@@ -150,107 +149,115 @@ class MaterialService:
         if not force and (usage["recipes"] or usage["bins"]):
             raise ValueError("REFERENCED")
         r = redis_cli.r
-        r.delete(k_dict_material(code))
-        r.srem(k_dict_material_all(), code)
+        pipe = r.pipeline(transaction=True)
+        DictIndex.drop(pipe, "material", code, MaterialService._postings(r.hgetall(k_dict_material(code))))
+        pipe.delete(k_dict_material(code))
+        pipe.srem(k_dict_material_all(), code)
+        pipe.execute()
+        DictCache.invalidate()
         MaterialService._audit("material_delete", code=code)
         return True
 
     @staticmethod
-    def usage(code: str) -> Dict[str, Any]:
+    def reindex() -> int:
+        # 回填检索索引（索引引入前已存在的物料），幂等
         r = redis_cli.r
-        # recipes scan
-        recipes: List[Dict[str, Any]] = []
-        for key in r.scan_iter(match="cm:dict:recipe:*"):
-            # only process hash keys (skip sets like cm:dict:recipe:all)
-            try:
-                if r.type(key) != 'hash':
-                    continue
-            except Exception:
+        n = 0
+        for code in r.smembers(k_dict_material_all()):
+            h = r.hgetall(k_dict_material(code))
+            if not h:
                 continue
-            h = r.hgetall(key)
-            sj = jget(h.get("schema_json")) or {}
-            # naive deep search for material_code == code
-            found = False
-            def walk(obj):
-                nonlocal found
-                if found:
-                    return
-                if isinstance(obj, dict):
-                    for k, v in obj.items():
-                        if k in ("material", "material_code") and str(v) == code:
-                            found = True; return
-                        walk(v)
-                elif isinstance(obj, list):
-                    for it in obj:
-                        walk(it)
-            walk(sj)
-            if found:
-                recipes.append({"id": h.get("id"), "name": h.get("name")})
-        # bins scan
-        bins: List[Dict[str, Any]] = []
-        for key in r.scan_iter(match="cm:dev:*:bin:*"):
-            try:
-                if r.type(key) != 'hash':
-                    continue
-            except Exception:
+            pipe = r.pipeline(transaction=False)
+            DictIndex.write(pipe, "material", code, set(), MaterialService._postings(h), h.get("updated_ts"))
+            pipe.execute()
+            n += 1
+        return n
+
+    @staticmethod
+    def _walk_refs(obj, code: str | None = None, to_code: str | None = None, found: set | None = None) -> set:
+        # 递归查找 schema 中的 material / material_code 引用；给出 code 与 to_code 时原地替换
+        found = set() if found is None else found
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if k in ("material", "material_code") and isinstance(v, str):
+                    if code is not None and v == code:
+                        obj[k] = v = to_code
+                    if v:
+                        found.add(v)
+                else:
+                    MaterialService._walk_refs(v, code, to_code, found)
+        elif isinstance(obj, list):
+            for it in obj:
+                MaterialService._walk_refs(it, code, to_code, found)
+        return found
+
+    @staticmethod
+    def schema_refs(schema: Dict[str, Any] | None) -> set:
+        return MaterialService._walk_refs(schema or {})
+
+    @staticmethod
+    def index_recipe_refs(pipe, recipe_id: str, old_codes, new_codes):
+        # 维护 material → recipes 引用索引（覆盖配料以外的字段，usage / replace 使用）
+        old_codes, new_codes = set(old_codes or ()), set(new_codes or ())
+        for c in old_codes - new_codes:
+            pipe.srem(k_material_refs(c), recipe_id)
+        for c in new_codes - old_codes:
+            pipe.sadd(k_material_refs(c), recipe_id)
+
+    @staticmethod
+    def reindex_refs() -> int:
+        # 回填 material → recipes 引用索引（索引引入前已存在的配方），幂等
+        r = redis_cli.r
+        n = 0
+        for rid in r.smembers(k_dict_recipe_all()):
+            sj = jget(r.hget(k_dict_recipe(rid), "schema_json"))
+            if sj is None:
                 continue
-            bh = r.hgetall(key)
-            if (bh.get("material_code") or "") == code:
-                parts = key.split(":")
-                did = parts[2]
-                bin_index = parts[-1]
-                remaining = bh.get("remaining")
-                capacity = bh.get("capacity")
-                unit = bh.get("unit")
-                low = bool(r.sismember(f"cm:dev:{did}:bins:low", bin_index))
-                bins.append({"device_id": did, "bin_index": bin_index, "remaining": remaining, "capacity": capacity, "unit": unit, "low": low})
+            pipe = r.pipeline(transaction=False)
+            MaterialService.index_recipe_refs(pipe, rid, (), MaterialService.schema_refs(sj))
+            pipe.execute()
+            n += 1
+        return n
+
+    @staticmethod
+    def usage(code: str) -> Dict[str, Any]:
+        # 经反向索引定位引用方：material → recipes（配方写入时按 schema 全量引用维护）、material → bins（料仓写入维护）
+        r = redis_cli.r
+        rids = sorted(r.smembers(k_material_refs(code)))
+        members = sorted(r.smembers(k_material_bins(code)))
+        pipe = r.pipeline(transaction=False)
+        for rid in rids:
+            pipe.hmget(k_dict_recipe(rid), "id", "name")
+        for m in members:
+            did, bin_index = m.rsplit(":", 1)
+            pipe.hmget(k_dev_bin(did, bin_index), "remaining", "capacity", "unit")
+            pipe.sismember(k_dev_bins_low(did), bin_index)
+        res = pipe.execute()
+        recipes = [{"id": rh[0] or rid, "name": rh[1]} for rid, rh in zip(rids, res[:len(rids)])]
+        bins: List[Dict[str, Any]] = []
+        rest = res[len(rids):]
+        for m, (remaining, capacity, unit), low in zip(members, rest[0::2], rest[1::2]):
+            did, bin_index = m.rsplit(":", 1)
+            bins.append({"device_id": did, "bin_index": bin_index, "remaining": remaining, "capacity": capacity, "unit": unit, "low": bool(low)})
         return {"recipes": recipes, "bins": bins}
 
     @staticmethod
     def usage_counts(codes: List[str]) -> Dict[str, Dict[str, int]]:
         r = redis_cli.r
-        res = {c: {"recipes": 0, "bins": 0} for c in codes}
-        if not codes:
-            return res
-        set_codes = set(codes)
-        # recipes
-        for key in r.scan_iter(match="cm:dict:recipe:*"):
-            try:
-                if r.type(key) != 'hash':
-                    continue
-            except Exception:
-                continue
-            h = r.hgetall(key)
-            sj = jget(h.get("schema_json")) or {}
-            # collect materials in this recipe
-            found = set()
-            def walk(obj):
-                if isinstance(obj, dict):
-                    for k, v in obj.items():
-                        if k in ("material", "material_code") and v in set_codes:
-                            found.add(v)
-                        walk(v)
-                elif isinstance(obj, list):
-                    for it in obj:
-                        walk(it)
-            walk(sj)
-            for c in found:
-                res[c]["recipes"] += 1
-        # bins
-        for key in r.scan_iter(match="cm:dev:*:bin:*"):
-            try:
-                if r.type(key) != 'hash':
-                    continue
-            except Exception:
-                continue
-            bh = r.hgetall(key)
-            c = bh.get("material_code")
-            if c in set_codes:
-                res[c]["bins"] += 1
-        return res
+        codes = [c for c in codes if c]
+        pipe = r.pipeline(transaction=False)
+        for c in codes:
+            pipe.scard(k_material_refs(c))
+            pipe.scard(k_material_bins(c))
+        res = pipe.execute() if codes else []
+        return {c: {"recipes": int(nr or 0), "bins": int(nb or 0)} for c, nr, nb in zip(codes, res[0::2], res[1::2])}
 
     @staticmethod
     def replace(code: str, to_code: str, scope: str = "all") -> Dict[str, int]:
+        # 只改写索引中引用该物料的配方与料仓，并同步引用索引、需求向量 / 设备库存（可售随之局部刷新）；
+        # 配方侧覆盖 schema 中任意位置的 material / material_code 字段，与改写范围一致
+        from .availability import AvailabilityService
+        from .devices import DeviceService
         r = redis_cli.r
         # validate target exists
         if not r.exists(k_dict_material(to_code)):
@@ -258,40 +265,37 @@ class MaterialService:
         changed_recipes = 0
         changed_bins = 0
         if scope in ("all", "recipes"):
-            for key in r.scan_iter(match="cm:dict:recipe:*"):
-                try:
-                    if r.type(key) != 'hash':
-                        continue
-                except Exception:
-                    continue
-                h = r.hgetall(key)
-                sj = jget(h.get("schema_json")) or {}
+            for rid in sorted(r.smembers(k_material_refs(code))):
+                key = k_dict_recipe(rid)
+                sj = jget(r.hget(key, "schema_json")) or {}
                 before = json.dumps(sj, ensure_ascii=False)
-                def walk(obj):
-                    if isinstance(obj, dict):
-                        for k, v in obj.items():
-                            if k in ("material", "material_code") and v == code:
-                                obj[k] = to_code
-                            else:
-                                walk(v)
-                    elif isinstance(obj, list):
-                        for it in obj:
-                            walk(it)
-                walk(sj)
+                old_refs = MaterialService.schema_refs(sj)
+                new_refs = MaterialService._walk_refs(sj, code, to_code)
                 after = json.dumps(sj, ensure_ascii=False)
                 if after != before:
-                    r.hset(key, mapping={"schema_json": jset(sj)})
+                    pipe = r.pipeline(transaction=True)
+                    pipe.hset(key, mapping={"schema_json": jset(sj)})
+                    MaterialService.index_recipe_refs(pipe, rid, old_refs, new_refs)
+                    pipe.execute()
                     changed_recipes += 1
+                if AvailabilityService.set_recipe_requirements(rid, AvailabilityService.requirement_vector(sj)):
+                    AvailabilityService.on_recipe_changed(rid)
+            if changed_recipes:
+                DictCache.invalidate()
         if scope in ("all", "bins"):
-            for key in r.scan_iter(match="cm:dev:*:bin:*"):
-                try:
-                    if r.type(key) != 'hash':
-                        continue
-                except Exception:
-                    continue
-                if r.hget(key, "material_code") == code:
-                    r.hset(key, mapping={"material_code": to_code})
-                    changed_bins += 1
+            devices = set()
+            for m in sorted(r.smembers(k_material_bins(code))):
+                did, bin_index = m.rsplit(":", 1)
+                key = k_dev_bin(did, bin_index)
+                pipe = r.pipeline(transaction=True)
+                pipe.hset(key, mapping={"material_code": to_code})
+                DeviceService.index_bin(pipe, did, bin_index, code, to_code)
+                pipe.execute()
+                devices.add(did)
+                changed_bins += 1
+            for did in devices:
+                before = r.hgetall(k_dev_stock(did))
+                AvailabilityService.on_stock_changed(did, before, DeviceService._recompute_stock(r, did))
         MaterialService._audit("material_replace", code=code, to_code=to_code, scope=scope, changed_recipes=changed_recipes, changed_bins=changed_bins)
         return {"changed_recipes": changed_recipes, "changed_bins": changed_bins}
 
@@ -1,13 +1,16 @@
 import re
+import uuid
 from typing import Dict, Any, List
 from ..utils.extensions import redis_cli, jget, jset
 from ..utils.keys import (
     k_menu_meta, k_menu_cats, k_menu_cat, k_menu_cat_items,
     k_menu_item, k_menu_available, k_menu_seq_cat, k_menu_seq_item,
-    ts, k_audit_stream, k_dict_recipe,
+    k_menu_cats_tmp, ts, k_audit_stream, k_dict_recipe,
 )
 from ..utils.rate_limit import check_rate, RateLimited
+from .availability import AvailabilityService
 from flask import current_app
+from redis.exceptions import WatchError
 
 TIME_RE = re.compile(r"^\d{2}:\d{2}$")
 
@@ -22,6 +25,22 @@ class MenuService:
             r.hset(kmeta, mapping=meta)
         return meta
 
+    @staticmethod
+    def _templates():
+        # 延迟导入，避免与 menu_templates 循环引用
+        from .menu_templates import MenuTemplateService
+        return MenuTemplateService
+
+    @staticmethod
+    def _bound(r, device_id: str) -> bool:
+        return bool(r.hget(k_menu_meta(device_id), "template_id"))
+
+    @staticmethod
+    def _require_private(r, device_id: str):
+        # 绑定模板的设备不允许修改菜单结构，只能改覆盖层（价格/可见性/时段）
+        if MenuService._bound(r, device_id):
+            raise ValueError("MENU_TEMPLATE_BOUND")
+
     @staticmethod
     def _next_cat_id(r, device_id: str) -> str:
         return str(r.incr(k_menu_seq_cat(device_id)))
@@ -34,6 +53,9 @@ class MenuService:
     def get_full_menu(device_id: str) -> Dict[str, Any]:
         r = redis_cli.r
         meta = MenuService._ensure_meta(r, device_id)
+        if meta.get("template_id"):
+            menu = MenuService._templates().resolve(device_id) or {"categories": []}
+            return {"meta": meta, "categories": menu["categories"]}
         cats = []
         for cat_id, score in r.zrange(k_menu_cats(device_id), 0, -1, withscores=True):
             cat_h = r.hgetall(k_menu_cat(device_id, cat_id))
@@ -48,29 +70,30 @@ class MenuService:
         r = redis_cli.r
         # 简化：直接读派生集合，如为空则现算一遍
         key = k_menu_available(device_id)
-        ids = list(r.smembers(key))
+        bound = MenuService._templates().binding(r, device_id)
+        # 模板发布新版本后按版本戳惰性重建
+        stale = bool(bound) and r.hget(k_menu_meta(device_id), "available_tpl_ver") != f"{bound[0]}@{bound[1]}"
+        ids = [] if stale else list(r.smembers(key))
         if ids:
             return ids
         MenuService._recompute_availability(device_id)
         return list(r.smembers(key))
 
     @staticmethod
-    def _recompute_availability(device_id: str):
-        r = redis_cli.r
-        key = k_menu_available(device_id)
-        r.delete(key)
+    def _item_available(h: Dict[str, Any]) -> bool:
         # 条件：visibility=visible 且 schedule 命中（简化）
-        for cat_id in r.zrange(k_menu_cats(device_id), 0, -1):
-            for item_id in r.zrange(k_menu_cat_items(device_id, cat_id), 0, -1):
-                h = r.hgetall(k_menu_item(device_id, item_id))
-                if not h:
-                    continue
-                if h.get("visibility", "visible") != "visible":
-                    continue
-                sch = jget(h.get("schedule_json"), None)
-                if sch and not MenuService._schedule_hit(sch):
-                    continue
-                r.sadd(key, item_id)
+        if not h:
+            return False
+        if h.get("visibility", "visible") != "visible":
+            return False
+        sch = jget(h.get("schedule_json"), None)
+        if sch and not MenuService._schedule_hit(sch):
+            return False
+        return True
+
+    @staticmethod
+    def _recompute_availability(device_id: str):
+        AvailabilityService.rebuild(device_id)
 
     @staticmethod
     def _schedule_hit(sch: Dict[str, Any]) -> bool:
@@ -83,6 +106,35 @@ class MenuService:
                     return False
         return True
 
+    @staticmethod
+    def _cat_hash(cat_id: str, payload: Dict[str, Any], sort_order: int) -> Dict[str, str]:
+        return {
+            "id": cat_id,
+            "name_i18n_json": jset(payload.get("name_i18n")),
+            "icon": payload.get("icon", ""),
+            "sort_order": str(sort_order),
+            "visible": "1",
+            "updated_ts": str(ts()),
+        }
+
+    @staticmethod
+    def _item_hash(item_id: str, cat_id: str, recipe_id: str, payload: Dict[str, Any], so: int) -> Dict[str, str]:
+        return {
+            "id": item_id,
+            "cat_id": cat_id,
+            "recipe_id": recipe_id,
+            "name_i18n_json": jset(payload.get("name_i18n") or {}),
+            "image_url": payload.get("image_url", ""),
+            "price_cents_override": "" if payload.get("price_cents_override") is None else str(payload.get("price_cents_override")),
+            "options_schema_json": jset(payload.get("options_schema") or {}),
+            "badges_csv": ",".join(payload.get("badges", [])) if payload.get("badges") else "",
+            "visibility": payload.get("visibility", "visible"),
+            "schedule_json": jset(payload.get("schedule") or {}),
+            "tags_csv": ",".join(payload.get("tags", [])) if payload.get("tags") else "",
+            "sort_order": str(so),
+            "updated_ts": str(ts()),
+        }
+
     @staticmethod
     def create_category(device_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         r = redis_cli.r
@@ -91,19 +143,13 @@ class MenuService:
             check_rate(r, f"rl:menu:cat:create:{device_id}", limit)
         except RateLimited:
             raise ValueError("RATE_LIMITED")
+        MenuService._require_private(r, device_id)
         name_i18n = payload.get("name_i18n")
         if not isinstance(name_i18n, dict):
             raise ValueError("INVALID_ARGUMENT:name_i18n")
         sort_order = int(payload.get("sort_order") or (r.zcard(k_menu_cats(device_id)) + 1))
         cat_id = MenuService._next_cat_id(r, device_id)
-        ch = {
-            "id": cat_id,
-            "name_i18n_json": jset(name_i18n),
-            "icon": payload.get("icon", ""),
-            "sort_order": str(sort_order),
-            "visible": "1",
-            "updated_ts": str(ts()),
-        }
+        ch = MenuService._cat_hash(cat_id, payload, sort_order)
         r.hset(k_menu_cat(device_id, cat_id), mapping=ch)
         r.zadd(k_menu_cats(device_id), {cat_id: sort_order})
         r.xadd(k_audit_stream(), {"action": "menu_cat_create", "actor": "admin", "target_id": device_id, "summary": cat_id, "ts": ts()})
@@ -112,6 +158,7 @@ class MenuService:
     @staticmethod
     def update_category(device_id: str, cat_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         r = redis_cli.r
+        MenuService._require_private(r, device_id)
         key = k_menu_cat(device_id, cat_id)
         if not r.exists(key):
             raise KeyError(cat_id)
@@ -134,6 +181,7 @@ class MenuService:
     @staticmethod
     def delete_category(device_id: str, cat_id: str, move_to: str | None):
         r = redis_cli.r
+        MenuService._require_private(r, device_id)
         items_key = k_menu_cat_items(device_id, cat_id)
         items = list(r.zrange(items_key, 0, -1))
         if items and not move_to:
@@ -157,6 +205,7 @@ class MenuService:
             check_rate(r, f"rl:menu:item:create:{device_id}", limit)
         except RateLimited:
             raise ValueError("RATE_LIMITED")
+        MenuService._require_private(r, device_id)
         cat_id = str(payload.get("cat_id"))
         recipe_id = str(payload.get("recipe_id"))
         if not cat_id or not r.exists(k_menu_cat(device_id, cat_id)):
@@ -167,29 +216,31 @@ class MenuService:
             raise ValueError("RECIPE_NOT_FOUND")
         item_id = MenuService._next_item_id(r, device_id)
         so = int(payload.get("sort_order") or (r.zcard(k_menu_cat_items(device_id, cat_id)) + 1))
-        h = {
-            "id": item_id,
-            "cat_id": cat_id,
-            "recipe_id": recipe_id,
-            "name_i18n_json": jset(payload.get("name_i18n") or {}),
-            "image_url": payload.get("image_url", ""),
-            "price_cents_override": "" if payload.get("price_cents_override") is None else str(payload.get("price_cents_override")),
-            "options_schema_json": jset(payload.get("options_schema") or {}),
-            "badges_csv": ",".join(payload.get("badges", [])) if payload.get("badges") else "",
-            "visibility": payload.get("visibility", "visible"),
-            "schedule_json": jset(payload.get("schedule") or {}),
-            "tags_csv": ",".join(payload.get("tags", [])) if payload.get("tags") else "",
-            "sort_order": str(so),
-            "updated_ts": str(ts()),
-        }
+        h = MenuService._item_hash(item_id, cat_id, recipe_id, payload, so)
         r.hset(k_menu_item(device_id, item_id), mapping=h)
         r.zadd(k_menu_cat_items(device_id, cat_id), {item_id: so})
+        pipe = r.pipeline(transaction=False)
+        AvailabilityService.index_item(pipe, device_id, item_id, recipe_id)
+        pipe.execute()
+        AvailabilityService.refresh_items(device_id, [item_id], {item_id: h})
         r.xadd(k_audit_stream(), {"action": "menu_item_create", "actor": "admin", "target_id": device_id, "summary": item_id, "ts": ts()})
         return h
 
     @staticmethod
     def update_item(device_id: str, item_id: str, payload: Dict[str, Any]) -> Dict[str, Any]:
         r = redis_cli.r
+        if MenuService._bound(r, device_id):
+            if set(payload) - {"visibility", "schedule", "price_cents_override"}:
+                raise ValueError("MENU_TEMPLATE_BOUND")
+            ovr = {}
+            if "visibility" in payload:
+                ovr["visibility"] = payload.get("visibility") or ""
+            if "schedule" in payload:
+                ovr["schedule_json"] = jset(payload.get("schedule") or {})
+            if "price_cents_override" in payload:
+                v = payload["price_cents_override"]
+                ovr["price_cents_override"] = "" if v is None else str(v)
+            return MenuService._templates().set_overrides(device_id, {item_id: ovr})[item_id]
         key = k_menu_item(device_id, item_id)
         if not r.exists(key):
             raise KeyError(item_id)
@@ -232,29 +283,45 @@ class MenuService:
             mapping["sort_order"] = str(so)
             r.zadd(k_menu_cat_items(device_id, mapping.get("cat_id") or h.get("cat_id")), {item_id: so})
         r.hset(key, mapping=mapping)
-        return r.hgetall(key)
+        if "recipe_id" in mapping:
+            pipe = r.pipeline(transaction=False)
+            AvailabilityService.unindex_item(pipe, device_id, item_id, h.get("recipe_id"))
+            AvailabilityService.index_item(pipe, device_id, item_id, mapping["recipe_id"])
+            pipe.execute()
+        h = r.hgetall(key)
+        if {"visibility", "schedule_json", "recipe_id"} & set(mapping):
+            AvailabilityService.refresh_items(device_id, [item_id], {item_id: h})
+        return h
 
     @staticmethod
     def delete_item(device_id: str, item_id: str):
         r = redis_cli.r
+        MenuService._require_private(r, device_id)
         key = k_menu_item(device_id, item_id)
         h = r.hgetall(key)
         if not h:
             return
-        r.zrem(k_menu_cat_items(device_id, h.get("cat_id")), item_id)
-        r.delete(key)
+        pipe = r.pipeline(transaction=False)
+        pipe.zrem(k_menu_cat_items(device_id, h.get("cat_id")), item_id)
+        pipe.delete(key)
+        pipe.srem(k_menu_available(device_id), item_id)
+        AvailabilityService.unindex_item(pipe, device_id, item_id, h.get("recipe_id"))
+        pipe.execute()
 
     @staticmethod
     def set_visibility(device_id: str, item_id: str, vis: str):
         if vis not in ("visible", "hidden", "archived"):
             raise ValueError("INVALID_ARGUMENT:visibility")
         r = redis_cli.r
+        if MenuService._bound(r, device_id):
+            return MenuService._templates().set_overrides(device_id, {item_id: {"visibility": vis}})[item_id]
         key = k_menu_item(device_id, item_id)
         if not r.exists(key):
             raise ValueError("MENU_ITEM_NOT_FOUND")
         r.hset(key, mapping={"visibility": vis, "updated_ts": str(ts())})
-        MenuService._recompute_availability(device_id)
-        return r.hgetall(key)
+        h = r.hgetall(key)
+        AvailabilityService.refresh_items(device_id, [item_id], {item_id: h})
+        return h
 
     @staticmethod
     def set_schedule(device_id: str, item_id: str, sch: Dict[str, Any]):
@@ -262,23 +329,166 @@ class MenuService:
         if not MenuService._schedule_hit(sch):
             raise ValueError("INVALID_SCHEDULE")
         r = redis_cli.r
+        if MenuService._bound(r, device_id):
+            return MenuService._templates().set_overrides(device_id, {item_id: {"schedule_json": jset(sch)}})[item_id]
         key = k_menu_item(device_id, item_id)
         if not r.exists(key):
             raise ValueError("MENU_ITEM_NOT_FOUND")
         r.hset(key, mapping={"schedule_json": jset(sch), "updated_ts": str(ts())})
-        MenuService._recompute_availability(device_id)
-        return r.hgetall(key)
+        h = r.hgetall(key)
+        AvailabilityService.refresh_items(device_id, [item_id], {item_id: h})
+        return h
 
     @staticmethod
     def set_price(device_id: str, item_id: str, price):
         r = redis_cli.r
+        v = "" if price is None else str(int(price))
+        if MenuService._bound(r, device_id):
+            return MenuService._templates().set_overrides(device_id, {item_id: {"price_cents_override": v}})[item_id]
         key = k_menu_item(device_id, item_id)
         if not r.exists(key):
             raise ValueError("MENU_ITEM_NOT_FOUND")
-        v = "" if price is None else str(int(price))
         r.hset(key, mapping={"price_cents_override": v, "updated_ts": str(ts())})
         return r.hgetall(key)
 
+    BULK_OPS = ("visibility", "move", "price", "schedule")
+
+    @staticmethod
+    def _validate_bulk_ops(ops) -> List[Dict[str, Any]]:
+        if not isinstance(ops, list) or not ops:
+            raise ValueError("INVALID_ARGUMENT:ops")
+        norm = []
+        for op in ops:
+            if not isinstance(op, dict) or op.get("op") not in MenuService.BULK_OPS:
+                raise ValueError("INVALID_ARGUMENT:op")
+            ids = op.get("item_ids")
+            if not isinstance(ids, list) or not ids:
+                raise ValueError("INVALID_ARGUMENT:item_ids")
+            # 同一操作内重复的商品只处理一次，避免 delta/pct 调价被叠加
+            o = {"op": op["op"], "item_ids": list(dict.fromkeys(str(i) for i in ids))}
+            if op["op"] == "visibility":
+                if op.get("visibility") not in ("visible", "hidden", "archived"):
+                    raise ValueError("INVALID_ARGUMENT:visibility")
+                o["visibility"] = op["visibility"]
+            elif op["op"] == "move":
+                if not op.get("cat_id"):
+                    raise ValueError("INVALID_ARGUMENT:cat_id")
+                o["cat_id"] = str(op["cat_id"])
+            elif op["op"] == "price":
+                # set=绝对价格；delta=加减分；pct=按百分比调整
+                if op.get("mode", "set") not in ("set", "delta", "pct"):
+                    raise ValueError("INVALID_ARGUMENT:mode")
+                try:
+                    o["value"] = None if op.get("value") is None else float(op["value"])
+                except Exception:
+                    raise ValueError("INVALID_ARGUMENT:value")
+                o["mode"] = op.get("mode", "set")
+                if o["value"] is None and o["mode"] != "set":
+                    raise ValueError("INVALID_ARGUMENT:value")
+            else:
+                sch = op.get("schedule") or {}
+                if not isinstance(sch, dict) or not MenuService._schedule_hit(sch):
+                    raise ValueError("INVALID_SCHEDULE")
+                o["schedule"] = sch
+            norm.append(o)
+        return norm
+
+    @staticmethod
+    def _adjust_price(op: Dict[str, Any], cur: str | None, default_price: str | None) -> str:
+        if op["mode"] == "set":
+            return "" if op["value"] is None else str(int(op["value"]))
+        base = int(float(cur or default_price or 0))
+        val = base + op["value"] if op["mode"] == "delta" else base * (1 + op["value"] / 100.0)
+        return str(max(0, int(round(val))))
+
+    @staticmethod
+    def _recipe_prices(r, recipe_ids) -> Dict[str, str]:
+        rids = sorted(recipe_ids)
+        pipe = r.pipeline(transaction=False)
+        for rid in rids:
+            pipe.hget(k_dict_recipe(rid), "default_price_cents")
+        return dict(zip(rids, pipe.execute()))
+
+    @staticmethod
+    def bulk_update(device_id: str, ops: List[Dict[str, Any]], expected_version: str | None = None) -> Dict[str, Any]:
+        ops = MenuService._validate_bulk_ops(ops)
+        r = redis_cli.r
+        if MenuService._bound(r, device_id):
+            return MenuService._templates().bulk_override(device_id, ops, expected_version)
+        kmeta = k_menu_meta(device_id)
+        item_ids = list(dict.fromkeys(iid for op in ops for iid in op["item_ids"]))
+        target_cats = list(dict.fromkeys(op["cat_id"] for op in ops if op["op"] == "move"))
+        watched = [kmeta] + [k_menu_item(device_id, iid) for iid in item_ids] + [k_menu_cat_items(device_id, c) for c in target_cats]
+        # WATCH 菜单版本与涉及的键，一次读取、一次 MULTI 写入；并发修改则重试
+        with r.pipeline() as tx:
+            for _ in range(3):
+                try:
+                    tx.watch(*watched)
+                    cur_ver = tx.hget(kmeta, "version") or "1"
+                    if expected_version is not None and str(expected_version) != str(cur_ver):
+                        raise ValueError("CONFLICT")
+                    rd = r.pipeline(transaction=False)
+                    for iid in item_ids:
+                        rd.hgetall(k_menu_item(device_id, iid))
+                    for c in target_cats:
+                        rd.exists(k_menu_cat(device_id, c))
+                        rd.zcard(k_menu_cat_items(device_id, c))
+                    res = rd.execute()
+                    items = dict(zip(item_ids, res[:len(item_ids)]))
+                    cat_res = res[len(item_ids):]
+                    cat_size = {}
+                    for i, c in enumerate(target_cats):
+                        if not cat_res[2 * i]:
+                            raise ValueError("MENU_CATEGORY_NOT_FOUND")
+                        cat_size[c] = int(cat_res[2 * i + 1] or 0)
+                    for iid, h in items.items():
+                        if not h:
+                            raise ValueError(f"MENU_ITEM_NOT_FOUND:{iid}")
+                    # 无价格覆盖的商品按配方默认价作为调价基准
+                    base_price = {}
+                    if any(op["op"] == "price" and op["mode"] != "set" for op in ops):
+                        base_price = MenuService._recipe_prices(r, {h.get("recipe_id") for h in items.values() if h.get("recipe_id")})
+                    now = str(ts())
+                    changes: Dict[str, Dict[str, str]] = {}
+                    moves = []
+                    for op in ops:
+                        for iid in op["item_ids"]:
+                            h = items[iid]
+                            m = changes.setdefault(iid, {})
+                            if op["op"] == "visibility":
+                                m["visibility"] = op["visibility"]
+                            elif op["op"] == "schedule":
+                                m["schedule_json"] = jset(op["schedule"])
+                            elif op["op"] == "move":
+                                old_cat = m.get("cat_id") or h.get("cat_id")
+                                if old_cat == op["cat_id"]:
+                                    continue
+                                cat_size[op["cat_id"]] += 1
+                                m["cat_id"] = op["cat_id"]
+                                m["sort_order"] = str(cat_size[op["cat_id"]])
+                                moves.append((iid, old_cat, op["cat_id"], cat_size[op["cat_id"]]))
+                            else:
+                                m["price_cents_override"] = MenuService._adjust_price(op, m.get("price_cents_override", h.get("price_cents_override")), base_price.get(h.get("recipe_id")))
+                            h.update(m)
+                    tx.multi()
+                    for iid, m in changes.items():
+                        if m:
+                            tx.hset(k_menu_item(device_id, iid), mapping={**m, "updated_ts": now})
+                    for iid, old_cat, new_cat, so in moves:
+                        tx.zrem(k_menu_cat_items(device_id, old_cat), iid)
+                        tx.zadd(k_menu_cat_items(device_id, new_cat), {iid: so})
+                    tx.xadd(k_audit_stream(), {"action": "menu_item_bulk", "actor": "admin", "target_id": device_id, "summary": f"ops={len(ops)} items={len(item_ids)}", "ts": ts()})
+                    tx.execute()
+                    break
+                except WatchError:
+                    continue
+            else:
+                raise ValueError("CONFLICT")
+        # 一次性刷新受影响商品的可售状态
+        touched = [iid for iid, m in changes.items() if {"visibility", "schedule_json"} & set(m)]
+        AvailabilityService.refresh_items(device_id, touched, items)
+        return {"updated": len([m for m in changes.values() if m]), "items": [items[iid] for iid in item_ids]}
+
     @staticmethod
     def publish(device_id: str):
         r = redis_cli.r
@@ -296,50 +506,159 @@ class MenuService:
         return menu
 
     @staticmethod
-    def import_menu(device_id: str, menu_json: Dict[str, Any], strategy: str):
-        if strategy not in ("overwrite", "merge"):
-            raise ValueError("INVALID_ARGUMENT:strategy")
+    def _normalize_import(menu_json: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # 整体校验导入文档，任何一处不合法都不落库
         if not isinstance(menu_json, dict):
             raise ValueError("INVALID_ARGUMENT:menu_json")
-        r = redis_cli.r
-        if strategy == "overwrite":
-            # 清理现有结构
-            for cat_id in r.zrange(k_menu_cats(device_id), 0, -1):
-                for item_id in r.zrange(k_menu_cat_items(device_id, cat_id), 0, -1):
-                    r.delete(k_menu_item(device_id, item_id))
-                r.delete(k_menu_cat_items(device_id, cat_id))
-                r.delete(k_menu_cat(device_id, cat_id))
-            r.delete(k_menu_cats(device_id))
-        # 重建
         cats = menu_json.get("categories", [])
+        if not isinstance(cats, list):
+            raise ValueError("INVALID_ARGUMENT:categories")
+        out = []
         for idx, cat in enumerate(cats, start=1):
+            if not isinstance(cat, dict):
+                raise ValueError(f"INVALID_ARGUMENT:categories[{idx}]")
             cat_payload = {
+                "id": str(cat.get("id") or ""),
                 "name_i18n": jget(cat.get("name_i18n_json")) or cat.get("name_i18n") or {"zh": cat.get("name", "分类")},
                 "icon": cat.get("icon", ""),
                 "sort_order": cat.get("sort_order", idx),
             }
-            c = MenuService.create_category(device_id, cat_payload)
-            # items
-            for jdx, it in enumerate(cat.get("items", []), start=1):
+            if not isinstance(cat_payload["name_i18n"], dict):
+                raise ValueError(f"INVALID_ARGUMENT:categories[{idx}].name_i18n")
+            items = []
+            for jdx, it in enumerate(cat.get("items", []) or [], start=1):
+                where = f"categories[{idx}].items[{jdx}]"
+                if not isinstance(it, dict):
+                    raise ValueError(f"INVALID_ARGUMENT:{where}")
                 it_payload = {
-                    "cat_id": c["id"],
-                    "recipe_id": it.get("recipe_id", ""),
-                    "name_i18n": jget(it.get("name_i18n_json")) or {},
+                    "id": str(it.get("id") or ""),
+                    "recipe_id": str(it.get("recipe_id") or ""),
+                    "name_i18n": jget(it.get("name_i18n_json")) or it.get("name_i18n") or {},
                     "image_url": it.get("image_url", ""),
-                    "price_cents_override": int(it.get("price_cents_override")) if it.get("price_cents_override") else None,
-                    "options_schema": jget(it.get("options_schema_json")) or {},
+                    "price_cents_override": it.get("price_cents_override"),
+                    "options_schema": jget(it.get("options_schema_json")) or it.get("options_schema") or {},
                     "badges": [b for b in (it.get("badges_csv", "").split(",") if it.get("badges_csv") else []) if b],
-                    "visibility": it.get("visibility", "visible"),
-                    "schedule": jget(it.get("schedule_json")) or {},
+                    "visibility": it.get("visibility") or "visible",
+                    "schedule": jget(it.get("schedule_json")) or it.get("schedule") or {},
                     "tags": [t for t in (it.get("tags_csv", "").split(",") if it.get("tags_csv") else []) if t],
                     "sort_order": it.get("sort_order", jdx),
                 }
-                MenuService.create_item(device_id, it_payload)
+                if not it_payload["recipe_id"]:
+                    raise ValueError(f"INVALID_ARGUMENT:{where}.recipe_id")
+                if it_payload["visibility"] not in ("visible", "hidden", "archived"):
+                    raise ValueError(f"INVALID_ARGUMENT:{where}.visibility")
+                if not isinstance(it_payload["schedule"], dict) or not MenuService._schedule_hit(it_payload["schedule"]):
+                    raise ValueError(f"INVALID_SCHEDULE:{where}")
+                try:
+                    v = it_payload["price_cents_override"]
+                    it_payload["price_cents_override"] = int(v) if v not in (None, "") else None
+                    it_payload["sort_order"] = int(it_payload["sort_order"] or jdx)
+                except Exception:
+                    raise ValueError(f"INVALID_ARGUMENT:{where}")
+                items.append(it_payload)
+            try:
+                cat_payload["sort_order"] = int(cat_payload["sort_order"] or idx)
+            except Exception:
+                raise ValueError(f"INVALID_ARGUMENT:categories[{idx}].sort_order")
+            out.append({"cat": cat_payload, "items": items})
+        return out
+
+    @staticmethod
+    def _check_recipes(r, recipe_ids):
+        rids = sorted(recipe_ids)
+        pipe = r.pipeline(transaction=False)
+        for rid in rids:
+            pipe.exists(k_dict_recipe(rid))
+        missing = [rid for rid, ex in zip(rids, pipe.execute()) if not ex]
+        if missing:
+            raise ValueError(f"RECIPE_NOT_FOUND:{','.join(missing)}")
+
+    @staticmethod
+    def import_menu(device_id: str, menu_json: Dict[str, Any], strategy: str):
+        if strategy not in ("overwrite", "merge"):
+            raise ValueError("INVALID_ARGUMENT:strategy")
+        doc = MenuService._normalize_import(menu_json)
+        r = redis_cli.r
+        MenuService._require_private(r, device_id)
+        MenuService._write_import(r, device_id, doc, strategy)
         return MenuService.publish(device_id)
 
+    @staticmethod
+    def _write_import(r, device_id: str, doc: List[Dict[str, Any]], strategy: str):
+        # 校验并写入已规范化的菜单文档；任何一步失败都不改动现有结构（模板解绑也复用）
+        n_items = sum(len(c["items"]) for c in doc)
+        # 旧结构（overwrite 时整体替换）
+        old_cats = r.zrange(k_menu_cats(device_id), 0, -1)
+        pipe = r.pipeline(transaction=False)
+        for cat_id in old_cats:
+            pipe.zrange(k_menu_cat_items(device_id, cat_id), 0, -1)
+        old_items = [(cat_id, iid) for cat_id, ids in zip(old_cats, pipe.execute()) for iid in ids]
+        total = n_items if strategy == "overwrite" else n_items + len(old_items)
+        if total > int(current_app.config.get("MENU_MAX_ITEMS", 500)):
+            raise ValueError("MENU_TOO_MANY_ITEMS")
+        # 批量校验配方存在
+        MenuService._check_recipes(r, {it["recipe_id"] for c in doc for it in c["items"]})
+        # 一次性预留 ID 段，新结构全部写在新键上，对读者不可见
+        pipe = r.pipeline(transaction=False)
+        pipe.incrby(k_menu_seq_cat(device_id), max(1, len(doc)))
+        pipe.incrby(k_menu_seq_item(device_id), max(1, n_items))
+        cat_end, item_end = pipe.execute()
+        next_cat = int(cat_end) - max(1, len(doc)) + 1
+        next_item = int(item_end) - max(1, n_items) + 1
+        cats_tmp = k_menu_cats_tmp(device_id, uuid.uuid4().hex)
+        new_cats: Dict[str, int] = {}
+        new_items = []
+        fresh_keys = [cats_tmp]
+        pipe = r.pipeline(transaction=False)
+        for c in doc:
+            cat_id = str(next_cat); next_cat += 1
+            so = c["cat"]["sort_order"]
+            pipe.hset(k_menu_cat(device_id, cat_id), mapping=MenuService._cat_hash(cat_id, c["cat"], so))
+            fresh_keys += [k_menu_cat(device_id, cat_id), k_menu_cat_items(device_id, cat_id)]
+            new_cats[cat_id] = so
+            for it in c["items"]:
+                item_id = str(next_item); next_item += 1
+                pipe.hset(k_menu_item(device_id, item_id), mapping=MenuService._item_hash(item_id, cat_id, it["recipe_id"], it, it["sort_order"]))
+                pipe.zadd(k_menu_cat_items(device_id, cat_id), {item_id: it["sort_order"]})
+                fresh_keys.append(k_menu_item(device_id, item_id))
+                new_items.append((item_id, it["recipe_id"]))
+        if new_cats:
+            pipe.zadd(cats_tmp, new_cats)
+        try:
+            pipe.execute()
+        except Exception:
+            r.delete(*fresh_keys)
+            raise
+        old_rids = []
+        if strategy == "overwrite" and old_items:
+            pipe = r.pipeline(transaction=False)
+            for _, iid in old_items:
+                pipe.hget(k_menu_item(device_id, iid), "recipe_id")
+            old_rids = pipe.execute()
+        # 原子切换：替换分类根集合并清理旧结构、维护索引，写一条汇总审计
+        tx = r.pipeline(transaction=True)
+        if strategy == "overwrite":
+            if new_cats:
+                tx.rename(cats_tmp, k_menu_cats(device_id))
+            else:
+                tx.delete(k_menu_cats(device_id))
+            for (cat_id, iid), rid in zip(old_items, old_rids):
+                tx.delete(k_menu_item(device_id, iid))
+                AvailabilityService.unindex_item(tx, device_id, iid, rid)
+            for cat_id in old_cats:
+                tx.delete(k_menu_cat(device_id, cat_id), k_menu_cat_items(device_id, cat_id))
+        elif new_cats:
+            tx.zadd(k_menu_cats(device_id), new_cats)
+            tx.delete(cats_tmp)
+        for iid, rid in new_items:
+            AvailabilityService.index_item(tx, device_id, iid, rid)
+        tx.xadd(k_audit_stream(), {"action": "menu_import", "actor": "admin", "target_id": device_id, "summary": f"{strategy} cats={len(new_cats)} items={len(new_items)}", "ts": ts()})
+        tx.execute()
+
     @staticmethod
     def reorder_categories(device_id: str, arr: List[Dict[str, Any]]):
         r = redis_cli.r
+        MenuService._require_private(r, device_id)
         mapping = {}
         for obj in arr:
             cid = str(obj.get("cat_id"))
@@ -352,6 +671,7 @@ class MenuService:
     @staticmethod
     def reorder_items(device_id: str, cat_id: str, arr: List[Dict[str, Any]]):
         r = redis_cli.r
+        MenuService._require_private(r, device_id)
         mapping = {}
         for obj in arr:
             iid = str(obj.get("item_id"))
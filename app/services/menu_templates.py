@@ -0,0 +1,323 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Tuple, Callable
+from ..utils.extensions import redis_cli, jget, jset
+from ..utils.keys import (
+    k_menu_meta, k_menu_tpl, k_menu_tpl_all, k_menu_tpl_doc, k_menu_tpl_seq,
+    k_menu_tpl_devices, k_menu_ovr, k_recipe_tpl_refs, k_audit_stream, ts,
+)
+from .menu import MenuService
+from .availability import AvailabilityService
+from redis.exceptions import WatchError
+
+OVERRIDE_FIELDS = ("price_cents_override", "visibility", "schedule_json")
+
+
+class MenuTemplateService:
+    # 模板版本发布后不可变，按 (tpl_id, version) 做进程内缓存
+    _doc_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+    _doc_lock = threading.Lock()
+    DOC_CACHE_SIZE = 32
+
+    @staticmethod
+    def _load_doc(r, tpl_id: str, version: str) -> Dict[str, Any] | None:
+        ck = (tpl_id, version)
+        with MenuTemplateService._doc_lock:
+            doc = MenuTemplateService._doc_cache.get(ck)
+            if doc is not None:
+                MenuTemplateService._doc_cache.move_to_end(ck)
+                return doc
+        doc = jget(r.get(k_menu_tpl_doc(tpl_id, version)))
+        if doc is None:
+            return None
+        with MenuTemplateService._doc_lock:
+            MenuTemplateService._doc_cache[ck] = doc
+            while len(MenuTemplateService._doc_cache) > MenuTemplateService.DOC_CACHE_SIZE:
+                MenuTemplateService._doc_cache.popitem(last=False)
+        return doc
+
+    @staticmethod
+    def binding(r, device_id: str) -> Tuple[str, str] | None:
+        # 返回 (tpl_id, 生效版本)；未绑定模板返回 None
+        tpl_id, pinned = r.hmget(k_menu_meta(device_id), "template_id", "template_version")
+        if not tpl_id:
+            return None
+        return tpl_id, (pinned or r.hget(k_menu_tpl(tpl_id), "version") or "")
+
+    @staticmethod
+    def _apply_overrides(item: Dict[str, Any], ovr_json: str | None) -> Dict[str, Any]:
+        ovr = jget(ovr_json) or {}
+        if not ovr:
+            return item
+        return {**item, **{f: ovr[f] for f in OVERRIDE_FIELDS if f in ovr}}
+
+    @staticmethod
+    def resolve(device_id: str) -> Dict[str, Any] | None:
+        # 模板 + 设备覆盖层，形状与 MenuService.get_full_menu 的 categories 一致
+        r = redis_cli.r
+        bound = MenuTemplateService.binding(r, device_id)
+        if not bound:
+            return None
+        tpl_id, version = bound
+        doc = MenuTemplateService._load_doc(r, tpl_id, version) or {"categories": []}
+        ovr = r.hgetall(k_menu_ovr(device_id))
+        cats = []
+        for cat in doc.get("categories", []):
+            items = [MenuTemplateService._apply_overrides(it, ovr.get(it["id"])) for it in cat.get("items", [])]
+            cats.append({**cat, "items": items})
+        return {"template_id": tpl_id, "template_version": version, "categories": cats}
+
+    @staticmethod
+    def resolve_items(device_id: str) -> Dict[str, Dict[str, Any]]:
+        menu = MenuTemplateService.resolve(device_id) or {"categories": []}
+        return {it["id"]: it for cat in menu["categories"] for it in cat["items"]}
+
+    @staticmethod
+    def get(tpl_id: str) -> Dict[str, Any]:
+        r = redis_cli.r
+        meta = r.hgetall(k_menu_tpl(tpl_id))
+        if not meta:
+            raise KeyError(tpl_id)
+        doc = MenuTemplateService._load_doc(r, tpl_id, meta.get("version", "")) or {"categories": []}
+        return {"meta": meta, "categories": doc.get("categories", []), "device_count": r.scard(k_menu_tpl_devices(tpl_id))}
+
+    @staticmethod
+    def list_all() -> List[Dict[str, Any]]:
+        r = redis_cli.r
+        ids = sorted(r.smembers(k_menu_tpl_all()))
+        pipe = r.pipeline(transaction=False)
+        for tid in ids:
+            pipe.hgetall(k_menu_tpl(tid))
+            pipe.scard(k_menu_tpl_devices(tid))
+        res = pipe.execute()
+        return [{**res[2 * i], "device_count": res[2 * i + 1]} for i in range(len(ids)) if res[2 * i]]
+
+    @staticmethod
+    def publish(tpl_id: str, menu_json: Dict[str, Any], name: str | None = None, notify: bool = True, actor: str = "admin") -> Dict[str, Any]:
+        if not tpl_id:
+            raise ValueError("INVALID_ARGUMENT:template_id")
+        doc = MenuService._normalize_import(menu_json)
+        r = redis_cli.r
+        MenuService._check_recipes(r, {it["recipe_id"] for c in doc for it in c["items"]})
+        # 保留文档中已有的 ID（覆盖层按 item_id 生效），其余从模板序列分配
+        used = set()
+        need = 0
+        for node in [c["cat"] for c in doc] + [it for c in doc for it in c["items"]]:
+            if node["id"] and node["id"] not in used:
+                used.add(node["id"])
+            else:
+                node["id"] = ""
+                need += 1
+        seq = int(r.incrby(k_menu_tpl_seq(tpl_id), need)) - need if need else 0
+        def next_id():
+            nonlocal seq
+            while True:
+                seq += 1
+                if str(seq) not in used:
+                    used.add(str(seq))
+                    return str(seq)
+        cats = []
+        rids = set()
+        for c in doc:
+            cat_id = c["cat"]["id"] or next_id()
+            items = []
+            for it in c["items"]:
+                item_id = it["id"] or next_id()
+                items.append(MenuService._item_hash(item_id, cat_id, it["recipe_id"], it, it["sort_order"]))
+                rids.add(it["recipe_id"])
+            cats.append({**MenuService._cat_hash(cat_id, c["cat"], c["cat"]["sort_order"]), "items": items})
+        cats.sort(key=lambda x: int(x["sort_order"]))
+        for cat in cats:
+            cat["items"].sort(key=lambda x: int(x["sort_order"]))
+        prev = r.hgetall(k_menu_tpl(tpl_id))
+        version = str(r.hincrby(k_menu_tpl(tpl_id), "version_seq", 1))
+        prev_rids = MenuTemplateService._version_rids(r, tpl_id, prev.get("version", ""))
+        # 一次写入：模板版本 + 元信息 + 配方引用索引
+        tx = r.pipeline(transaction=True)
+        tx.set(k_menu_tpl_doc(tpl_id, version), jset({"categories": cats}))
+        tx.hset(k_menu_tpl(tpl_id), mapping={"id": tpl_id, "name": name or prev.get("name") or tpl_id, "version": version, "updated_ts": str(ts())})
+        tx.sadd(k_menu_tpl_all(), tpl_id)
+        for rid in rids:
+            tx.sadd(k_recipe_tpl_refs(rid), tpl_id)
+        tx.xadd(k_audit_stream(), {"action": "menu_tpl_publish", "actor": actor, "target_id": tpl_id, "summary": version, "ts": ts()})
+        tx.execute()
+        # 新版本不再使用的配方，仍可能被固定在旧版本的设备引用
+        MenuTemplateService._prune_refs(r, tpl_id, prev_rids - rids)
+        res = {"template_id": tpl_id, "version": version, "batch_id": None}
+        if notify:
+            res["batch_id"] = MenuTemplateService._notify(r, tpl_id, version)
+        return res
+
+    @staticmethod
+    def _version_rids(r, tpl_id: str, version: str) -> set:
+        doc = MenuTemplateService._load_doc(r, tpl_id, version) if version else None
+        return {it["recipe_id"] for cat in (doc or {}).get("categories", []) for it in cat["items"]}
+
+    @staticmethod
+    def _prune_refs(r, tpl_id: str, recipe_ids):
+        # 配方 → 模板引用只在模板最新版本与所有设备固定的版本都不再包含该配方时移除
+        recipe_ids = set(recipe_ids)
+        if not recipe_ids:
+            return
+        devices = list(r.smembers(k_menu_tpl_devices(tpl_id)))
+        pipe = r.pipeline(transaction=False)
+        for d in devices:
+            pipe.hget(k_menu_meta(d), "template_version")
+        versions = {v for v in pipe.execute() if v} | {r.hget(k_menu_tpl(tpl_id), "version") or ""}
+        live = set()
+        for v in versions:
+            live |= MenuTemplateService._version_rids(r, tpl_id, v)
+        stale = recipe_ids - live
+        if stale:
+            pipe = r.pipeline(transaction=False)
+            for rid in stale:
+                pipe.srem(k_recipe_tpl_refs(rid), tpl_id)
+            pipe.execute()
+
+    @staticmethod
+    def _notify(r, tpl_id: str, version: str) -> str | None:
+        # 仅通知跟随最新版本的设备；可售集合在读取时按版本戳惰性重建
+        from .commands import CommandService
+        devices = sorted(r.smembers(k_menu_tpl_devices(tpl_id)))
+        pipe = r.pipeline(transaction=False)
+        for d in devices:
+            pipe.hget(k_menu_meta(d), "template_version")
+        followers = [d for d, pinned in zip(devices, pipe.execute()) if not pinned]
+        if not followers:
+            return None
+        payload = {"template_id": tpl_id, "version": version}
+        return CommandService.dispatch_batch(followers, "menu_update", payload, note=f"menu template {tpl_id} v{version}")["batch_id"]
+
+    @staticmethod
+    def bind(device_id: str, tpl_id: str, version: str | None = None) -> Dict[str, Any]:
+        r = redis_cli.r
+        tpl = r.hgetall(k_menu_tpl(tpl_id))
+        if not tpl:
+            raise ValueError("MENU_TEMPLATE_NOT_FOUND")
+        if version and not r.exists(k_menu_tpl_doc(tpl_id, str(version))):
+            raise ValueError("MENU_TEMPLATE_VERSION_NOT_FOUND")
+        old = MenuTemplateService.binding(r, device_id)
+        if old:
+            r.srem(k_menu_tpl_devices(old[0]), device_id)
+        else:
+            # 清空设备私有菜单，改为引用模板
+            MenuService.import_menu(device_id, {"categories": []}, "overwrite")
+        if version:
+            # 固定的旧版本可能含已被新版本移除的配方，补回引用
+            pipe = r.pipeline(transaction=False)
+            for rid in MenuTemplateService._version_rids(r, tpl_id, str(version)):
+                pipe.sadd(k_recipe_tpl_refs(rid), tpl_id)
+            pipe.execute()
+        r.hset(k_menu_meta(device_id), mapping={"template_id": tpl_id, "template_version": str(version or "")})
+        r.sadd(k_menu_tpl_devices(tpl_id), device_id)
+        r.delete(k_menu_ovr(device_id))
+        if old:
+            MenuTemplateService._prune_refs(r, old[0], MenuTemplateService._version_rids(r, old[0], old[1]))
+        r.xadd(k_audit_stream(), {"action": "menu_tpl_bind", "actor": "admin", "target_id": device_id, "summary": f"{tpl_id}@{version or 'latest'}", "ts": ts()})
+        return MenuService.publish(device_id)
+
+    @staticmethod
+    def unbind(device_id: str) -> Dict[str, Any]:
+        # 解绑时将“模板 + 覆盖层”物化为设备私有菜单
+        r = redis_cli.r
+        # 先校验并写入私有结构（仍处于绑定状态，读者继续看到模板），成功后才清除绑定与覆盖层
+        menu = MenuTemplateService.resolve(device_id)
+        if not menu:
+            raise ValueError("MENU_TEMPLATE_NOT_BOUND")
+        doc = MenuService._normalize_import({"categories": menu["categories"]})
+        MenuService._write_import(r, device_id, doc, "overwrite")
+        tpl_id = menu["template_id"]
+        r.hdel(k_menu_meta(device_id), "template_id", "template_version", "available_tpl_ver")
+        r.srem(k_menu_tpl_devices(tpl_id), device_id)
+        r.delete(k_menu_ovr(device_id))
+        r.xadd(k_audit_stream(), {"action": "menu_tpl_unbind", "actor": "admin", "target_id": device_id, "summary": tpl_id, "ts": ts()})
+        MenuTemplateService._prune_refs(r, tpl_id, MenuTemplateService._version_rids(r, tpl_id, menu["template_version"]))
+        return MenuService.publish(device_id)
+
+    @staticmethod
+    def set_overrides(device_id: str, changes: Dict[str, Dict[str, str]], expected_version: str | None = None) -> Dict[str, Dict[str, Any]]:
+        # changes: item_id -> {字段: 值}；仅允许价格/可见性/时段
+        return MenuTemplateService._write_overrides(device_id, lambda items: changes, expected_version)
+
+    @staticmethod
+    def _write_overrides(device_id: str, build: Callable[[Dict[str, Dict[str, Any]]], Dict[str, Dict[str, str]]], expected_version: str | None = None) -> Dict[str, Dict[str, Any]]:
+        # WATCH 覆盖层、菜单元信息（绑定 / 版本）与模板元信息，在其内解析“模板 + 覆盖层”并由 build 计算变更；
+        # 读取与写入之间有并发覆盖写入或模板发布则重试，不用过期数据覆盖。If-Match 与私有菜单一样比对设备菜单版本
+        r = redis_cli.r
+        kovr, kmeta = k_menu_ovr(device_id), k_menu_meta(device_id)
+        with r.pipeline() as tx:
+            for _ in range(3):
+                try:
+                    tx.watch(kovr, kmeta)
+                    tpl_id, cur_ver = tx.hmget(kmeta, "template_id", "version")
+                    if tpl_id:
+                        tx.watch(k_menu_tpl(tpl_id))
+                    if expected_version is not None and str(expected_version) != str(cur_ver or "1"):
+                        raise ValueError("CONFLICT")
+                    items = MenuTemplateService.resolve_items(device_id)
+                    changes = build(items)
+                    for iid in changes:
+                        if iid not in items:
+                            raise ValueError(f"MENU_ITEM_NOT_FOUND:{iid}")
+                    ids = list(changes)
+                    cur = dict(zip(ids, tx.hmget(kovr, ids))) if ids else {}
+                    merged = {}
+                    for iid, fields in changes.items():
+                        ovr = jget(cur.get(iid)) or {}
+                        ovr.update({f: v for f, v in fields.items() if f in OVERRIDE_FIELDS})
+                        merged[iid] = ovr
+                    tx.multi()
+                    if merged:
+                        tx.hset(kovr, mapping={iid: jset(ovr) for iid, ovr in merged.items()})
+                    tx.execute()
+                    break
+                except WatchError:
+                    continue
+            else:
+                raise ValueError("CONFLICT")
+        for iid, ovr in merged.items():
+            items[iid] = {**items[iid], **{f: ovr[f] for f in OVERRIDE_FIELDS if f in ovr}}
+        AvailabilityService.refresh_items(device_id, ids, {iid: items[iid] for iid in ids})
+        return {iid: items[iid] for iid in ids}
+
+    @staticmethod
+    def bulk_override(device_id: str, ops: List[Dict[str, Any]], expected_version: str | None = None) -> Dict[str, Any]:
+        r = redis_cli.r
+        if any(op["op"] == "move" for op in ops):
+            raise ValueError("MENU_TEMPLATE_BOUND")
+        def build(items):
+            # 在 WATCH 内按最新的模板与覆盖层计算调价基准与变更
+            base_price = {}
+            if any(op["op"] == "price" and op["mode"] != "set" for op in ops):
+                base_price = MenuService._recipe_prices(r, {h.get("recipe_id") for h in items.values() if h.get("recipe_id")})
+            changes: Dict[str, Dict[str, str]] = {}
+            for op in ops:
+                for iid in op["item_ids"]:
+                    if iid not in items:
+                        raise ValueError(f"MENU_ITEM_NOT_FOUND:{iid}")
+                    m = changes.setdefault(iid, {})
+                    if op["op"] == "visibility":
+                        m["visibility"] = op["visibility"]
+                    elif op["op"] == "schedule":
+                        m["schedule_json"] = jset(op["schedule"])
+                    else:
+                        cur = m.get("price_cents_override", items[iid].get("price_cents_override"))
+                        m["price_cents_override"] = MenuService._adjust_price(op, cur, base_price.get(items[iid].get("recipe_id")))
+            return changes
+        updated = MenuTemplateService._write_overrides(device_id, build, expected_version)
+        r.xadd(k_audit_stream(), {"action": "menu_item_bulk", "actor": "admin", "target_id": device_id, "summary": f"ops={len(ops)} items={len(updated)}", "ts": ts()})
+        return {"updated": len(updated), "items": list(updated.values())}
+
+    @staticmethod
+    def items_by_recipe(device_id: str, recipe_ids) -> List[str]:
+        rids = set(recipe_ids)
+        return [iid for iid, it in MenuTemplateService.resolve_items(device_id).items() if it.get("recipe_id") in rids]
+
+    @staticmethod
+    def devices_for_recipe(recipe_id: str) -> List[str]:
+        r = redis_cli.r
+        tids = list(r.smembers(k_recipe_tpl_refs(recipe_id)))
+        pipe = r.pipeline(transaction=False)
+        for tid in tids:
+            pipe.smembers(k_menu_tpl_devices(tid))
+        return sorted({d for s in pipe.execute() for d in s})
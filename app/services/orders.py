@@ -4,6 +4,7 @@ from ..utils.keys import (
     k_order, k_orders_by_ts, ts,
     k_orders_global_by_ts, k_order_index, k_audit_stream
 )
+from .events import EventBus
 from datetime import datetime
 import csv, io, json
 
@@ -37,6 +38,7 @@ class OrderService:
             r.set(k_order_index(order_id), device_id)
         except Exception:
             pass
+        EventBus.publish("order.created", {"device_id": device_id, "order_id": order_id, "server_ts": ts_val})
         return True
 
     # Global querying and utilities
@@ -276,6 +278,7 @@ class OrderService:
         try:
             r.hset(k_order(device_id, order_id), mapping={"pay_status": "refunded", "refund_ts": str(ts())})
             r.xadd(k_audit_stream(), {"action": "order_refund", "actor": actor, "target_id": order_id, "ts": ts(), "summary": device_id or ''})
+            EventBus.publish("order.refunded", {"device_id": device_id or "", "order_id": order_id})
         except Exception:
             pass
         return r.hgetall(k_order(device_id, order_id))
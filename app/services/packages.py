@@ -35,7 +35,7 @@ class PackageService:
         return res
 
     @staticmethod
-    def dispatch(pkg_id: str, device_ids: List[str]):
+    def dispatch(pkg_id: str, device_ids: List[str], selector: str | None = None):
         from .commands import CommandService
         payload = {"package_id": pkg_id}
-        return CommandService.dispatch_batch(device_ids, "upgrade", payload, note=f"Dispatch package {pkg_id}")
+        return CommandService.dispatch_batch(device_ids, "upgrade", payload, note=f"Dispatch package {pkg_id}", selector=selector)
@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from typing import Dict, Any, List, Tuple, Callable
+from ..utils.extensions import redis_cli
+from ..utils.keys import k_batch_progress
+from .commands import CommandService
+
+# 合并窗口：窗口内同一批次的多次变更只读取一次快照、推送一次增量
+FLUSH_S = 0.5
+# 单个订阅者积压上限；积压满时清空队列，改推一条完整概要，保证慢连接最终一致
+SUB_QUEUE_MAX = 100
+
+
+# 批次进度推送中枢：每个进程只持有一个 pub/sub 连接（模式订阅全部批次频道），
+# 有订阅者的批次在变更后按窗口合并读取一次概要，只把变化的字段分发给所有 SSE 连接；
+# 全局观察者（事件总线）会收到任意批次变更后的最新概要
+class ProgressHub:
+    _lock = threading.Lock()
+    _subs: Dict[str, List[queue.Queue]] = {}
+    _watchers: List[Callable[[str, Dict[str, Any]], None]] = []
+    _state: Dict[str, Dict[str, Any]] = {}
+    _dirty: set = set()
+    _thread: threading.Thread | None = None
+
+    @staticmethod
+    def _ensure_thread():
+        with ProgressHub._lock:
+            if ProgressHub._thread and ProgressHub._thread.is_alive():
+                return
+            ProgressHub._thread = threading.Thread(target=ProgressHub._run, name="batch-progress-hub", daemon=True)
+            ProgressHub._thread.start()
+
+    @staticmethod
+    def subscribe(batch_id: str) -> Tuple[queue.Queue, Dict[str, Any]]:
+        # 返回增量队列与当前概要（首个订阅者读取一次，其余直接复用）
+        ProgressHub._ensure_thread()
+        q: queue.Queue = queue.Queue(maxsize=SUB_QUEUE_MAX)
+        with ProgressHub._lock:
+            ProgressHub._subs.setdefault(batch_id, []).append(q)
+            snap = ProgressHub._state.get(batch_id)
+        if snap is None:
+            loaded = CommandService.get_batch(batch_id)
+            with ProgressHub._lock:
+                snap = ProgressHub._state.setdefault(batch_id, loaded)
+        return q, snap
+
+    @staticmethod
+    def unsubscribe(batch_id: str, q: queue.Queue):
+        with ProgressHub._lock:
+            subs = ProgressHub._subs.get(batch_id) or []
+            if q in subs:
+                subs.remove(q)
+            if not subs:
+                ProgressHub._subs.pop(batch_id, None)
+                ProgressHub._state.pop(batch_id, None)
+                ProgressHub._dirty.discard(batch_id)
+
+    @staticmethod
+    def watch(fn: Callable[[str, Dict[str, Any]], None]):
+        ProgressHub._ensure_thread()
+        with ProgressHub._lock:
+            if fn not in ProgressHub._watchers:
+                ProgressHub._watchers.append(fn)
+
+    @staticmethod
+    def unwatch(fn: Callable[[str, Dict[str, Any]], None]):
+        with ProgressHub._lock:
+            if fn in ProgressHub._watchers:
+                ProgressHub._watchers.remove(fn)
+
+    @staticmethod
+    def _diff(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+        out = {}
+        for part in ("info", "counts"):
+            prev = old.get(part) or {}
+            changed = {k: v for k, v in (new.get(part) or {}).items() if prev.get(k) != v}
+            if changed:
+                out[part] = changed
+        return out
+
+    @staticmethod
+    def _flush():
+        with ProgressHub._lock:
+            watchers = list(ProgressHub._watchers)
+            dirty = [bid for bid in ProgressHub._dirty if watchers or bid in ProgressHub._subs]
+            ProgressHub._dirty.clear()
+        for bid in dirty:
+            snap = CommandService.get_batch(bid)
+            for fn in watchers:
+                try:
+                    fn(bid, snap)
+                except Exception:
+                    pass
+            with ProgressHub._lock:
+                if bid not in ProgressHub._subs:
+                    continue
+                delta = ProgressHub._diff(ProgressHub._state.get(bid) or {}, snap)
+                ProgressHub._state[bid] = snap
+                subs = list(ProgressHub._subs[bid])
+            if not delta:
+                continue
+            for q in subs:
+                try:
+                    q.put_nowait(delta)
+                except queue.Full:
+                    ProgressHub._resync(q, snap)
+
+    @staticmethod
+    def _resync(q: queue.Queue, snap: Dict[str, Any]):
+        # _state 已前移，丢弃的增量不会再出现在后续增量里；清空积压后以全部字段作为一条增量补齐。
+        # 只有刷新线程写队列，清空后必有空位
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            q.put_nowait({part: dict(snap.get(part) or {}) for part in ("info", "counts")})
+        except queue.Full:
+            pass
+
+    @staticmethod
+    def _run():
+        prefix, suffix = k_batch_progress("\0").split("\0")
+        while True:
+            try:
+                ps = redis_cli.r.pubsub(ignore_subscribe_messages=True)
+                ps.psubscribe(k_batch_progress("*"))
+                last = time.monotonic()
+                while True:
+                    msg = ps.get_message(timeout=FLUSH_S)
+                    if msg and msg.get("type") == "pmessage":
+                        bid = msg["channel"][len(prefix):len(msg["channel"]) - len(suffix)]
+                        with ProgressHub._lock:
+                            if ProgressHub._watchers or bid in ProgressHub._subs:
+                                ProgressHub._dirty.add(bid)
+                    now = time.monotonic()
+                    if now - last >= FLUSH_S:
+                        ProgressHub._flush()
+                        last = now
+            except Exception:
+                # 连接中断后重连，best-effort
+                time.sleep(1)
@@ -4,12 +4,25 @@ from ..utils.extensions import redis_cli, jget, jset
 from ..utils.keys import (
     k_dict_recipe, k_dict_recipe_enabled, k_dict_recipe_all,
     k_dev, k_menu_cat, k_menu_cat_items, k_menu_item,
-    k_audit_stream, ts, k_recipe_pkg, k_dev_recipes_active,
-    k_dict_material,
+    k_audit_stream, ts, k_recipe_pkg, k_recipe_pkgs, k_dev_recipes_active,
+    k_recipe_menu_refs, k_recipe_devices_active, k_recipe_tpl_refs,
 )
 from ..utils.rate_limit import check_rate, RateLimited
 from .materials import MaterialService
 from .commands import CommandService
+from .availability import AvailabilityService
+from .dict_index import DictIndex
+from .dict_cache import DictCache
+from .blobs import BlobService
+from .menu_templates import MenuTemplateService
+
+# 配方制品与增量在共享 blob 中的类型标记（按摘要下载时据此校验归属）
+PKG_KIND = "recipe_pkg"
+PKG_DELTA_KIND = "recipe_pkg_delta"
+
+
+def _ptr(key: str) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
 
 
 class RecipeService:
@@ -70,6 +83,21 @@ class RecipeService:
         }
         return True, "", normalized
 
+    @staticmethod
+    def _texts(h: Dict[str, Any]) -> List[str]:
+        # 关键字检索范围：id、名称与中英文名称
+        names = (jget(h.get("schema_json")) or {}).get("name_i18n") or {}
+        return [h.get("id") or "", h.get("name") or "", names.get("zh") or "", names.get("en") or ""]
+
+    @staticmethod
+    def _postings(h: Dict[str, Any]) -> set:
+        if not h:
+            return set()
+        sj = jget(h.get("schema_json")) or {}
+        tags_csv = ",".join(sj.get("tags", [])) if isinstance(sj.get("tags"), list) else (sj.get("tags_csv") or "")
+        tags = [t.strip().lower() for t in tags_csv.split(",") if t.strip()]
+        return DictIndex.postings("recipe", {"enabled": [h.get("enabled") or "1"], "tag": tags}, RecipeService._texts(h))
+
     @staticmethod
     def upsert(recipe_id: str, data: Dict[str, Any]):
         r = redis_cli.r
@@ -80,11 +108,9 @@ class RecipeService:
         if not ok:
             raise ValueError(msg)
         # check materials existence (soft check; collect missing)
-        missing = []
-        for ing in norm.get("ingredients", []):
-            code = ing.get("material") or ing.get("material_code")
-            if code and not redis_cli.r.exists(k_dict_material(code)):
-                missing.append(code)
+        codes = [ing.get("material") or ing.get("material_code") for ing in norm.get("ingredients", [])]
+        known = DictCache.materials(codes)
+        missing = [code for code in codes if code and not known.get(code)]
         # strict validation when enabled flag is true (to避免上架无物料)
         if enabled and missing:
             raise ValueError(f"MATERIALS_MISSING:{','.join(sorted(set(missing)))}")
@@ -106,6 +132,15 @@ class RecipeService:
             r.sadd(k_dict_recipe_enabled(), recipe_id)
         else:
             r.srem(k_dict_recipe_enabled(), recipe_id)
+        pipe = r.pipeline(transaction=True)
+        DictIndex.write(pipe, "recipe", recipe_id, RecipeService._postings(prev), RecipeService._postings({**prev, **h}), h["updated_ts"])
+        MaterialService.index_recipe_refs(pipe, recipe_id, MaterialService.schema_refs(jget(prev.get("schema_json"))), MaterialService.schema_refs(norm))
+        pipe.execute()
+        DictCache.invalidate()
+        # 启停或需求向量变化时，仅刷新引用该配方的商品可售状态
+        req_changed = AvailabilityService.set_recipe_requirements(recipe_id, AvailabilityService.requirement_vector(norm))
+        if req_changed or prev.get("enabled") != h["enabled"]:
+            AvailabilityService.on_recipe_changed(recipe_id)
         r.xadd(k_audit_stream(), {"action": ("recipe_update" if exists else "recipe_create"), "target_id": recipe_id, "ts": ts(), "summary": h["name"]})
         return {**h, "missing_materials": missing}
 
@@ -116,96 +151,234 @@ class RecipeService:
     @staticmethod
     def list(query: str | None = None, enabled: str | None = None, tags: str | None = None, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
         r = redis_cli.r
-        q = (query or "").lower().strip()
-        tagset = set([t.strip().lower() for t in (tags or "").split(',') if t.strip()])
-        rows: List[Dict[str, Any]] = []
-        for rid in r.smembers(k_dict_recipe_all()):
-            h = r.hgetall(k_dict_recipe(rid))
-            if not h:
-                continue
-            if enabled in ("1","0","true","false","enabled","disabled"):
-                want = "1" if enabled in ("1","true","enabled") else "0"
-                if (h.get("enabled") or "1") != want:
-                    continue
-            if q:
-                name_zh = (jget(h.get("schema_json")) or {}).get("name_i18n", {}).get("zh", "")
-                if q not in (h.get("id") or '').lower() and q not in (name_zh or '').lower() and q not in (h.get("name") or '').lower():
-                    continue
-            if tagset:
-                sj = jget(h.get("schema_json")) or {}
-                tags_csv = ",".join(sj.get("tags", [])) if isinstance(sj.get("tags"), list) else (sj.get("tags_csv") or "")
-                ht = set([t.strip().lower() for t in tags_csv.split(',') if t.strip()])
-                if not tagset.issubset(ht):
-                    continue
-            rows.append(h)
-        def score(o):
-            try: return int(o.get("updated_ts") or 0)
-            except: return 0
-        rows.sort(key=score, reverse=True)
-        total = len(rows)
         page = max(1, int(page or 1)); page_size = max(1, min(int(page_size or 20), 100))
-        start=(page-1)*page_size; end=start+page_size
-        items = rows[start:end]
-        # enrich usage counts
+        # 筛选条件 → 索引集合求交，updated_ts 倒序分页，只读取当前页
+        filters = [("tag", t) for t in sorted({t.strip().lower() for t in (tags or "").split(',') if t.strip()})]
+        if enabled in ("1","0","true","false","enabled","disabled"):
+            filters.append(("enabled", "1" if enabled in ("1","true","enabled") else "0"))
+        total, items = DictIndex.search("recipe", k_dict_recipe, RecipeService._texts, filters, query, page, page_size)
+        # 引用计数直接取反向索引基数，一页一次往返
+        pipe = r.pipeline(transaction=False)
         for it in items:
-            rid = it.get('id')
-            u = RecipeService.usage(rid)
-            it['menu_refs_count'] = len(u.get('menu_refs', []))
-            it['devices_active_count'] = len(u.get('devices_active', []))
+            pipe.scard(k_recipe_menu_refs(it.get('id')))
+            pipe.scard(k_recipe_devices_active(it.get('id')))
+            pipe.scard(k_recipe_tpl_refs(it.get('id')))
+        counts = pipe.execute()
+        for i, it in enumerate(items):
+            it['menu_refs_count'] = int(counts[3 * i] or 0)
+            it['devices_active_count'] = int(counts[3 * i + 1] or 0)
+            it['template_refs_count'] = int(counts[3 * i + 2] or 0)
         return {"items": items, "total": total, "page": page, "page_size": page_size}
 
     @staticmethod
     def delete(recipe_id: str, force: bool = False) -> bool:
         r = redis_cli.r
         u = RecipeService.usage(recipe_id)
-        if not force and (u['menu_refs'] or u['devices_active']):
+        # 仅被模板菜单引用的配方同样不能直接删除，否则所有绑定设备的菜单失效
+        if not force and (u['menu_refs'] or u['devices_active'] or u['templates'] or u['template_devices']):
             raise ValueError("REFERENCED")
-        r.delete(k_dict_recipe(recipe_id))
-        r.srem(k_dict_recipe_all(), recipe_id)
-        r.srem(k_dict_recipe_enabled(), recipe_id)
+        prev = r.hgetall(k_dict_recipe(recipe_id))
+        pipe = r.pipeline(transaction=True)
+        DictIndex.drop(pipe, "recipe", recipe_id, RecipeService._postings(prev))
+        MaterialService.index_recipe_refs(pipe, recipe_id, MaterialService.schema_refs(jget(prev.get("schema_json"))), ())
+        pipe.delete(k_dict_recipe(recipe_id))
+        pipe.srem(k_dict_recipe_all(), recipe_id)
+        pipe.srem(k_dict_recipe_enabled(), recipe_id)
+        pipe.execute()
+        DictCache.invalidate()
+        AvailabilityService.set_recipe_requirements(recipe_id, None)
+        AvailabilityService.on_recipe_changed(recipe_id)
         r.xadd(k_audit_stream(), {"action": "recipe_delete", "target_id": recipe_id, "ts": ts()})
         return True
 
     @staticmethod
     def usage(recipe_id: str) -> Dict[str, Any]:
         r = redis_cli.r
-        # menu refs across devices
+        # 菜单引用：recipe → "device:item" 反向索引（菜单增删改与导入时维护）
+        refs = sorted(r.smembers(k_recipe_menu_refs(recipe_id)))
+        pipe = r.pipeline(transaction=False)
+        for ref in refs:
+            device_id, _, item_id = ref.rpartition(":")
+            pipe.hmget(k_menu_item(device_id, item_id), "recipe_id", "cat_id", "name", "name_i18n_json")
         menu_refs = []
+        for ref, (rid, cat_id, name, name_i18n) in zip(refs, pipe.execute() if refs else []):
+            # 跳过索引中残留的失效引用
+            if rid != recipe_id:
+                continue
+            device_id, _, item_id = ref.rpartition(":")
+            name = (jget(name_i18n) or {}).get('zh') or name or ''
+            menu_refs.append({"device_id": device_id, "cat_id": cat_id or "", "item_id": item_id, "name": name})
+        devices_active = sorted(r.smembers(k_recipe_devices_active(recipe_id)))
+        # 模板菜单引用：recipe → 模板索引，以及绑定这些模板的设备
+        templates = sorted(r.smembers(k_recipe_tpl_refs(recipe_id)))
+        template_devices = MenuTemplateService.devices_for_recipe(recipe_id) if templates else []
+        return {"menu_refs": menu_refs, "devices_active": devices_active, "templates": templates, "template_devices": template_devices}
+
+    @staticmethod
+    def set_device_active(device_id: str, recipe_ids: List[str]):
+        # 整体替换设备启用的配方集合，并同步 recipe → devices 反向索引
+        r = redis_cli.r
+        key = k_dev_recipes_active(device_id)
+        old = set(r.smembers(key))
+        new = {str(x) for x in recipe_ids or [] if x}
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(key)
+        if new:
+            pipe.sadd(key, *new)
+        for rid in old - new:
+            pipe.srem(k_recipe_devices_active(rid), device_id)
+        for rid in new - old:
+            pipe.sadd(k_recipe_devices_active(rid), device_id)
+        pipe.execute()
+
+    @staticmethod
+    def add_device_active(device_id: str, recipe_ids: List[str]):
+        # 增量登记（配方下发回执成功时调用）
+        rids = {str(x) for x in recipe_ids or [] if x}
+        if not rids:
+            return
+        pipe = redis_cli.r.pipeline(transaction=True)
+        pipe.sadd(k_dev_recipes_active(device_id), *rids)
+        for rid in rids:
+            pipe.sadd(k_recipe_devices_active(rid), device_id)
+        pipe.execute()
+
+    @staticmethod
+    def reindex_usage() -> int:
+        # 回填菜单引用与启用设备反向索引（索引引入前已存在的数据），幂等
+        r = redis_cli.r
+        n = 0
         for key in r.scan_iter(match="cm:dev:*:menu:cat:*:items"):
-            parts = key.split(":")
-            device_id = parts[2]
-            cat_id = parts[6] if len(parts) > 6 else parts[-2]
-            for item_id in r.zrange(key, 0, -1):
-                ih = r.hgetall(k_menu_item(device_id, item_id))
-                if ih.get("recipe_id") == recipe_id:
-                    ch = r.hgetall(k_menu_cat(device_id, cat_id))
-                    name = (jget(ih.get("name_i18n_json")) or {}).get('zh') or ih.get('name') or ''
-                    menu_refs.append({"device_id": device_id, "cat_id": cat_id, "item_id": item_id, "name": name})
-        # devices active set
-        devices_active = []
+            device_id = key.split(":")[2]
+            item_ids = r.zrange(key, 0, -1)
+            pipe = r.pipeline(transaction=False)
+            for item_id in item_ids:
+                pipe.hget(k_menu_item(device_id, item_id), "recipe_id")
+            rids = pipe.execute() if item_ids else []
+            pipe = r.pipeline(transaction=False)
+            for item_id, rid in zip(item_ids, rids):
+                AvailabilityService.index_item(pipe, device_id, item_id, rid)
+                n += 1 if rid else 0
+            pipe.execute()
         for key in r.scan_iter(match="cm:dev:*:recipes:active"):
             device_id = key.split(":")[2]
-            if r.sismember(key, recipe_id):
-                devices_active.append(device_id)
-        return {"menu_refs": menu_refs, "devices_active": devices_active}
+            pipe = r.pipeline(transaction=False)
+            for rid in r.smembers(key):
+                pipe.sadd(k_recipe_devices_active(rid), device_id)
+                n += 1
+            pipe.execute()
+        return n
+
+    @staticmethod
+    def _patch_ops(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+        # JSON Patch（RFC 6902 子集）：对象逐键比较，其余值（含数组）整体替换
+        if isinstance(old, dict) and isinstance(new, dict):
+            ops: List[Dict[str, Any]] = []
+            for k in sorted(old.keys() - new.keys()):
+                ops.append({"op": "remove", "path": f"{path}/{_ptr(k)}"})
+            for k in sorted(new):
+                p = f"{path}/{_ptr(k)}"
+                if k not in old:
+                    ops.append({"op": "add", "path": p, "value": new[k]})
+                else:
+                    ops += RecipeService._patch_ops(old[k], new[k], p)
+            return ops
+        if type(old) is type(new) and old == new:
+            return []
+        return [{"op": "replace", "path": path, "value": new}]
+
+    @staticmethod
+    def _pkg_view(recipe_id: str, rec: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "recipe_id": recipe_id,
+            "version": rec.get("version", ""),
+            "digest": rec.get("digest", ""),
+            "size": int(rec.get("size") or 0),
+            "base_version": rec.get("base_version", ""),
+            "base_digest": rec.get("base_digest", ""),
+            "delta_digest": rec.get("delta_digest", ""),
+            "delta_size": int(rec.get("delta_size") or 0),
+            "built_ts": rec.get("built_ts", ""),
+        }
 
     @staticmethod
     def publish(recipe_id: str) -> Dict[str, Any]:
         r = redis_cli.r
-        h = r.hgetall(k_dict_recipe(recipe_id))
+        h = DictCache.recipe(recipe_id)
         if not h:
             raise KeyError(recipe_id)
         version = h.get("version", "1")
-        # build a package snapshot
+        # 制品为规范化 JSON（键排序、紧凑），按 sha256 内容寻址存入共享 blob（较大时压缩）；
+        # 内容相同的版本复用同一 blob，设备按摘要判断是否需要下载
+        doc = {"kind": PKG_KIND, "id": recipe_id, "schema": h.get("schema") or {}}
+        raw = BlobService.canonical(doc)
+        digest = BlobService.digest(raw)
         pkg_key = k_recipe_pkg(recipe_id, version)
-        r.hset(pkg_key, mapping={"id": recipe_id, "version": version, "schema_json": h.get("schema_json"), "built_ts": str(ts())})
-        r.xadd(k_audit_stream(), {"action": "recipe_publish", "target_id": recipe_id, "ts": ts(), "summary": version})
-        return {"recipe_id": recipe_id, "version": version}
+        cur = r.hgetall(pkg_key)
+        if cur.get("digest") == digest:
+            return {**RecipeService._pkg_view(recipe_id, cur), "unchanged": True}
+        BlobService.put(raw)
+        rec = {"id": recipe_id, "version": version, "digest": digest, "size": str(len(raw.encode("utf-8"))),
+               "base_version": "", "base_digest": "", "delta_digest": "", "delta_size": "0", "built_ts": str(ts())}
+        # 增量：相对上一个已发布版本，仅在比完整制品小时保留
+        prev = r.zrevrangebyscore(k_recipe_pkgs(recipe_id), f"({int(version)}", "-inf", start=0, num=1)
+        base = r.hgetall(k_recipe_pkg(recipe_id, prev[0])) if prev else {}
+        base_doc = jget(BlobService.get(base["digest"])) if base.get("digest") else None
+        if isinstance(base_doc, dict):
+            rec.update({"base_version": prev[0], "base_digest": base["digest"]})
+            if base["digest"] != digest:
+                delta = BlobService.canonical({"kind": PKG_DELTA_KIND, "id": recipe_id, "base": base["digest"], "target": digest,
+                                               "ops": RecipeService._patch_ops(base_doc, doc)})
+                # 按 UTF-8 字节数比较，与 size / delta_size 口径一致（中文名称等多字节字符）
+                delta_size = len(delta.encode("utf-8"))
+                if delta_size < int(rec["size"]):
+                    rec.update({"delta_digest": BlobService.put(delta), "delta_size": str(delta_size)})
+        pipe = r.pipeline(transaction=True)
+        pipe.delete(pkg_key)
+        pipe.hset(pkg_key, mapping=rec)
+        pipe.zadd(k_recipe_pkgs(recipe_id), {version: int(version)})
+        pipe.execute()
+        # 同一版本内容被改写后重新发布（如物料替换），释放旧制品的引用
+        for d in (cur.get("digest"), cur.get("delta_digest")):
+            if d:
+                BlobService.release(d)
+        r.xadd(k_audit_stream(), {"action": "recipe_publish", "target_id": recipe_id, "ts": ts(), "summary": f"{version} {digest[:12]}"})
+        return RecipeService._pkg_view(recipe_id, rec)
+
+    @staticmethod
+    def package(recipe_id: str, version: str | None = None, have: str | None = None) -> Dict[str, Any] | None:
+        # 设备取包清单：已持有当前摘要则无需下载；持有上一版本时给出增量摘要
+        r = redis_cli.r
+        if not version:
+            latest = r.zrevrange(k_recipe_pkgs(recipe_id), 0, 0)
+            if not latest:
+                return None
+            version = latest[0]
+        rec = r.hgetall(k_recipe_pkg(recipe_id, version))
+        if not rec.get("digest"):
+            return None
+        view = RecipeService._pkg_view(recipe_id, rec)
+        view["up_to_date"] = bool(have) and have == view["digest"]
+        view["use_delta"] = bool(have) and not view["up_to_date"] and have == view["base_digest"] and bool(view["delta_digest"])
+        return view
 
     @staticmethod
-    def dispatch(recipe_id: str, device_ids: List[str]) -> Dict[str, Any]:
+    def package_blob(recipe_id: str, digest: str) -> str | None:
+        # 按摘要读取制品或增量；只返回属于该配方的内容
+        raw = BlobService.get(digest)
+        doc = jget(raw) if raw else None
+        if not isinstance(doc, dict) or doc.get("kind") not in (PKG_KIND, PKG_DELTA_KIND) or doc.get("id") != recipe_id:
+            return None
+        return raw
+
+    @staticmethod
+    def dispatch(recipe_id: str, device_ids: List[str], selector: str | None = None) -> Dict[str, Any]:
         payload = {"recipe_id": recipe_id}
-        res = CommandService.dispatch_batch(device_ids, "recipe_update", payload, note=f"recipe {recipe_id}")
+        # 已发布则附带制品版本与摘要，设备已持有相同摘要时可跳过下载
+        pkg = RecipeService.package(recipe_id)
+        if pkg:
+            payload.update({"version": pkg["version"], "digest": pkg["digest"]})
+        res = CommandService.dispatch_batch(device_ids, "recipe_update", payload, note=f"recipe {recipe_id}", selector=selector)
         # audit
         redis_cli.r.xadd(k_audit_stream(), {"action": "recipe_dispatch", "target_id": recipe_id, "ts": ts(), "summary": res.get('batch_id')})
         return res
@@ -240,10 +413,9 @@ class RecipeService:
             ok, msg, norm = RecipeService._validate_schema(schema)
             if not ok:
                 errors.append({"id": rid, "error": msg}); continue
-            for ing in norm.get('ingredients', []):
-                code = ing.get('material') or ing.get('material_code')
-                if code and not redis_cli.r.exists(k_dict_material(code)):
-                    missing.add(code)
+            codes = [ing.get('material') or ing.get('material_code') for ing in norm.get('ingredients', [])]
+            known = DictCache.materials(codes)
+            missing.update(code for code in codes if code and not known.get(code))
             if dry_run:
                 details.append({"id": rid, "action": ("update" if exists else "create")})
             else:
@@ -257,6 +429,23 @@ class RecipeService:
             redis_cli.r.xadd(k_audit_stream(), {"action": "recipe_import", "ts": ts(), "summary": f"c{created}/u{updated}/m{len(missing)}"})
             return {"result": {"created": created, "updated": updated, "conflicts": conflicts, "errors": errors, "missing_materials": sorted(list(missing))}, "applied": True}
 
+    @staticmethod
+    def reindex_all() -> int:
+        # 回填派生索引（需求向量、检索索引等），用于索引引入前已存在的配方
+        r = redis_cli.r
+        n = 0
+        for rid in r.smembers(k_dict_recipe_all()):
+            h = r.hgetall(k_dict_recipe(rid))
+            if not h:
+                continue
+            sj = jget(h.get("schema_json")) or {}
+            AvailabilityService.set_recipe_requirements(rid, AvailabilityService.requirement_vector(sj))
+            pipe = r.pipeline(transaction=False)
+            DictIndex.write(pipe, "recipe", rid, set(), RecipeService._postings(h), h.get("updated_ts"))
+            pipe.execute()
+            n += 1
+        return n
+
     @staticmethod
     def list_enabled():
         r = redis_cli.r
@@ -0,0 +1,149 @@
+import re
+import uuid
+from typing import Dict, Any, List, Tuple, Iterable, Iterator
+from ..utils.extensions import redis_cli
+from ..utils.keys import k_devices_all, k_devices_label, k_devices_tmp
+
+# 选择器求值结果的保留秒数（下发过程中逐块取出）
+TMP_TTL_S = 600
+# 每次从结果集合取出的条数
+POP_COUNT = 500
+
+_TOKEN = re.compile(r"\(|\)|[^\s()]+")
+
+
+# 设备选择器：tag:a AND region:b AND NOT status:offline，支持 OR 与括号，优先级 NOT > AND > OR；
+# 每个 key:value 对应一个标签集合，* 为全部设备。整条表达式编译为一次事务内的
+# SINTERSTORE / SUNIONSTORE / SDIFFSTORE，结果落在临时集合上
+class TargetService:
+    @staticmethod
+    def parse(selector: str):
+        tokens = _TOKEN.findall(selector or "")
+        if not tokens:
+            raise ValueError("INVALID_ARGUMENT:selector")
+        pos = 0
+
+        def peek():
+            return tokens[pos].upper() if pos < len(tokens) else None
+
+        def take():
+            nonlocal pos
+            pos += 1
+            return tokens[pos - 1]
+
+        def expr():
+            nodes = [conj()]
+            while peek() == "OR":
+                take()
+                nodes.append(conj())
+            return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+        def conj():
+            nodes = [unary()]
+            while peek() == "AND":
+                take()
+                nodes.append(unary())
+            return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+        def unary():
+            if peek() == "NOT":
+                take()
+                return ("not", unary())
+            if peek() == "(":
+                take()
+                node = expr()
+                if peek() != ")":
+                    raise ValueError("INVALID_ARGUMENT:selector")
+                take()
+                return node
+            if peek() in (None, ")", "AND", "OR"):
+                raise ValueError("INVALID_ARGUMENT:selector")
+            tok = take()
+            if tok == "*":
+                return ("all",)
+            key, sep, value = tok.partition(":")
+            if not sep or not key or not value:
+                raise ValueError("INVALID_ARGUMENT:selector")
+            return ("term", key, value)
+
+        node = expr()
+        if pos != len(tokens):
+            raise ValueError("INVALID_ARGUMENT:selector")
+        return node
+
+    @staticmethod
+    def _compile(pipe, node, temps: List[str]) -> str:
+        kind = node[0]
+        if kind == "all":
+            return k_devices_all()
+        if kind == "term":
+            return k_devices_label(node[1], node[2])
+
+        def tmp():
+            key = k_devices_tmp(uuid.uuid4().hex)
+            temps.append(key)
+            return key
+
+        if kind == "or":
+            out = tmp()
+            pipe.sunionstore(out, [TargetService._compile(pipe, n, temps) for n in node[1]])
+            return out
+        if kind == "not":
+            out = tmp()
+            pipe.sdiffstore(out, [k_devices_all(), TargetService._compile(pipe, node[1], temps)])
+            return out
+        # and：肯定项求交，否定项直接做差集，避免先对全集取补
+        pos = [TargetService._compile(pipe, n, temps) for n in node[1] if n[0] != "not"]
+        neg = [TargetService._compile(pipe, n[1], temps) for n in node[1] if n[0] == "not"]
+        out = tmp()
+        pipe.sinterstore(out, pos or [k_devices_all()])
+        if neg:
+            pipe.sdiffstore(out, [out, *neg])
+        return out
+
+    @staticmethod
+    def resolve(selector: str) -> Tuple[str, int]:
+        # 返回结果临时集合与设备数；由 iter_ids 取空删除，或调用方自行删除
+        r = redis_cli.r
+        temps: List[str] = []
+        pipe = r.pipeline(transaction=True)
+        src = TargetService._compile(pipe, TargetService.parse(selector), temps)
+        out = k_devices_tmp(uuid.uuid4().hex)
+        # 结果始终落在独立临时键上，读取期间不受源集合变更影响
+        pipe.sunionstore(out, [src])
+        pipe.expire(out, TMP_TTL_S)
+        pipe.scard(out)
+        if temps:
+            pipe.delete(*temps)
+        res = pipe.execute()
+        return out, int(res[-2] if temps else res[-1])
+
+    @staticmethod
+    def iter_ids(key: str) -> Iterator[str]:
+        # 逐块 SPOP 取出（不重复，取空即删除），中途放弃时清理剩余
+        r = redis_cli.r
+        try:
+            while True:
+                ids = r.spop(key, POP_COUNT)
+                if not ids:
+                    break
+                yield from ids
+        finally:
+            r.delete(key)
+
+    @staticmethod
+    def targets(device_ids: List[str] | None, selector: str | None) -> Tuple[Iterable[str], int]:
+        # 批次目标：给出 selector 时按选择器流式读取，否则使用显式 device_ids
+        if selector:
+            key, n = TargetService.resolve(selector)
+            return TargetService.iter_ids(key), n
+        ids = list(device_ids or [])
+        return ids, len(ids)
+
+    @staticmethod
+    def preview(selector: str, limit: int = 20) -> Dict[str, Any]:
+        key, n = TargetService.resolve(selector)
+        r = redis_cli.r
+        sample = sorted(r.srandmember(key, max(0, min(int(limit or 20), 200))) or [])
+        r.delete(key)
+        return {"selector": selector, "count": n, "sample": sample}
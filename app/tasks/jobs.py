@@ -1,7 +1,14 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
 from ..utils.extensions import redis_cli
+from ..utils.keys import k_migration, ts
 from ..services.commands import CommandService
+from ..services.recipes import RecipeService
+from ..services.materials import MaterialService
+from ..services.devices import DeviceService
+
+# 回填执行中标记的过期秒数（进程中途退出后可由下次启动重新执行）
+MIGRATION_LOCK_S = 3600
 
 
 def register_jobs(sched: BackgroundScheduler, app):
@@ -14,3 +21,64 @@ def register_jobs(sched: BackgroundScheduler, app):
             pass
 
     sched.add_job(recycle_inflight, 'interval', minutes=1, id='recycle_inflight', max_instances=1, coalesce=True)
+
+    # 延迟重试队列搬运（到期命令回到 pending）
+    def promote_delayed():
+        try:
+            CommandService.promote_delayed()
+        except Exception:
+            pass
+
+    sched.add_job(promote_delayed, 'interval', seconds=5, id='promote_delayed', max_instances=1, coalesce=True)
+
+    # 命令历史保留期清理（终态命令超过 CMD_RETENTION_DAYS 天即删除）
+    def expire_history():
+        try:
+            with app.app_context():
+                CommandService.expire_history()
+        except Exception:
+            pass
+
+    sched.add_job(expire_history, 'interval', minutes=30, id='expire_history', max_instances=1, coalesce=True)
+
+    # 心跳超时的设备置为离线（发布 device.offline 事件）
+    def mark_offline():
+        try:
+            DeviceService.mark_offline(app.config.get("DEVICE_OFFLINE_S", 180))
+        except Exception:
+            pass
+
+    sched.add_job(mark_offline, 'interval', seconds=30, id='mark_offline', max_instances=1, coalesce=True)
+
+    # 启动时的一次性回填（幂等）：SET NX 抢占 cm:migr:{name}，完成后写入 done 标记，
+    # 之后任何进程启动都直接跳过；失败则删除标记，下次启动重试
+    def migrate(name, fn):
+        def job():
+            try:
+                r = redis_cli.r
+                if not r.set(k_migration(name), f"running:{ts()}", nx=True, ex=MIGRATION_LOCK_S):
+                    return
+                try:
+                    with app.app_context():
+                        fn()
+                except Exception:
+                    r.delete(k_migration(name))
+                    return
+                r.set(k_migration(name), f"done:{ts()}")
+            except Exception:
+                # best-effort
+                pass
+        return job
+
+    for name, fn in (
+        ("reindex_recipes", RecipeService.reindex_all),          # 配方需求向量与检索索引
+        ("reindex_recipe_usage", RecipeService.reindex_usage),   # recipe → 菜单项 / 启用设备
+        ("reindex_materials", MaterialService.reindex),          # 物料检索索引
+        ("reindex_material_refs", MaterialService.reindex_refs), # material → recipes 全量引用
+        ("reindex_inflight", CommandService.reindex_inflight),   # 已下发命令的 inflight 截止时间
+        ("reindex_batches", CommandService.reindex_batches),     # 旧批次状态集合、计数与列表索引
+        ("reindex_labels", DeviceService.reindex_labels),        # 设备全集与状态 / 标签索引
+        ("reindex_bins", DeviceService.reindex_bins),            # 设备料仓集合与 material → bins
+        ("reindex_history", CommandService.reindex_history),     # 设备历史与保留期索引
+    ):
+        sched.add_job(migrate(name, fn), 'date', id=name)
@@ -19,5 +19,11 @@ def load_config():
         },
         "EXPORT_MAX_RANGE": int(env("EXPORT_MAX_RANGE", 31)),
         "MENU_MAX_ITEMS": int(env("MENU_MAX_ITEMS", 500)),
+        "CMD_LONGPOLL_MAX_WAIT": int(env("CMD_LONGPOLL_MAX_WAIT", 30)),
+        "CMD_TIMEOUT_S": int(env("CMD_TIMEOUT_S", 60)),
+        "BATCH_DEDUP_TTL_S": int(env("BATCH_DEDUP_TTL_S", 3600)),
+        "CMD_RETENTION_DAYS": int(env("CMD_RETENTION_DAYS", 7)),
         "ENABLE_SSE": env("ENABLE_SSE", "0") == "1",
+        "SSE_KEEPALIVE_S": int(env("SSE_KEEPALIVE_S", 15)),
+        "DEVICE_OFFLINE_S": int(env("DEVICE_OFFLINE_S", 180)),
     }
@@ -13,6 +13,11 @@ def k_menu_cats(device_id: str) -> str:
     return f"cm:dev:{device_id}:menu:cats"
 
 
+def k_menu_cats_tmp(device_id: str, token: str) -> str:
+    # 导入时新分类集合先写在临时键，切换时 RENAME
+    return f"cm:dev:{device_id}:menu:cats:tmp:{token}"
+
+
 def k_menu_cat(device_id: str, cat_id: str) -> str:
     return f"cm:dev:{device_id}:menu:cat:{cat_id}"
 
@@ -29,6 +34,11 @@ def k_menu_available(device_id: str) -> str:
     return f"cm:dev:{device_id}:menu:available"
 
 
+def k_menu_available_tmp(device_id: str, token: str) -> str:
+    # 全量重建时的临时集合，构建完成后 RENAME 覆盖 menu:available
+    return f"cm:dev:{device_id}:menu:available:tmp:{token}"
+
+
 def k_menu_seq_cat(device_id: str) -> str:
     return f"cm:dev:{device_id}:menu:seq:cat"
 
@@ -58,6 +68,34 @@ def k_cmd_pending_q(device_id: str) -> str:
 def k_cmd_inflight(device_id: str) -> str:
     return f"cm:dev:{device_id}:cmd:inflight"
 
+def k_cmd_processing_q(device_id: str) -> str:
+    # 长轮询 BLMOVE 的目标列表：已出队、尚未标记 sent 的命令
+    return f"cm:dev:{device_id}:q:cmd:processing"
+
+def k_cmd_by_ts(device_id: str) -> str:
+    # 设备命令历史：cmd_id，score 为 issued_ts
+    return f"cm:dev:{device_id}:cmds:by_ts"
+
+def k_cmd_all_by_ts() -> str:
+    # 全局命令索引（保留期清理用）：member "device_id:cmd_id"，score 为 issued_ts
+    return "cm:cmd:by_ts"
+
+def k_cmd_coalesce(device_id: str) -> str:
+    # 可合并命令类型 → 最近一次单独下发的 cmd_id（仍 pending 且负载相同则复用）
+    return f"cm:dev:{device_id}:q:cmd:coalesce"
+
+def k_dedup_batch(dedup_key: str) -> str:
+    # 批次去重登记：dedup_key → batch_id（SET NX EX）
+    return f"cm:dedup:batch:{dedup_key}"
+
+def k_cmd_inflight_deadlines() -> str:
+    # 全局 inflight 截止时间索引：member "device_id:cmd_id"，score 为超时时刻
+    return "cm:cmd:inflight:by_deadline"
+
+def k_cmd_delayed() -> str:
+    # 延迟重试队列：member "device_id:cmd_id"，score 为可再次下发的时刻
+    return "cm:cmd:delayed"
+
 # Orders
 def k_order(device_id: str, order_id: str) -> str:
     return f"cm:dev:{device_id}:order:{order_id}"
@@ -89,6 +127,27 @@ def k_dict_material(code: str) -> str:
 def k_dict_material_all() -> str:
     return "cm:dict:material:all"
 
+def k_dict_gen() -> str:
+    # 字典代数：物料 / 配方每次写入 +1，各进程据此整体失效本地缓存
+    return "cm:dict:gen"
+
+# 字典检索索引（kind 为 material / recipe；与字典条目键分开命名，避免与条目 id 冲突）
+def k_dict_by_ts(kind: str) -> str:
+    # 条目 id，score 为 updated_ts
+    return f"cm:idx:dict:{kind}:by_ts"
+
+def k_dict_field(kind: str, field: str, value: str) -> str:
+    # 筛选索引（unit / active / enabled / tag → id 集合）
+    return f"cm:idx:dict:{kind}:f:{field}:{value}"
+
+def k_dict_gram(kind: str, gram: str) -> str:
+    # 关键字 n-gram 索引（code / id / 中英文名称的 1~3 字符子串 → id 集合）
+    return f"cm:idx:dict:{kind}:gram:{gram}"
+
+def k_dict_tmp(kind: str, token: str) -> str:
+    # 组合筛选的临时交集（同一事务内创建并删除）
+    return f"cm:idx:dict:{kind}:tmp:{token}"
+
 # Alarms
 def k_alarm(device_id: str, alarm_id: str) -> str:
     return f"cm:dev:{device_id}:alarm:{alarm_id}"
@@ -103,12 +162,150 @@ def k_alarms_status(device_id: str, status: str) -> str:
 def k_batch(batch_id: str) -> str:
     return f"cm:batch:{batch_id}"
 
+def k_batches_by_ts() -> str:
+    # 批次列表索引：batch_id，score 为 created_ts
+    return "cm:batches:by_ts"
+
+def k_batches_idx(field: str, value: str) -> str:
+    # 批次筛选索引（type / status / creator / tag → batch_id 集合）
+    return f"cm:batches:idx:{field}:{value}"
+
+def k_batches_tmp(token: str) -> str:
+    # 组合筛选的临时交集（同一事务内创建并删除）
+    return f"cm:batches:tmp:{token}"
+
 def k_batch_cmds(batch_id: str) -> str:
     return f"cm:batch:{batch_id}:cmds"
 
+def k_batch_items(batch_id: str) -> str:
+    # 批次全部命令（zset，score 为 issued_ts）
+    return f"cm:batch:{batch_id}:items"
+
+def k_batch_status(batch_id: str, status: str) -> str:
+    # 批次内按状态分组的命令（zset，score 为 issued_ts），随状态迁移原子移动
+    return f"cm:batch:{batch_id}:st:{status}"
+
+def k_batch_progress(batch_id: str) -> str:
+    # 批次进度频道（pub/sub，非键）：命令状态迁移发布 "from>to"，批次元信息变更发布 "meta"
+    return f"cm:batch:{batch_id}:progress"
+
+def k_batch_staging(batch_id: str) -> str:
+    # 限流批次的待放行队列（list of "device_id:cmd_id"）
+    return f"cm:batch:{batch_id}:staging"
+
+def k_batch_parked(batch_id: str) -> str:
+    # 暂停批次的停放队列：领取时遇到即移出设备队列，恢复时整体放回
+    return f"cm:batch:{batch_id}:parked"
+
 # Recipe device active set and packages
 def k_dev_recipes_active(device_id: str) -> str:
     return f"cm:dev:{device_id}:recipes:active"
 
 def k_recipe_pkg(recipe_id: str, version: str) -> str:
+    # 发布记录：digest / size / base_version / base_digest / delta_digest / delta_size / built_ts
     return f"cm:pkg:recipe:{recipe_id}:{version}"
+
+def k_recipe_pkgs(recipe_id: str) -> str:
+    # 已发布版本：version，score 为版本号
+    return f"cm:idx:recipe:{recipe_id}:pkgs"
+
+# Device bins / stock
+def k_dev_bin(device_id: str, bin_index: str) -> str:
+    return f"cm:dev:{device_id}:bin:{bin_index}"
+
+def k_dev_bins(device_id: str) -> str:
+    return f"cm:dev:{device_id}:bins"
+
+def k_dev_bins_low(device_id: str) -> str:
+    return f"cm:dev:{device_id}:bins:low"
+
+def k_dev_stock(device_id: str) -> str:
+    # material_code -> 该设备所有料仓剩余量之和
+    return f"cm:dev:{device_id}:stock"
+
+# Availability join indexes
+def k_recipe_req(recipe_id: str) -> str:
+    # 配方需求向量：material_code -> 单杯用量
+    return f"cm:idx:recipe:{recipe_id}:req"
+
+def k_material_recipes(code: str) -> str:
+    return f"cm:idx:material:{code}:recipes"
+
+def k_material_refs(code: str) -> str:
+    # schema 任意位置（配料、步骤参数、选项等）以 material / material_code 引用该物料的配方
+    return f"cm:idx:material:{code}:refs"
+
+def k_material_bins(code: str) -> str:
+    # 装有该物料的料仓："device_id:bin_index"
+    return f"cm:idx:material:{code}:bins"
+
+def k_recipe_menu_refs(recipe_id: str) -> str:
+    # 成员为 "{device_id}:{item_id}"
+    return f"cm:idx:recipe:{recipe_id}:menu_refs"
+
+def k_recipe_devices_active(recipe_id: str) -> str:
+    # cm:dev:{d}:recipes:active 的反向索引：启用该配方的设备
+    return f"cm:idx:recipe:{recipe_id}:devices_active"
+
+def k_menu_recipe_items(device_id: str, recipe_id: str) -> str:
+    return f"cm:dev:{device_id}:menu:recipe:{recipe_id}:items"
+
+# Shared menu templates
+def k_menu_tpl(tpl_id: str) -> str:
+    return f"cm:menu:tpl:{tpl_id}"
+
+def k_menu_tpl_all() -> str:
+    return "cm:menu:tpl:all"
+
+def k_menu_tpl_doc(tpl_id: str, version: str) -> str:
+    # 某一版本的模板菜单（JSON），发布后不可变
+    return f"cm:menu:tpl:{tpl_id}:v:{version}"
+
+def k_menu_tpl_seq(tpl_id: str) -> str:
+    return f"cm:menu:tpl:{tpl_id}:seq"
+
+def k_menu_tpl_devices(tpl_id: str) -> str:
+    return f"cm:menu:tpl:{tpl_id}:devices"
+
+def k_menu_ovr(device_id: str) -> str:
+    # 设备覆盖层：item_id -> {"price_cents_override","visibility","schedule_json"}
+    return f"cm:dev:{device_id}:menu:ovr"
+
+def k_recipe_tpl_refs(recipe_id: str) -> str:
+    return f"cm:idx:recipe:{recipe_id}:tpl_refs"
+
+# Content-addressed blobs
+def k_blob(digest: str) -> str:
+    # 内容寻址的共享负载：enc / data / size / refs
+    return f"cm:blob:{digest}"
+
+# Event bus
+def k_event_stream() -> str:
+    # 全局事件流（设备上下线、订单、告警、料仓低料），id 即 SSE Last-Event-ID
+    return "cm:stream:events"
+
+def k_devices_last_seen() -> str:
+    # 设备最近心跳：device_id，score 为 last_seen_ts（离线判定用）
+    return "cm:devices:last_seen"
+
+# Device targeting
+def k_devices_all() -> str:
+    # 全部设备（选择器 NOT / * 的全集）
+    return "cm:devices:all"
+
+def k_devices_label(key: str, value: str) -> str:
+    # 标签索引：tag:a / group:g / status:online / region:b … → device_id 集合
+    return f"cm:devices:label:{key}:{value}"
+
+def k_devices_groups() -> str:
+    # 已使用的分组名
+    return "cm:devices:groups"
+
+def k_devices_tmp(token: str) -> str:
+    # 选择器求值的临时集合（带过期时间）
+    return f"cm:devices:tmp:{token}"
+
+# One-time backfills
+def k_migration(name: str) -> str:
+    # 回填完成标记："done:{ts}"；执行中为带过期时间的 "running:{ts}"
+    return f"cm:migr:{name}"
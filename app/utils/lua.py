@@ -0,0 +1,277 @@
+from typing import Dict
+from redis.commands.core import Script
+
+
+# 服务端脚本：把“读-判-写”合并为一次原子执行，避免多次往返与中途崩溃丢状态。
+# 说明：脚本内会按前缀拼出命令/批次哈希键，仅适用于单实例 Redis（非 Cluster）。
+
+# 状态迁移公共函数（拼接在各脚本之前）：改写命令状态，属于批次的命令同时在
+# cm:batch:{id}:st:{status}（score=issued_ts）之间移动并调整 count_{status} 计数，
+# 同时向 cm:batch:{id}:progress 发布 "from>to"。
+# 返回原状态；命令不存在返回 false。
+TRANSITION_LIB = """
+local function cm_move(cmd_key, bprefix, cmd_id, to)
+  local h = redis.call('HMGET', cmd_key, 'status', 'batch_id', 'issued_ts')
+  local from = h[1]
+  if not from then
+    return false
+  end
+  if from ~= to and h[2] and h[2] ~= '' then
+    local bkey = bprefix .. h[2]
+    redis.call('ZREM', bkey .. ':st:' .. from, cmd_id)
+    redis.call('ZADD', bkey .. ':st:' .. to, tonumber(h[3]) or 0, cmd_id)
+    redis.call('HINCRBY', bkey, 'count_' .. from, -1)
+    redis.call('HINCRBY', bkey, 'count_' .. to, 1)
+    redis.call('PUBLISH', bkey .. ':progress', from .. '>' .. to)
+  end
+  redis.call('HSET', cmd_key, 'status', to)
+  return from
+end
+"""
+
+# 领取命令：先消费 processing（长轮询 BLMOVE 遗留），再从 pending 队尾弹出；
+# 跳过已取消/已删除的命令，批次暂停的命令移入该批次的 parked 列表（不再回到设备队列），其余标记 sent、登记 inflight，
+# 并按批次 timeout_s（缺省取 ARGV[6]）写入全局截止时间索引。
+# KEYS: pending, processing, inflight, inflight_deadlines
+# ARGV: limit, now, cmd_hash_prefix, batch_hash_prefix, device_id, default_timeout_s
+CLAIM = TRANSITION_LIB + """
+local pending, processing, inflight, deadlines = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local limit = tonumber(ARGV[1])
+local now = ARGV[2]
+local cprefix, bprefix = ARGV[3], ARGV[4]
+local device_id, default_timeout = ARGV[5], tonumber(ARGV[6])
+local out = {}
+local function take(id)
+  local key = cprefix .. id
+  local h = redis.call('HMGET', key, 'status', 'batch_id')
+  if not h[1] or h[1] == 'canceled' then
+    return
+  end
+  local timeout = default_timeout
+  if h[2] and h[2] ~= '' then
+    local b = redis.call('HMGET', bprefix .. h[2], 'paused', 'timeout_s')
+    if b[1] == '1' then
+      redis.call('RPUSH', bprefix .. h[2] .. ':parked', device_id .. ':' .. id)
+      return
+    end
+    local t = tonumber(b[2])
+    if t and t > 0 then
+      timeout = t
+    end
+  end
+  cm_move(key, bprefix, id, 'sent')
+  redis.call('HSET', key, 'sent_ts', now)
+  redis.call('ZADD', inflight, now, id)
+  redis.call('ZADD', deadlines, tonumber(now) + timeout, device_id .. ':' .. id)
+  table.insert(out, id)
+end
+while #out < limit do
+  local id = redis.call('RPOP', processing)
+  if not id then break end
+  take(id)
+end
+local scanned = 0
+while #out < limit and scanned < limit * 5 do
+  local id = redis.call('RPOP', pending)
+  if not id then break end
+  scanned = scanned + 1
+  take(id)
+end
+return out
+"""
+
+# 超时回收单条命令：仅当截止时间索引中的分数仍等于扫描时看到的值（未被重新领取）
+# 且状态仍为 sent 时才处理；未超出 max_attempts 则按退避时间放入延迟队列，否则置为 fail。
+# KEYS: cmd_hash, delayed, inflight, inflight_deadlines
+# ARGV: cmd_id, member, observed_deadline, default_max_attempts, eligible_ts, batch_hash_prefix
+REQUEUE_EXPIRED = TRANSITION_LIB + """
+local score = redis.call('ZSCORE', KEYS[4], ARGV[2])
+if not score or tonumber(score) ~= tonumber(ARGV[3]) then
+  return 'skip'
+end
+redis.call('ZREM', KEYS[4], ARGV[2])
+redis.call('ZREM', KEYS[3], ARGV[1])
+local h = redis.call('HMGET', KEYS[1], 'status', 'attempts', 'max_attempts')
+if h[1] ~= 'sent' then
+  return 'skip'
+end
+local attempts = (tonumber(h[2]) or 0) + 1
+local max_attempts = tonumber(h[3]) or tonumber(ARGV[4])
+if attempts < max_attempts then
+  cm_move(KEYS[1], ARGV[6], ARGV[1], 'pending')
+  redis.call('HSET', KEYS[1], 'attempts', attempts, 'next_attempt_ts', ARGV[5], 'last_error', 'timeout')
+  redis.call('ZADD', KEYS[2], ARGV[5], ARGV[2])
+  return 'requeued'
+end
+cm_move(KEYS[1], ARGV[6], ARGV[1], 'fail')
+redis.call('HSET', KEYS[1], 'attempts', attempts, 'last_error', 'timeout')
+return 'failed'
+"""
+
+# 通用状态迁移：可限定允许的原状态（逗号分隔，空为不限），并附带写入其它字段。
+# 返回原状态；不允许迁移时返回 '!' .. 原状态；命令不存在返回 false。
+# KEYS: cmd_hash
+# ARGV: batch_hash_prefix, cmd_id, to_status, allowed_from, field1, value1, ...
+SET_STATUS = TRANSITION_LIB + """
+local cur = redis.call('HGET', KEYS[1], 'status')
+if not cur then
+  return false
+end
+if ARGV[4] ~= '' and not string.find(',' .. ARGV[4] .. ',', ',' .. cur .. ',', 1, true) then
+  return '!' .. cur
+end
+cm_move(KEYS[1], ARGV[1], ARGV[2], ARGV[3])
+for i = 5, #ARGV - 1, 2 do
+  redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return cur
+"""
+
+# 延迟队列到期搬运（单设备一批）：逐条 ZREM 成功者才 LPUSH，多实例并发搬运也不会重复入队。
+# KEYS: delayed, pending
+# ARGV: device_id, cmd_id...
+PROMOTE_DUE = """
+local n = 0
+for i = 2, #ARGV do
+  if redis.call('ZREM', KEYS[1], ARGV[1] .. ':' .. ARGV[i]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[i])
+    n = n + 1
+  end
+end
+return n
+"""
+
+# 批次放行：在 active < max_concurrency 期间从 staging 取出命令推入设备 pending 队列；
+# max_concurrency <= 0 时全部放行；批次暂停或已取消时不放行。
+# KEYS: batch_hash, staging
+# ARGV: pending_key_prefix, pending_key_suffix
+RELEASE_BATCH = """
+local b = redis.call('HMGET', KEYS[1], 'max_concurrency', 'active', 'paused', 'status')
+if b[3] == '1' or b[4] == 'canceled' then
+  return 0
+end
+local maxc = tonumber(b[1]) or 0
+local active = tonumber(b[2]) or 0
+local n = 0
+while maxc <= 0 or active < maxc do
+  local m = redis.call('LPOP', KEYS[2])
+  if not m then break end
+  local sep = string.find(m, ':[^:]*$')
+  redis.call('LPUSH', ARGV[1] .. string.sub(m, 1, sep - 1) .. ARGV[2], string.sub(m, sep + 1))
+  active = active + 1
+  n = n + 1
+end
+if n > 0 then
+  redis.call('HSET', KEYS[1], 'active', active)
+end
+return n
+"""
+
+# 批次恢复：清除暂停标记并把 parked 命令整体放回各设备队列的出队端（保持原有先后顺序）。
+# KEYS: batch_hash, parked
+# ARGV: pending_key_prefix, pending_key_suffix
+RESUME_BATCH = """
+redis.call('HSET', KEYS[1], 'paused', '0')
+local n = 0
+while true do
+  local m = redis.call('RPOP', KEYS[2])
+  if not m then break end
+  local sep = string.find(m, ':[^:]*$')
+  redis.call('RPUSH', ARGV[1] .. string.sub(m, 1, sep - 1) .. ARGV[2], string.sub(m, sep + 1))
+  n = n + 1
+end
+return n
+"""
+
+# 过期清理单条命令：仅终态命令，先把结果计入批次汇总（count_* 保持不变，另记 count_expired），
+# 再移出批次成员/状态索引与设备历史并删除命令哈希。返回 1 表示已清理。
+# KEYS: cmd_hash, device_by_ts, all_by_ts
+# ARGV: cmd_id, member, batch_hash_prefix
+EXPIRE_CMD = """
+local h = redis.call('HMGET', KEYS[1], 'status', 'batch_id')
+if h[1] and h[1] ~= 'success' and h[1] ~= 'fail' and h[1] ~= 'canceled' then
+  return 0
+end
+if h[1] and h[2] and h[2] ~= '' then
+  local bkey = ARGV[3] .. h[2]
+  redis.call('HINCRBY', bkey, 'count_expired', 1)
+  redis.call('ZREM', bkey .. ':items', ARGV[1])
+  redis.call('ZREM', bkey .. ':st:' .. h[1], ARGV[1])
+  redis.call('HDEL', bkey .. ':cmds', ARGV[1])
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[2])
+return 1
+"""
+
+# 离线判定：最近心跳早于 cutoff 且仍为 online 时置为 offline；心跳期间被刷新则不处理。
+# 返回 1 表示本次转为离线。
+# KEYS: device_hash, last_seen
+# ARGV: device_id, cutoff, status_label_prefix
+MARK_OFFLINE = """
+local h = redis.call('HMGET', KEYS[1], 'status', 'last_seen_ts')
+if (tonumber(h[2]) or 0) > tonumber(ARGV[2]) then
+  return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+if h[1] ~= 'online' then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'offline')
+redis.call('SREM', ARGV[3] .. 'online', ARGV[1])
+redis.call('SADD', ARGV[3] .. 'offline', ARGV[1])
+return 1
+"""
+
+# 共享负载引用计数递减，归零即删除。
+# KEYS: blob_hash
+BLOB_RELEASE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return -1
+end
+local n = redis.call('HINCRBY', KEYS[1], 'refs', -1)
+if n <= 0 then
+  redis.call('DEL', KEYS[1])
+end
+return n
+"""
+
+# 共享负载写入：正文已存在只增加引用；不存在且带正文参数时写入正文并增加引用，
+# 不带参数返回 0（调用方编码后再调用）。判断与写入原子完成，不会与 BLOB_RELEASE 交错出只有 refs 的哈希。
+# KEYS: blob_hash；ARGV: [enc, data, size, created_ts]
+BLOB_PUT = """
+if redis.call('HEXISTS', KEYS[1], 'data') == 1 then
+  redis.call('HINCRBY', KEYS[1], 'refs', 1)
+  return 1
+end
+if #ARGV == 0 then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'enc', ARGV[1], 'data', ARGV[2], 'size', ARGV[3], 'created_ts', ARGV[4])
+redis.call('HINCRBY', KEYS[1], 'refs', 1)
+return 1
+"""
+
+SCRIPTS: Dict[str, str] = {
+    "claim": CLAIM,
+    "requeue_expired": REQUEUE_EXPIRED,
+    "set_status": SET_STATUS,
+    "promote_due": PROMOTE_DUE,
+    "release_batch": RELEASE_BATCH,
+    "resume_batch": RESUME_BATCH,
+    "blob_put": BLOB_PUT,
+    "blob_release": BLOB_RELEASE,
+    "expire_cmd": EXPIRE_CMD,
+    "mark_offline": MARK_OFFLINE,
+}
+
+_registered: Dict[str, Script] = {}
+
+
+def script(r, name: str) -> Script:
+    # 惰性注册；调用时请显式传 client=（客户端可能在测试/重连时被替换）
+    s = _registered.get(name)
+    if s is None:
+        s = _registered[name] = r.register_script(SCRIPTS[name])
+    return s
@@ -0,0 +1,79 @@
+import os
+import time
+import json
+from app import create_app
+
+app = create_app()
+
+
+# 旧版领取逻辑（逐条 RPOP / HGETALL / HSET / ZADD），作为基准对照
+def legacy_claim(r, device_id: str, limit: int = 1):
+    from app.utils.keys import k_cmd_hash, k_cmd_pending_q, k_cmd_inflight, k_batch, ts
+    result = []
+    tries = 0
+    for _ in range(max(1, min(limit, 20))):
+        cmd_id = r.rpop(k_cmd_pending_q(device_id))
+        if not cmd_id:
+            break
+        key = k_cmd_hash(device_id, cmd_id)
+        ch = r.hgetall(key)
+        if ch and (ch.get("status") == "canceled"):
+            continue
+        bid = ch.get("batch_id") if ch else ""
+        if bid:
+            b = r.hgetall(k_batch(bid)) or {}
+            if (b.get("paused") == "1"):
+                r.lpush(k_cmd_pending_q(device_id), cmd_id)
+                tries += 1
+                if tries > 5:
+                    break
+                continue
+        r.hset(key, mapping={"status": "sent", "sent_ts": str(ts())})
+        r.zadd(k_cmd_inflight(device_id), {cmd_id: ts()})
+        h = ch or r.hgetall(key)
+        h["id"] = cmd_id
+        result.append(h)
+    return result
+
+
+# 领取吞吐基准：python bench_claim.py（BENCH_N 条命令，BENCH_LIMIT 每次领取条数）
+if __name__ == "__main__":
+    from app.utils.extensions import redis_cli
+    from app.services.commands import CommandService
+    r = redis_cli.r
+    device_id = os.environ.get("BENCH_DEVICE", "dev-bench")
+    n = int(os.environ.get("BENCH_N", 2000))
+    limit = int(os.environ.get("BENCH_LIMIT", 10))
+
+    def reset():
+        keys = list(r.scan_iter(match=f"cm:dev:{device_id}:*"))
+        if keys:
+            r.delete(*keys)
+        batch = CommandService.dispatch_batch([device_id] * (n // 2), "sync", {}, "bench")
+        # 单独命令各带不同负载，避免 sync 合并后实际条数少于 BENCH_N
+        for i in range(n - n // 2):
+            CommandService.enqueue(device_id, "sync", {"bench_seq": i})
+        return batch["batch_id"]
+
+    def run(claim):
+        t = time.perf_counter()
+        got = 0
+        while True:
+            out = claim(limit)
+            if not out:
+                break
+            got += len(out)
+        dt = time.perf_counter() - t
+        return {"claimed": got, "seconds": round(dt, 3), "per_sec": round(got / dt, 1) if dt else None}
+
+    report = {}
+    with app.app_context():
+        bids = [reset()]
+        report["legacy"] = run(lambda k: legacy_claim(r, device_id, k))
+        bids.append(reset())
+        report["lua"] = run(lambda k: CommandService.claim(device_id, k))
+        for bid in bids:
+            r.delete(f"cm:batch:{bid}", f"cm:batch:{bid}:cmds")
+    for name, res in report.items():
+        assert res["claimed"] == n, f"{name}: claimed {res['claimed']} of {n}"
+    print(json.dumps({"n": n, "limit": limit, **report}, ensure_ascii=False))
@@ -4,8 +4,30 @@ from app import create_app
 
 app = create_app()
 
+
+def smoke_ack_after_cancel(device_id: str):
+    # 取消后的迟到回执：命令保持 canceled，不得回到 pending / 延迟队列
+    from app.utils.extensions import redis_cli
+    from app.utils.keys import k_cmd_hash, k_cmd_delayed
+    from app.services.commands import CommandService
+    r = redis_cli.r
+    with app.app_context():
+        res = CommandService.dispatch_batch([device_id], "sync", {"smoke": "ack-after-cancel"}, note="smoke")
+        claimed = CommandService.claim(device_id, 20)
+        cmd_id = next(c["id"] for c in claimed if c.get("batch_id") == res["batch_id"])
+        CommandService.batch_cancel(res["batch_id"])
+        ack = CommandService.ack_many(device_id, [{"id": cmd_id, "status": "fail", "error": "late"}])
+        counts = CommandService.get_batch(res["batch_id"])["counts"]
+    assert ack["rejected"] == [cmd_id] and not ack["acked"], ack
+    assert r.hget(k_cmd_hash(device_id, cmd_id), "status") == "canceled"
+    assert r.zscore(k_cmd_delayed(), f"{device_id}:{cmd_id}") is None
+    assert counts["canceled"] == 1 and counts["pending"] == 0, counts
+    return ack
+
+
 # 简单 smoke 测试：创建分类与商品并导出菜单
 if __name__ == "__main__":
+    print(json.dumps({"ack_after_cancel": smoke_ack_after_cancel(os.environ.get("SMOKE_DEVICE", "dev-smoke"))}, ensure_ascii=False))
     from app.utils.extensions import redis_cli
     r = redis_cli.r
     device_id = os.environ.get("SMOKE_DEVICE", "dev-smoke")